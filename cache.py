@@ -0,0 +1,266 @@
+__author__ = 'gabriel'
+"""
+On-disk cache for the output of read_gml() and read_data().
+
+Parsed entities are stored column-wise in a single flat binary file rather than pickled one object at a time:
+every string (FIDs, references, tag keys and values) is interned into one table, coordinates go into flat float
+arrays with offsets, and tags are stored as (key, type, value) columns so that numbers and times keep their type.
+Integers are kept apart from floats; both are stored in the float column, so integers must be exactly representable
+(no larger than 2 ** 53 in magnitude).
+Nothing is pickled, so the cache does not depend on where the entity classes live.
+
+Cache files are named by a hash of the source file's content, the parser that produced it (name and version) and
+the reader options, so an edited file or a parser change simply results in a cache miss. Bump the parser's
+PARSER_VERSION whenever its output changes.
+
+Each reader describes its output with a schema: a list of (store name, entity class, geometry attribute, kind)
+tuples. The entity classes must take (fid, geometry, tags) as their constructor arguments. The geometry kinds are
+    'point'     a single coordinate pair (or None)
+    'coords'    an (N, 2) coordinate array
+    'string'    a single string (or None)
+    'strings'   a list of strings
+    'mapping'   a dict of strings to strings
+"""
+import os
+import hashlib
+import tempfile
+import datetime
+import json
+import struct
+import numpy as np
+
+CACHE_VERSION = 2
+
+# tag value types
+TAG_STRING = 0
+TAG_NUMBER = 1
+TAG_TIME = 2
+TAG_INT = 3
+
+# largest magnitude of an integer tag that survives the float column exactly
+MAX_INT_TAG = 2 ** 53
+
+
+class StringTable(object):
+
+    def __init__(self):
+        # the empty string is always present, so the table is never empty
+        self.strings = [u'']
+        self.index = {u'': 0}
+
+    def __call__(self, s):
+        try:
+            return self.index[s]
+        except KeyError:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+            return self.index[s]
+
+    def encode(self):
+        blob = u'\x00'.join(unicode(t) for t in self.strings).encode('utf-8')
+        return np.frombuffer(blob, dtype=np.uint8)
+
+    @staticmethod
+    def decode(arr):
+        return arr.tostring().decode('utf-8').split(u'\x00')
+
+
+def file_hash(filename, blocksize=2 ** 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(filename, parser, parser_version, **options):
+    """
+    :param parser: Name of the parser, e.g. 'itn'.
+    :param options: Reader options that affect the output (filters etc). Their repr is included in the key.
+    """
+    opts = repr(sorted((k, getattr(v, 'wkt', v)) for k, v in options.items()))
+    h = hashlib.sha1()
+    h.update('%s|%s|%s|%s|%s' % (file_hash(filename), parser, parser_version, CACHE_VERSION, opts))
+    return '%s_%s' % (parser, h.hexdigest())
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + '.bin')
+
+
+def encode(stores, schema):
+    """
+    Encode the entity dictionaries into a dictionary of arrays.
+    :param stores: Dictionary of store name: {fid: entity}
+    """
+    strings = StringTable()
+    arrs = {}
+
+    for name, cls, geom_attr, kind in schema:
+        fids = stores[name].keys()
+        entities = [stores[name][t] for t in fids]
+        arrs[name + '_fid'] = np.array([strings(t) for t in fids], dtype=np.int32)
+        geoms = [getattr(e, geom_attr) for e in entities]
+
+        if kind == 'point':
+            arrs[name + '_geom'] = np.array([g if g is not None else (np.nan, np.nan) for g in geoms],
+                                            dtype=float).reshape(-1, 2)
+        elif kind == 'coords':
+            arrs[name + '_geom'] = np.concatenate([np.asarray(g, dtype=float).reshape(-1, 2) for g in geoms]) \
+                if geoms else np.zeros((0, 2))
+            arrs[name + '_offsets'] = np.cumsum([0] + [len(g) for g in geoms])
+        elif kind == 'string':
+            arrs[name + '_geom'] = np.array([strings(g) if g is not None else -1 for g in geoms], dtype=np.int32)
+        elif kind == 'strings':
+            arrs[name + '_geom'] = np.array([strings(t) for g in geoms for t in g], dtype=np.int32)
+            arrs[name + '_offsets'] = np.cumsum([0] + [len(g) for g in geoms])
+        elif kind == 'mapping':
+            arrs[name + '_geom'] = np.array([(strings(k), strings(v)) for g in geoms for k, v in g.iteritems()],
+                                            dtype=np.int32).reshape(-1, 2)
+            arrs[name + '_offsets'] = np.cumsum([0] + [len(g) for g in geoms])
+        else:
+            raise ValueError("Unrecognised geometry kind %s" % kind)
+
+        # tags: string values are interned, numbers (integer or not) are stored as floats and times as seconds since
+        # midnight
+        tag_keys = []
+        tag_types = []
+        tag_values = []
+        for e in entities:
+            for k, v in e.tags.iteritems():
+                tag_keys.append(strings(k))
+                if isinstance(v, basestring):
+                    tag_types.append(TAG_STRING)
+                    tag_values.append(strings(v))
+                elif isinstance(v, (int, long)) and abs(v) <= MAX_INT_TAG:
+                    tag_types.append(TAG_INT)
+                    tag_values.append(v)
+                elif isinstance(v, float):
+                    tag_types.append(TAG_NUMBER)
+                    tag_values.append(v)
+                elif isinstance(v, datetime.time):
+                    tag_types.append(TAG_TIME)
+                    tag_values.append(v.hour * 3600 + v.minute * 60 + v.second + v.microsecond * 1e-6)
+                else:
+                    raise TypeError("Cannot cache tag value %r of type %s" % (v, type(v)))
+        arrs[name + '_tag_key'] = np.array(tag_keys, dtype=np.int32)
+        arrs[name + '_tag_type'] = np.array(tag_types, dtype=np.int8)
+        arrs[name + '_tag_value'] = np.array(tag_values, dtype=float)
+        arrs[name + '_tag_offsets'] = np.cumsum([0] + [len(e.tags) for e in entities])
+
+    arrs['strings'] = strings.encode()
+    return arrs
+
+
+def decode_tag(tag_type, value, strings):
+    if tag_type == TAG_STRING:
+        return strings[int(value)]
+    elif tag_type == TAG_NUMBER:
+        return value
+    elif tag_type == TAG_INT:
+        return int(value)
+    seconds, microseconds = divmod(int(round(value * 1e6)), 1000000)
+    return datetime.time(seconds // 3600, (seconds // 60) % 60, seconds % 60, microseconds)
+
+
+def decode(arrs, schema):
+    """
+    Rebuild the entity dictionaries from the output of encode().
+    :return: Dictionary of store name: {fid: entity}
+    """
+    strings = StringTable.decode(arrs['strings'])
+    stores = {}
+
+    for name, cls, geom_attr, kind in schema:
+        fids = [strings[i] for i in arrs[name + '_fid'].tolist()]
+        n = len(fids)
+
+        if kind == 'point':
+            geoms = [None if x != x else (x, y) for x, y in arrs[name + '_geom'].tolist()]
+        elif kind == 'coords':
+            geoms = np.split(arrs[name + '_geom'].copy(), arrs[name + '_offsets'][1:-1]) if n else []
+        elif kind == 'string':
+            geoms = [strings[i] if i >= 0 else None for i in arrs[name + '_geom'].tolist()]
+        elif kind in ('strings', 'mapping'):
+            idx = arrs[name + '_geom'].tolist()
+            offsets = arrs[name + '_offsets'].tolist()
+            if kind == 'strings':
+                values = [strings[i] for i in idx]
+                geoms = [values[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+            else:
+                values = [(strings[i], strings[j]) for i, j in idx]
+                geoms = [dict(values[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+        else:
+            raise ValueError("Unrecognised geometry kind %s" % kind)
+
+        keys = [strings[i] for i in arrs[name + '_tag_key'].tolist()]
+        values = [decode_tag(t, x, strings)
+                  for t, x in zip(arrs[name + '_tag_type'].tolist(), arrs[name + '_tag_value'].tolist())]
+        items = zip(keys, values)
+        offsets = arrs[name + '_tag_offsets'].tolist()
+
+        stores[name] = dict(
+            (fid, cls(fid, geom, dict(items[a:b])))
+            for fid, geom, a, b in zip(fids, geoms, offsets[:-1], offsets[1:])
+        )
+
+    return stores
+
+
+def write_arrays(f, arrs):
+    """
+    Write a dictionary of arrays to an open file: a length-prefixed JSON header giving the name, dtype, shape and
+    offset of each array, followed by the raw array data. Unlike .npz, reading this back needs only one header parse.
+    """
+    header = {}
+    offset = 0
+    for name, arr in sorted(arrs.items()):
+        arr = np.ascontiguousarray(arr)
+        arrs[name] = arr
+        header[name] = (arr.dtype.str, arr.shape, offset)
+        offset += arr.nbytes
+    header = json.dumps(header)
+    f.write(struct.pack('<q', len(header)))
+    f.write(header)
+    for name, arr in sorted(arrs.items()):
+        f.write(arr.tostring())
+
+
+def read_arrays(f):
+    n = struct.unpack('<q', f.read(8))[0]
+    header = json.loads(f.read(n))
+    buf = f.read()
+    arrs = {}
+    for name, (dtype, shape, offset) in header.iteritems():
+        dtype = np.dtype(str(dtype))
+        count = int(np.prod(shape))
+        arrs[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape)
+    return arrs
+
+
+def load(cache_dir, key, schema):
+    """
+    :return: Dictionary of store name: {fid: entity}, or None if there is no cache entry.
+    """
+    fn = cache_path(cache_dir, key)
+    if not os.path.isfile(fn):
+        return None
+    with open(fn, 'rb') as f:
+        return decode(read_arrays(f), schema)
+
+
+def save(cache_dir, key, schema, stores):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file and rename, so that concurrent readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_arrays(f, encode(stores, schema))
+        os.rename(tmp, cache_path(cache_dir, key))
+    except:
+        os.remove(tmp)
+        raise
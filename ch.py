@@ -0,0 +1,298 @@
+__author__ = 'gabriel'
+"""
+Contraction hierarchies, for answering many shortest path queries on a network that does not change.
+
+Preprocessing contracts the nodes one at a time, least important first. When a node is removed, a shortcut arc is
+added between each pair of its remaining neighbours whose shortest route ran through it, unless a local "witness"
+search finds a route that is no longer. The order of contraction gives each node a rank. Any shortest route can then
+be found by searching only upwards in rank: forwards from the start and backwards from the end, until the two
+searches meet. These upward searches settle very few nodes, however large the network.
+
+Arcs are directed; an undirected network is supplied with each edge in both directions. Where there are parallel
+edges only the shortest is kept. A shortcut remembers the two arcs it replaces, so a route can be unpacked back to
+the original edges.
+
+The hierarchy refers to nodes by ID and edges by FID, so it does not depend on the backend used by StreetNet.
+"""
+import heapq
+import numpy as np
+
+
+class ContractionHierarchy(object):
+
+    def __init__(self, node_ids, rank, arc_nodes, arc_weight, arc_fid, arc_children):
+        """
+        :param node_ids: List of node IDs. Nodes are referred to by their index in this list.
+        :param rank: Length N array giving the order in which the nodes were contracted.
+        :param arc_nodes: (A, 2) integer array giving the start and end node of each arc.
+        :param arc_weight: Length A array of arc lengths.
+        :param arc_fid: List of edge FIDs, length A, with None for shortcuts.
+        :param arc_children: (A, 2) integer array giving the two arcs replaced by each shortcut, or -1.
+        """
+        self.node_ids = list(node_ids)
+        self.rank = np.asarray(rank)
+        self.arc_nodes = np.asarray(arc_nodes)
+        self.arc_weight = np.asarray(arc_weight, dtype=float)
+        self.arc_fid = list(arc_fid)
+        self.arc_children = np.asarray(arc_children)
+        self.build_search_graph()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the search graph is rebuilt when loading
+        for k in ('node_index', 'up', 'down'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_search_graph()
+
+    def build_search_graph(self):
+        """
+        Build the upward adjacency lists used by query(). up[i] lists (node, arc, length) for the arcs leaving node i
+        for a higher ranked node; down[i] lists the arcs arriving at node i from a higher ranked node, as
+        (node, arc, length) with the arc followed backwards.
+        """
+        self.node_index = dict((t, i) for i, t in enumerate(self.node_ids))
+        n = len(self.node_ids)
+        self.up = [[] for _ in xrange(n)]
+        self.down = [[] for _ in xrange(n)]
+        rank = self.rank.tolist()
+        for a, ((u, w), length) in enumerate(zip(self.arc_nodes.tolist(), self.arc_weight.tolist())):
+            if rank[w] > rank[u]:
+                self.up[u].append((w, a, length))
+            else:
+                self.down[w].append((u, a, length))
+
+    @classmethod
+    def build(cls, node_ids, arcs, witness_limit=100):
+        """
+        Contract a network.
+        :param node_ids: Iterable of node IDs.
+        :param arcs: Iterable of (from node ID, to node ID, FID, length). Undirected edges should be given in both
+        directions.
+        :param witness_limit: The maximum number of nodes settled by each witness search. Stopping early only adds
+        unnecessary shortcuts, so the hierarchy stays correct.
+        """
+        node_ids = list(node_ids)
+        index = dict((t, i) for i, t in enumerate(node_ids))
+        n = len(node_ids)
+
+        arc_nodes = []
+        arc_weight = []
+        arc_fid = []
+        arc_children = []
+        # best arc between each pair of nodes, by start node and by end node
+        out_arcs = [{} for _ in xrange(n)]
+        in_arcs = [{} for _ in xrange(n)]
+
+        def add_arc(u, w, length, fid=None, children=(-1, -1)):
+            if u == w:
+                return
+            a = out_arcs[u].get(w)
+            if a is not None and arc_weight[a] <= length:
+                return
+            a = len(arc_weight)
+            arc_nodes.append((u, w))
+            arc_weight.append(length)
+            arc_fid.append(fid)
+            arc_children.append(children)
+            out_arcs[u][w] = a
+            in_arcs[w][u] = a
+
+        for u, w, fid, length in arcs:
+            add_arc(index[u], index[w], length, fid=fid)
+
+        contracted = [False] * n
+        n_deleted = [0] * n
+
+        def witness(u, v, limit):
+            # tentative distances from u avoiding v; each is the length of a real route, so can act as a witness
+            dist = {u: 0.}
+            done = set()
+            heap = [(0., u)]
+            while heap and len(done) < witness_limit:
+                d, x = heapq.heappop(heap)
+                if x in done:
+                    continue
+                if d > limit:
+                    break
+                done.add(x)
+                for y, a in out_arcs[x].iteritems():
+                    if y == v or contracted[y]:
+                        continue
+                    dy = d + arc_weight[a]
+                    if dy < dist.get(y, np.inf):
+                        dist[y] = dy
+                        heapq.heappush(heap, (dy, y))
+            return dist
+
+        def shortcuts(v):
+            # the shortcuts needed to contract v, and the number of arcs removed by doing so
+            ins = [(u, a) for u, a in in_arcs[v].iteritems() if not contracted[u]]
+            outs = [(w, a) for w, a in out_arcs[v].iteritems() if not contracted[w]]
+            res = []
+            for u, au in ins:
+                via = [(w, aw, arc_weight[au] + arc_weight[aw]) for w, aw in outs if w != u]
+                if not via:
+                    continue
+                dist = witness(u, v, max(t[2] for t in via))
+                for w, aw, length in via:
+                    if dist.get(w, np.inf) > length:
+                        res.append((u, w, length, (au, aw)))
+            return res, len(ins) + len(outs)
+
+        def priority(v):
+            s, removed = shortcuts(v)
+            return len(s) - removed + n_deleted[v]
+
+        heap = [(priority(v), v) for v in xrange(n)]
+        heapq.heapify(heap)
+        rank = np.zeros(n, dtype=np.int32)
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            if contracted[v]:
+                continue
+            # lazy update: the priority may have changed since v was queued
+            p = priority(v)
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, v))
+                continue
+            s, _ = shortcuts(v)
+            contracted[v] = True
+            rank[v] = order
+            order += 1
+            for u in set(in_arcs[v]).union(out_arcs[v]):
+                n_deleted[u] += 1
+            for u, w, length, children in s:
+                add_arc(u, w, length, children=children)
+
+        # keep only the arcs that are still the best between their nodes; shortcuts only ever refer to these
+        keep = sorted(set(a for x in out_arcs for a in x.itervalues()))
+        new_id = dict((a, i) for i, a in enumerate(keep))
+        new_id[-1] = -1
+        return cls(
+            node_ids,
+            rank,
+            np.array([arc_nodes[a] for a in keep], dtype=np.int32).reshape(-1, 2),
+            np.array([arc_weight[a] for a in keep], dtype=float),
+            [arc_fid[a] for a in keep],
+            np.array([(new_id[arc_children[a][0]], new_id[arc_children[a][1]]) for a in keep],
+                     dtype=np.int32).reshape(-1, 2),
+        )
+
+    @property
+    def n_shortcuts(self):
+        return sum(1 for t in self.arc_fid if t is None)
+
+    def unpack(self, arcs):
+        """
+        Expand a sequence of arcs into the original edges.
+        :return: List of (from node ID, to node ID, FID, length)
+        """
+        res = []
+        stack = list(reversed(arcs))
+        while stack:
+            a = stack.pop()
+            first, second = self.arc_children[a].tolist()
+            if first < 0:
+                u, w = self.arc_nodes[a].tolist()
+                res.append((self.node_ids[u], self.node_ids[w], self.arc_fid[a], self.arc_weight.item(a)))
+            else:
+                stack.append(second)
+                stack.append(first)
+        return res
+
+    def query(self, sources, targets, cutoff=None):
+        """
+        Shortest route from any of the seeds to any of the targets, as routing.shortest_path.
+        :param sources: Dictionary of node ID: initial distance.
+        :param targets: Dictionary of node ID: final distance.
+        :param cutoff: Optional. Routes longer than this are not searched for.
+        :return: (distance, nodes, fids, lengths) or None if no target can be reached (within cutoff). nodes lists the node IDs
+        along the route and fids and lengths the edges between them.
+        """
+        # side 0 searches up from the sources and side 1 up from the targets (following arcs backwards)
+        graphs = (self.up, self.down)
+        seen = ({}, {})
+        pred = ({}, {})
+        heaps = ([], [])
+        for side, init in enumerate((sources, targets)):
+            for k, d in init.iteritems():
+                v = self.node_index[k]
+                if d < seen[side].get(v, np.inf):
+                    seen[side][v] = d
+                    pred[side][v] = None
+                    heapq.heappush(heaps[side], (d, v))
+
+        done = (set(), set())
+        # a route must be strictly shorter than best to replace it
+        best = np.inf if cutoff is None else np.nextafter(cutoff, np.inf)
+        meet = None
+        while heaps[0] or heaps[1]:
+            # advance whichever search is behind; both can stop once neither can improve on the best route
+            side = 0 if heaps[0] and (not heaps[1] or heaps[0][0] <= heaps[1][0]) else 1
+            d, v = heapq.heappop(heaps[side])
+            if d >= best:
+                break
+            if v in done[side]:
+                continue
+            done[side].add(v)
+            if v in seen[1 - side] and d + seen[1 - side][v] < best:
+                best = d + seen[1 - side][v]
+                meet = v
+            for w, a, length in graphs[side][v]:
+                dw = d + length
+                if dw < seen[side].get(w, np.inf):
+                    seen[side][w] = dw
+                    pred[side][w] = (v, a)
+                    heapq.heappush(heaps[side], (dw, w))
+        if meet is None:
+            return None
+
+        arcs = []
+        v = meet
+        while pred[0][v] is not None:
+            v, a = pred[0][v]
+            arcs.append(a)
+        start = v
+        arcs.reverse()
+        v = meet
+        while pred[1][v] is not None:
+            v, a = pred[1][v]
+            arcs.append(a)
+
+        edges = self.unpack(arcs)
+        nodes = [self.node_ids[start]] + [t[1] for t in edges]
+        return best, nodes, [t[2] for t in edges], [t[3] for t in edges]
+
+    def to_arrays(self, node_map, edge_map):
+        """
+        Encode as arrays, for saving (see snapshot.write).
+        :param node_map, edge_map: Functions mapping node IDs and FIDs to integers.
+        """
+        return {
+            'nodes': np.array([node_map(t) for t in self.node_ids], dtype=np.int32),
+            'rank': self.rank,
+            'arc_nodes': self.arc_nodes,
+            'arc_weight': self.arc_weight,
+            'arc_edge': np.array([-1 if t is None else edge_map(t) for t in self.arc_fid], dtype=np.int32),
+            'arc_children': self.arc_children,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrs, node_ids, edge_fids):
+        """
+        Inverse of to_arrays().
+        :param node_ids, edge_fids: Lists mapping the integers back to node IDs and FIDs.
+        """
+        return cls(
+            [node_ids[i] for i in arrs['nodes'].tolist()],
+            arrs['rank'],
+            arrs['arc_nodes'],
+            arrs['arc_weight'],
+            [None if i < 0 else edge_fids[i] for i in arrs['arc_edge'].tolist()],
+            arrs['arc_children'],
+        )
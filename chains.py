@@ -0,0 +1,322 @@
+__author__ = 'gabriel'
+"""
+Degree-2 chain contraction, for searching a smaller graph.
+
+Many nodes in a street network only join two edges: ITN, for example, splits a street wherever its attributes change,
+so these nodes are just breakpoints in the geometry. A route can never turn at such a node, so each maximal run of
+edges through them (a chain) can be replaced by a single super-edge between the junctions at its ends, remembering
+the member edges and their cumulative lengths. Searches then run between junctions only, and the route is expanded
+back to the original edges afterwards.
+
+For directed routing, a chain only continues through a node if travel is allowed in the same directions on both of its
+edges, so every chain can be travelled either in both directions or in one direction along its whole length. Nodes
+where the direction of travel changes are treated as junctions.
+
+Points inside a chain (at an interior node, or on one of its edges) join the search at the junctions at either end of
+their chain, or reach each other directly along it.
+
+The overlay refers to nodes by ID and edges by FID, so it does not depend on the backend used by StreetNet.
+"""
+from collections import defaultdict
+
+import routing
+
+
+class ChainOverlay(object):
+
+    def __init__(self, chains, edge_ends):
+        """
+        :param chains: List of (nodes, fids, lengths, forward, backward). nodes lists the node IDs along the chain,
+        from one junction to the other, and fids and lengths the edges between them. forward and backward are True if
+        the chain may be travelled from its first node to its last and from its last node to its first.
+        :param edge_ends: Dictionary of FID: (neg node ID, pos node ID) for every edge in the chains.
+        """
+        self.chains = chains
+        self.edge_ends = edge_ends
+        self.build_search_graph()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the search graph is rebuilt when loading
+        for k in ('offsets', 'position', 'out_arcs', 'in_arcs'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_search_graph()
+
+    @classmethod
+    def build(cls, edges):
+        """
+        Find the chains of a network.
+        :param edges: Iterable of (neg node ID, pos node ID, FID, length, forward, backward), where forward and
+        backward are True if travel is allowed from neg to pos and from pos to neg. For an undirected network, both
+        are always True.
+        """
+        edges = list(edges)
+        incident = defaultdict(list)
+        for k, (u, v, _, _, _, _) in enumerate(edges):
+            incident[u].append(k)
+            incident[v].append(k)
+
+        def allows(k, x, y):
+            u, v, _, _, fwd, bwd = edges[k]
+            return fwd if (x, y) == (u, v) else bwd
+
+        def other_end(k, x):
+            u, v = edges[k][:2]
+            return v if x == u else u
+
+        def continues(x):
+            # True if x joins exactly two distinct edges (neither a loop), with the same directions of travel
+            ks = incident[x]
+            if len(ks) != 2 or ks[0] == ks[1] or any(edges[k][0] == edges[k][1] for k in ks):
+                return False
+            p, q = other_end(ks[0], x), other_end(ks[1], x)
+            return allows(ks[0], p, x) == allows(ks[1], x, q) and allows(ks[0], x, p) == allows(ks[1], q, x)
+
+        interior = set(x for x in incident if continues(x))
+        used = [False] * len(edges)
+        chains = []
+
+        def walk(start, k):
+            nodes = [start]
+            fids = []
+            lengths = []
+            fwd = bwd = True
+            x = start
+            while True:
+                used[k] = True
+                y = other_end(k, x)
+                fwd = fwd and allows(k, x, y)
+                bwd = bwd and allows(k, y, x)
+                nodes.append(y)
+                fids.append(edges[k][2])
+                lengths.append(edges[k][3])
+                if y not in interior or y == start:
+                    break
+                a, b = incident[y]
+                k = b if a == k else a
+                x = y
+            chains.append((nodes, fids, lengths, fwd, bwd))
+
+        for x, ks in incident.iteritems():
+            if x not in interior:
+                for k in ks:
+                    if not used[k]:
+                        walk(x, k)
+        # anything left forms closed loops with no junction, so one node of each becomes a junction
+        for x, ks in incident.iteritems():
+            for k in ks:
+                if not used[k]:
+                    interior.discard(x)
+                    walk(x, k)
+
+        return cls(chains, dict((fid, (u, v)) for u, v, fid, _, _, _ in edges))
+
+    def build_search_graph(self):
+        """
+        Compute the cumulative lengths along each chain, the position of every interior node, and the adjacency of
+        the junctions. out_arcs[a] lists (junction, arc, length) for the chains that may be travelled away from
+        junction a, and in_arcs[a] those that may be travelled towards it. Each arc is (chain index, True if
+        travelled from its first node to its last). Only the shortest chain between two junctions is kept.
+        """
+        self.offsets = []
+        self.position = {}
+        best = {}
+        for c, (nodes, _, lengths, fwd, bwd) in enumerate(self.chains):
+            cum = [0.]
+            for length in lengths:
+                cum.append(cum[-1] + length)
+            self.offsets.append(cum)
+            for i in xrange(1, len(nodes) - 1):
+                self.position[nodes[i]] = (c, i)
+            a, b = nodes[0], nodes[-1]
+            for ok, key, arc in ((fwd, (a, b), (c, True)), (bwd, (b, a), (c, False))):
+                if ok and (key not in best or cum[-1] < best[key][1]):
+                    best[key] = (arc, cum[-1])
+        self.out_arcs = {}
+        self.in_arcs = {}
+        for (a, b), (arc, length) in best.iteritems():
+            self.out_arcs.setdefault(a, []).append((b, arc, length))
+            self.in_arcs.setdefault(b, []).append((a, arc, length))
+
+    @property
+    def n_junctions(self):
+        return len(set(self.out_arcs).union(self.in_arcs))
+
+    def neighbours(self, a):
+        return self.out_arcs.get(a, ())
+
+    def reverse_neighbours(self, a):
+        return self.in_arcs.get(a, ())
+
+    def expand(self, arc):
+        """
+        :return: (nodes, fids, lengths) of the original edges along a chain, in the direction travelled.
+        """
+        c, forward = arc
+        nodes, fids, lengths, _, _ = self.chains[c]
+        if forward:
+            return nodes, fids, lengths
+        return nodes[::-1], fids[::-1], lengths[::-1]
+
+    def exits(self, x):
+        """
+        The routes from a node to the junctions at the ends of its chain.
+        :return: List of (junction, distance, (nodes, fids, lengths)).
+        """
+        if x not in self.position:
+            return [(x, 0., ([x], [], []))]
+        c, i = self.position[x]
+        nodes, fids, lengths, fwd, bwd = self.chains[c]
+        cum = self.offsets[c]
+        res = []
+        if bwd:
+            res.append((nodes[0], cum[i], (nodes[i::-1], fids[i - 1::-1], lengths[i - 1::-1])))
+        if fwd:
+            res.append((nodes[-1], cum[-1] - cum[i], (nodes[i:], fids[i:], lengths[i:])))
+        return res
+
+    def entries(self, y):
+        """
+        The routes to a node from the junctions at the ends of its chain.
+        :return: List of (junction, distance, (nodes, fids, lengths)).
+        """
+        if y not in self.position:
+            return [(y, 0., ([y], [], []))]
+        c, i = self.position[y]
+        nodes, fids, lengths, fwd, bwd = self.chains[c]
+        cum = self.offsets[c]
+        res = []
+        if fwd:
+            res.append((nodes[0], cum[i], (nodes[:i + 1], fids[:i], lengths[:i])))
+        if bwd:
+            res.append((nodes[-1], cum[-1] - cum[i], (nodes[:i - 1:-1], fids[:i - 1:-1], lengths[:i - 1:-1])))
+        return res
+
+    def within(self, x, y):
+        """
+        The route from x to y along their chain, if both are interior nodes of the same chain.
+        :return: (distance, (nodes, fids, lengths)) or None.
+        """
+        if x not in self.position or y not in self.position:
+            return None
+        (c, i), (c2, j) = self.position[x], self.position[y]
+        if c != c2:
+            return None
+        nodes, fids, lengths, fwd, bwd = self.chains[c]
+        cum = self.offsets[c]
+        if i <= j and fwd or i == j:
+            return cum[j] - cum[i], (nodes[i:j + 1], fids[i:j], lengths[i:j])
+        if i > j and bwd:
+            # interior nodes are never first in their chain, so j - 1 >= 0
+            return cum[i] - cum[j], (nodes[i:j - 1:-1], fids[i - 1:j - 1:-1], lengths[i - 1:j - 1:-1])
+        return None
+
+    @staticmethod
+    def dominated(piece, start, finish, sources, targets):
+        """
+        True if a route along piece passes another seed or target that gives a route at least as short. This happens
+        when a point lies on a node: the route from the node along the point's own edge costs exactly as much as the
+        route from the other end of that edge, and only the latter gives the expected path.
+        :param piece: (nodes, fids, lengths) of the route.
+        :param start: Distance before the first node.
+        :param finish: Distance after the last node.
+        """
+        nodes, _, lengths = piece
+        cum = [0.]
+        for length in lengths:
+            cum.append(cum[-1] + length)
+        for k in xrange(1, len(nodes)):
+            if nodes[k] in sources and sources[nodes[k]] <= start + cum[k]:
+                return True
+        for k in xrange(len(nodes) - 1):
+            if nodes[k] in targets and cum[k] + targets[nodes[k]] <= cum[-1] + finish:
+                return True
+        return False
+
+    def query(self, sources, targets, cutoff=None, bidirectional=False):
+        """
+        Shortest route from any of the seeds to any of the targets, as routing.shortest_path.
+        :param sources: Dictionary of node ID: initial distance.
+        :param targets: Dictionary of node ID: final distance.
+        :param cutoff: Optional. Routes longer than this are not searched for.
+        :param bidirectional: If True, use routing.bidirectional_shortest_path rather than Dijkstra's algorithm.
+        :return: (distance, nodes, fids, lengths) or None if no target can be reached (within cutoff). nodes lists
+        the node IDs along the route and fids and lengths the original edges between them.
+        """
+        # the seeds and targets move to the junctions at the ends of their chains, remembering how they got there
+        seeds = {}
+        first = {}
+        for x, d in sources.iteritems():
+            for a, dist, piece in self.exits(x):
+                if self.dominated(piece, d, 0., sources, targets):
+                    continue
+                if d + dist < seeds.get(a, float('inf')):
+                    seeds[a] = d + dist
+                    first[a] = piece
+        finals = {}
+        last = {}
+        for y, d in targets.iteritems():
+            for b, dist, piece in self.entries(y):
+                if self.dominated(piece, 0., d, sources, targets):
+                    continue
+                if d + dist < finals.get(b, float('inf')):
+                    finals[b] = d + dist
+                    last[b] = piece
+
+        best = None
+        if bidirectional:
+            res = routing.bidirectional_shortest_path(self.neighbours, self.reverse_neighbours, seeds, finals,
+                                                      cutoff=cutoff)
+        else:
+            res = routing.shortest_path(self.neighbours, seeds, finals, cutoff=cutoff)
+        if res is not None:
+            total, junctions, arcs, _ = res
+            nodes, fids, lengths = [list(t) for t in first[junctions[0]]]
+            for arc in arcs:
+                n, f, l = self.expand(arc)
+                nodes.extend(n[1:])
+                fids.extend(f)
+                lengths.extend(l)
+            n, f, l = last[junctions[-1]]
+            nodes.extend(n[1:])
+            fids.extend(f)
+            lengths.extend(l)
+            best = (total, nodes, fids, lengths)
+
+        # routes that stay inside one chain never reach a junction
+        for x, d in sources.iteritems():
+            for y, t in targets.iteritems():
+                res = self.within(x, y)
+                if res is None or self.dominated(res[1], d, t, sources, targets):
+                    continue
+                total = d + res[0] + t
+                if (best is None or total < best[0]) and (cutoff is None or total <= cutoff):
+                    best = (total,) + tuple(list(p) for p in res[1])
+        return best
+
+    def next_edge(self, x, fid, directed):
+        """
+        The edge by which a walk continues through an interior node.
+        :param x: Node ID.
+        :param fid: The edge by which the node was reached.
+        :param directed: If True, only continue in an allowed direction.
+        :return: List of (neg node ID, pos node ID, FID), empty if the walk cannot continue, or None if x is a
+        junction or fid is not one of its edges.
+        """
+        if x not in self.position:
+            return None
+        c, i = self.position[x]
+        nodes, fids, _, fwd, bwd = self.chains[c]
+        if fid == fids[i - 1]:
+            nxt, ok = fids[i], fwd
+        elif fid == fids[i]:
+            nxt, ok = fids[i - 1], bwd
+        else:
+            return None
+        if directed and not ok:
+            return []
+        return [self.edge_ends[nxt] + (nxt,)]
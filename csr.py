@@ -0,0 +1,321 @@
+__author__ = 'gabriel'
+"""
+Compact, array-backed representation of a street network, used as an alternative backend to networkx by StreetNet
+(see StreetNet.set_backend).
+
+Nodes and edges are numbered 0..N-1 and 0..E-1. Everything else is held in flat arrays indexed by those numbers:
+node coordinates, edge endpoints, lengths, one-way flags, all polyline vertices in one shared buffer with per-edge
+offsets, and one column per additional edge attribute. Adjacency is stored in compressed sparse row (CSR) form,
+once for the undirected physical network and twice for the directed routing network (forwards and reversed):
+
+    indptr[i]:indptr[i + 1]     the slice of the adjacency arrays belonging to node i
+    indices[k]                  the neighbouring node
+    edge_ids[k]                 the edge leading to it
+
+Searches use a collapsed copy of each adjacency, keeping only the shortest of any parallel edges between a pair of
+nodes (in each direction), so that they do not consider edges that can never be part of a shortest route. Where a
+network has no parallel edges the full adjacency is used as it is.
+
+The adjacency arrays are held as array.array rather than numpy arrays, because they are sliced once per node visited
+during a search and slicing a numpy array is comparatively slow; adjacency() gives numpy views of them for
+vectorised use. The original node IDs and edge FIDs are kept in lists, with dictionaries for the reverse lookup.
+
+The other arrays are exactly those of the snapshot format (see snapshot.py), so a CSRGraph can be created directly
+from memory-mapped snapshot files without building a networkx graph.
+"""
+import array
+import numpy as np
+import networkx as nx
+from shapely.geometry import LineString
+
+import snapshot
+
+
+def to_array(arr, typecode):
+    dtype = np.float64 if typecode == 'd' else np.int32
+    return array.array(typecode, np.ascontiguousarray(arr, dtype=dtype).tostring())
+
+
+def build_adjacency(n_nodes, src, dst, edge_ids, edge_length):
+    """
+    Sort (src, dst, edge_id) triples into CSR form.
+    :return: (indptr, indices, edge_ids, lengths), all array.array. lengths holds the edge lengths in adjacency order.
+    """
+    order = np.argsort(src, kind='mergesort')
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n_nodes))))
+    return (
+        to_array(indptr, 'i'),
+        to_array(dst[order], 'i'),
+        to_array(edge_ids[order], 'i'),
+        to_array(np.asarray(edge_length)[edge_ids[order]], 'd'),
+    )
+
+
+def collapse_adjacency(n_nodes, indptr, indices, edge_ids, lengths):
+    """
+    Keep only the shortest edge from each node to each neighbour, preserving the order of the others.
+    :return: (indptr, indices, edge_ids, lengths), the arrays given if nothing is removed.
+    """
+    if not len(indices):
+        return indptr, indices, edge_ids, lengths
+    arrs = [np.frombuffer(t, dtype=np.float64 if t.typecode == 'd' else np.int32)
+            for t in (indptr, indices, edge_ids, lengths)]
+    rows = np.repeat(np.arange(n_nodes), np.diff(arrs[0]))
+    order = np.lexsort((arrs[3], arrs[1], rows))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = (rows[order][1:] != rows[order][:-1]) | (arrs[1][order][1:] != arrs[1][order][:-1])
+    if first.all():
+        return indptr, indices, edge_ids, lengths
+    keep = np.sort(order[first])
+    return (
+        to_array(np.concatenate(([0], np.cumsum(np.bincount(rows[keep], minlength=n_nodes)))), 'i'),
+        to_array(arrs[1][keep], 'i'),
+        to_array(arrs[2][keep], 'i'),
+        to_array(arrs[3][keep], 'd'),
+    )
+
+
+class CSRGraph(object):
+
+    def __init__(self, node_ids, node_loc, edge_fids, edge_nodes, edge_length, edge_oneway,
+                 edge_coords, edge_coord_offsets, columns=None,
+                 edge_id_key='fid', node0_key='orientation_neg', node1_key='orientation_pos'):
+        """
+        :param node_ids: List of node IDs, length N
+        :param node_loc: (N, 2) array of node coordinates
+        :param edge_fids: List of edge IDs, length E. These must be unique.
+        :param edge_nodes: (E, 2) integer array giving the neg and pos node of each edge
+        :param edge_length: Length E array
+        :param edge_oneway: Length E array. 0: two-way, 1: neg -> pos only, -1: pos -> neg only
+        :param edge_coords: (M, 2) array of all polyline vertices
+        :param edge_coord_offsets: Length E + 1 array. The vertices of edge i are edge_coords[offsets[i]:offsets[i + 1]]
+        :param columns: Optional dictionary of attribute name: (kind, array, string table) for the remaining edge
+        attributes, as in the snapshot format.
+        :param edge_id_key, node0_key, node1_key: The attribute names used for the edge ID and nodes by the
+        StreetNet class.
+        """
+        self.node_ids = node_ids
+        self.node_index = dict((t, i) for i, t in enumerate(node_ids))
+        self.node_loc = node_loc
+        self.edge_fids = edge_fids
+        self.edge_index = dict((t, i) for i, t in enumerate(edge_fids))
+        if len(self.edge_index) != len(edge_fids):
+            raise ValueError("Edge IDs must be unique to use the CSR backend")
+        self.edge_nodes = edge_nodes
+        self.edge_length = edge_length
+        self.edge_oneway = edge_oneway
+        self.edge_coords = edge_coords
+        self.edge_coord_offsets = edge_coord_offsets
+        self.columns = columns or {}
+        self.edge_id_key = edge_id_key
+        self.node0_key = node0_key
+        self.node1_key = node1_key
+
+        n = len(node_ids)
+        eids = np.arange(len(edge_fids), dtype=np.int32)
+        u = np.asarray(edge_nodes[:, 0], dtype=np.int64)
+        v = np.asarray(edge_nodes[:, 1], dtype=np.int64)
+        loop = u == v
+
+        # undirected: each edge is listed at both ends, apart from self-loops which are listed once (as in networkx)
+        self.indptr, self.indices, self.edge_ids, self.lengths = build_adjacency(
+            n,
+            np.concatenate((u, v[~loop])),
+            np.concatenate((v, u[~loop])),
+            np.concatenate((eids, eids[~loop])),
+            edge_length,
+        )
+        # number of self-loops at each node, which count twice towards the degree
+        self.loops = np.bincount(u[loop], minlength=n)
+
+        # directed routing network
+        oneway = np.asarray(edge_oneway)
+        fwd = oneway >= 0
+        bwd = (oneway <= 0) & ~loop
+        self.out_indptr, self.out_indices, self.out_edge_ids, self.out_lengths = build_adjacency(
+            n,
+            np.concatenate((u[fwd], v[bwd])),
+            np.concatenate((v[fwd], u[bwd])),
+            np.concatenate((eids[fwd], eids[bwd])),
+            edge_length,
+        )
+        # and the same network with every arc reversed, for searches that work backwards from a destination
+        self.in_indptr, self.in_indices, self.in_edge_ids, self.in_lengths = build_adjacency(
+            n,
+            np.concatenate((v[fwd], u[bwd])),
+            np.concatenate((u[fwd], v[bwd])),
+            np.concatenate((eids[fwd], eids[bwd])),
+            edge_length,
+        )
+
+        # collapsed adjacency for searches, by (directed, reverse)
+        self.routing_adjacency = {
+            (False, False): collapse_adjacency(n, self.indptr, self.indices, self.edge_ids, self.lengths),
+            (True, False): collapse_adjacency(n, self.out_indptr, self.out_indices, self.out_edge_ids,
+                                              self.out_lengths),
+            (True, True): collapse_adjacency(n, self.in_indptr, self.in_indices, self.in_edge_ids, self.in_lengths),
+        }
+
+    @classmethod
+    def from_arrays(cls, meta, arrs, **kwargs):
+        """
+        Build from the output of snapshot.read() or snapshot.to_arrays(). The arrays are used as they are, so
+        memory-mapped arrays stay memory-mapped.
+        """
+        columns = {}
+        for name, kind in meta['columns'].items():
+            table = None
+            if kind == 'string':
+                table = snapshot.decode_strings(arrs['attr_%s_strings' % name],
+                                                arrs['attr_%s_string_offsets' % name])
+            columns[name] = (kind, arrs['attr_' + name], table)
+        return cls(
+            snapshot.decode_strings(arrs['node_ids'], arrs['node_id_offsets']),
+            arrs['node_loc'],
+            snapshot.decode_strings(arrs['edge_fids'], arrs['edge_fid_offsets']),
+            arrs['edge_nodes'],
+            arrs['edge_length'],
+            arrs['edge_oneway'],
+            arrs['edge_coords'],
+            arrs['edge_coord_offsets'],
+            columns=columns,
+            **kwargs
+        )
+
+    @classmethod
+    def from_streetnet(cls, net):
+        meta, arrs = snapshot.to_arrays(net)
+        obj = cls.from_arrays(meta, arrs,
+                              edge_id_key=net.EDGE_ID_KEY, node0_key=net.NODE0_KEY, node1_key=net.NODE1_KEY)
+        # keep the IDs used by the network (to_arrays stores the original IDs as text)
+        obj.relabel(net.g.nodes(), [attr[net.EDGE_ID_KEY] for _, _, attr in net.g.edges(data=True)])
+        return obj
+
+    def relabel(self, node_ids, edge_fids):
+        """
+        Replace the node and edge IDs. The new lists must be in the same order as the old.
+        """
+        self.node_ids = node_ids
+        self.node_index = dict((t, i) for i, t in enumerate(node_ids))
+        self.edge_fids = edge_fids
+        self.edge_index = dict((t, i) for i, t in enumerate(edge_fids))
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_fids)
+
+    def degree(self, i):
+        return int(self.indptr[i + 1] - self.indptr[i] + self.loops[i])
+
+    def neighbours(self, i, directed=False, reverse=False):
+        """
+        :return: List of (node, edge, length) tuples for the edges leaving node i. In the directed case, only those
+        edges along which travel is allowed are included. If reverse is True, list the edges arriving at node i
+        instead (in the directed case), giving the node at their other end.
+        """
+        if directed and reverse:
+            a, b = self.in_indptr[i], self.in_indptr[i + 1]
+            return zip(self.in_indices[a:b], self.in_edge_ids[a:b], self.in_lengths[a:b])
+        if directed:
+            a, b = self.out_indptr[i], self.out_indptr[i + 1]
+            return zip(self.out_indices[a:b], self.out_edge_ids[a:b], self.out_lengths[a:b])
+        a, b = self.indptr[i], self.indptr[i + 1]
+        return zip(self.indices[a:b], self.edge_ids[a:b], self.lengths[a:b])
+
+    def routing_neighbours(self, i, directed=False, reverse=False):
+        """
+        As neighbours(), but giving only the shortest of any parallel edges to each neighbour.
+        """
+        indptr, indices, edge_ids, lengths = self.routing_adjacency[(directed, directed and reverse)]
+        a, b = indptr[i], indptr[i + 1]
+        return zip(indices[a:b], edge_ids[a:b], lengths[a:b])
+
+    def adjacency(self, directed=False):
+        """
+        :return: (indptr, indices, edge_ids, lengths) as numpy arrays, sharing memory with the adjacency arrays.
+        """
+        if directed:
+            arrs = (self.out_indptr, self.out_indices, self.out_edge_ids, self.out_lengths)
+        else:
+            arrs = (self.indptr, self.indices, self.edge_ids, self.lengths)
+        return tuple(np.frombuffer(t, dtype=np.float64 if t.typecode == 'd' else np.int32) for t in arrs)
+
+    def allows(self, e, i, j):
+        """
+        True if travel from node i to node j along edge e is permitted.
+        """
+        u, v = self.edge_nodes.item(e, 0), self.edge_nodes.item(e, 1)
+        oneway = self.edge_oneway.item(e)
+        if (i, j) == (u, v) and oneway >= 0:
+            return True
+        return (i, j) == (v, u) and oneway <= 0
+
+    def edge_ends(self, e):
+        """
+        :return: (neg node ID, pos node ID, fid)
+        """
+        u, v = self.edge_nodes[e]
+        return self.node_ids[u], self.node_ids[v], self.edge_fids[e]
+
+    def coords(self, e):
+        return self.edge_coords[self.edge_coord_offsets[e]:self.edge_coord_offsets[e + 1]]
+
+    def linestring(self, e):
+        return LineString(np.array(self.coords(e)))
+
+    def edge_attrs(self, e):
+        """
+        Rebuild the attribute dictionary of edge e. This is a new dictionary, so changes to it are not stored.
+        """
+        u, v = self.edge_nodes[e]
+        attrs = {
+            self.edge_id_key: self.edge_fids[e],
+            self.node0_key: self.node_ids[u],
+            self.node1_key: self.node_ids[v],
+            'length': float(self.edge_length[e]),
+            'linestring': self.linestring(e),
+        }
+        for name, (kind, arr, table) in self.columns.iteritems():
+            val = arr[e].item()
+            if kind == 'string':
+                if val >= 0:
+                    attrs[name] = table[val]
+            elif kind == 'bool':
+                if val >= 0:
+                    attrs[name] = bool(val)
+            elif val == val:
+                attrs[name] = val
+        return attrs
+
+    @property
+    def extent(self):
+        if not len(self.edge_coords):
+            return np.inf, np.inf, -np.inf, -np.inf
+        xmin, ymin = np.min(self.edge_coords, axis=0)
+        xmax, ymax = np.max(self.edge_coords, axis=0)
+        return float(xmin), float(ymin), float(xmax), float(ymax)
+
+    def to_networkx(self):
+        """
+        :return: (g, g_routing), the equivalent undirected and directed networkx multigraphs.
+        """
+        g = nx.MultiGraph()
+        g_routing = nx.MultiDiGraph()
+        for v, loc in zip(self.node_ids, self.node_loc.tolist()):
+            g.add_node(v, loc=tuple(loc))
+            g_routing.add_node(v, loc=tuple(loc))
+
+        for e, oneway in enumerate(self.edge_oneway.tolist()):
+            attr = self.edge_attrs(e)
+            u, v, fid = attr[self.node0_key], attr[self.node1_key], self.edge_fids[e]
+            g.add_edge(u, v, key=fid, attr_dict=attr)
+            if oneway >= 0:
+                g_routing.add_edge(u, v, key=fid, attr_dict=attr)
+            if oneway <= 0:
+                g_routing.add_edge(v, u, key=fid, attr_dict=attr)
+
+        return g, g_routing
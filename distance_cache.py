@@ -0,0 +1,82 @@
+__author__ = 'gabriel'
+"""
+Bounded least-recently-used cache of node-to-node network distances (see StreetNet.enable_distance_cache).
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+
+def entry_size(key, value):
+    """
+    Approximate memory used by one cache entry: the key tuple and its members, the value and the dictionary slots.
+    """
+    return sys.getsizeof(key) + sum(sys.getsizeof(t) for t in key) + sys.getsizeof(value) + 100
+
+
+class DistanceCache(object):
+
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        """
+        :param max_bytes: Approximate upper limit on the memory used. The least recently used entries are evicted to
+        stay within it.
+        """
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __getstate__(self):
+        # the entries are not worth saving, and the lock cannot be pickled
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        :return: The cached value, or None. A hit marks the entry as most recently used.
+        """
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = value
+                return
+            self.entries[key] = value
+            self.n_bytes += entry_size(key, value)
+            while self.n_bytes > self.max_bytes and self.entries:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.n_bytes -= entry_size(old_key, old_value)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: Dictionary of hits, misses, hit rate, evictions, entries and approximate size in bytes.
+        """
+        n = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(n) if n else 0.,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.n_bytes,
+        }
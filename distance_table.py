@@ -0,0 +1,159 @@
+__author__ = 'gabriel'
+"""
+Precomputed all-pairs node distances, for networks small enough that an N x N table fits on disk (float32, so 4N^2
+bytes: 1.6GB for 20,000 nodes).
+
+The table is filled by scipy's compiled Dijkstra, one block of source nodes per job, optionally across a process pool.
+It is held in a .npy file that is memory-mapped, so it is shared by every process that opens it and only the rows
+that are used are read. The distance between two NetPoints is then the minimum over the (up to four) combinations of
+the ends of their edges; see StreetNet.build_distance_table.
+
+Distances are stored in single precision, so are accurate to about 1 part in 10^7 (a few millimetres across a city).
+"""
+import os
+import tempfile
+import multiprocessing as mp
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+# the graph and output file used by worker processes, set by _init_worker
+_worker = None
+
+
+def _init_worker(graph, filename):
+    global _worker
+    _worker = (graph, np.load(filename, mmap_mode='r+'))
+
+
+def _fill_rows(rows):
+    # module-level function so that it can be pickled and sent to a worker process
+    graph, dist = _worker
+    fill_rows(graph, dist, rows)
+    return len(rows)
+
+
+def fill_rows(graph, dist, rows):
+    """
+    Compute the distances from a block of consecutive source nodes.
+    """
+    # each edge is listed in every direction in which it may be travelled, so the graph is always directed here
+    dist[rows[0]:rows[-1] + 1] = csgraph.dijkstra(graph, directed=True, indices=rows)
+    dist.flush()
+
+
+def node_graph(n_nodes, indptr, indices, lengths):
+    """
+    Sparse matrix of node-to-node lengths from CSR adjacency arrays (see csr.CSRGraph.adjacency), keeping only the
+    shortest of any parallel edges. scipy would otherwise add them together.
+    """
+    rows = np.repeat(np.arange(n_nodes), np.diff(indptr))
+    order = np.lexsort((lengths, indices, rows))
+    rows, cols, data = rows[order], np.asarray(indices)[order], np.asarray(lengths)[order]
+    first = np.ones(rows.size, dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return sparse.csr_matrix((data[first], (rows[first], cols[first])), shape=(n_nodes, n_nodes))
+
+
+class DistanceTable(object):
+
+    def __init__(self, node_ids, dist, directed, filename=None, temporary=False):
+        """
+        :param node_ids: List of node IDs, giving the order of the rows and columns.
+        :param dist: (N, N) float32 array, usually memory-mapped. dist[i, j] is the distance from node i to node j,
+        np.inf if there is no route.
+        :param directed: True if the distances respect one-way restrictions.
+        :param filename: The .npy file holding dist, if any. This is reopened when the table is unpickled.
+        :param temporary: If True, the table owns filename, which is deleted when the table is closed or garbage
+        collected.
+        """
+        self.node_ids = list(node_ids)
+        self.node_index = dict((t, i) for i, t in enumerate(self.node_ids))
+        self.dist = dist
+        self.directed = directed
+        self.filename = filename
+        self.temporary = temporary
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('node_index')
+        if self.filename is not None:
+            # the file is reopened rather than copied into the pickle
+            state['dist'] = None
+        # copies (e.g. in worker processes) read the file while the original table exists, but never delete it
+        state['temporary'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.node_index = dict((t, i) for i, t in enumerate(self.node_ids))
+        if self.dist is None:
+            self.dist = np.load(self.filename, mmap_mode='r')
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Release the table, deleting its file if it is temporary. The table cannot be used afterwards.
+        """
+        self.dist = None
+        if getattr(self, 'temporary', False):
+            self.temporary = False
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+    @classmethod
+    def build(cls, node_ids, graph, directed, filename=None, n_jobs=1, block_size=256):
+        """
+        :param node_ids: List of node IDs, in the order of the rows of graph.
+        :param graph: Sparse matrix of lengths, as given by node_graph(), listing each edge in every direction in
+        which it may be travelled.
+        :param directed: True if graph respects one-way restrictions. This is only recorded.
+        :param filename: The .npy file to write. If None, a temporary file is used, which is deleted when the table
+        is closed or garbage collected.
+        :param n_jobs: Number of worker processes. If None, use the number of CPUs.
+        :param block_size: Number of source nodes in each job.
+        """
+        n = len(node_ids)
+        temporary = filename is None
+        if temporary:
+            fd, filename = tempfile.mkstemp(suffix='.npy')
+            os.close(fd)
+        try:
+            dist = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(n, n))
+            del dist
+            blocks = [np.arange(i, min(i + block_size, n)) for i in range(0, n, block_size)]
+
+            n_jobs = min(n_jobs or mp.cpu_count(), len(blocks))
+            if n_jobs <= 1:
+                dist = np.load(filename, mmap_mode='r+')
+                for rows in blocks:
+                    fill_rows(graph, dist, rows)
+                del dist
+            else:
+                pool = mp.Pool(n_jobs, initializer=_init_worker, initargs=(graph, filename))
+                try:
+                    for _ in pool.imap_unordered(_fill_rows, blocks):
+                        pass
+                finally:
+                    pool.close()
+                    pool.join()
+        except:
+            if temporary:
+                os.remove(filename)
+            raise
+
+        return cls(node_ids, np.load(filename, mmap_mode='r'), directed, filename=filename, temporary=temporary)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def node_distance(self, u, v):
+        """
+        :return: The distance from node u to node v, by ID.
+        """
+        return float(self.dist[self.node_index[u], self.node_index[v]])
@@ -0,0 +1,185 @@
+__author__ = 'gabriel'
+"""
+Input streams shared by the GML and OSM readers.
+
+open_input() accepts a filename or an open file-like object, detects gzip or bzip2 compression from the first few
+bytes and returns a file-like object that decompresses on the fly as the parser reads from it, so compressed
+archives never have to be unpacked to disk. Concatenated (multi-member) gzip and bzip2 streams are supported.
+Decompression can optionally be moved to a background thread; zlib and bz2 release the GIL while they work, so it
+then overlaps with parsing.
+"""
+import bz2
+import zlib
+import threading
+import Queue
+
+GZIP_MAGIC = '\x1f\x8b'
+BZ2_MAGIC = 'BZh'
+
+CHUNK_SIZE = 2 ** 16
+
+
+def gzip_decompressor():
+    # the 16 offset tells zlib to expect (and check) a gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def bz2_decompressor():
+    return bz2.BZ2Decompressor()
+
+
+class ChunkedReader(object):
+    """
+    Base class for the streams below. Subclasses implement next_chunk(), which returns the next block of data or
+    an empty string at the end of the stream.
+    """
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def next_chunk(self):
+        raise NotImplementedError()
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+            chunk = self.next_chunk()
+            if not chunk:
+                self.eof = True
+            else:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+        end = len(self.buffer) if size < 0 else self.pos + size
+        res = self.buffer[self.pos:end]
+        self.pos += len(res)
+        return res
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class InputStream(ChunkedReader):
+
+    def __init__(self, fileobj, head='', decompressor=None, close_fileobj=True, chunksize=CHUNK_SIZE):
+        """
+        Read-only file-like wrapper around a (possibly compressed) byte stream.
+        :param fileobj: The underlying stream.
+        :param head: Bytes already consumed from fileobj (e.g. when sniffing the compression), which are
+        processed before anything else is read.
+        :param decompressor: Optional callable returning a new decompressor object, e.g. gzip_decompressor. A new
+        one is created at the start of each member of a concatenated stream.
+        :param close_fileobj: If True, fileobj is closed along with this stream.
+        """
+        self.fileobj = fileobj
+        self.new_decompressor = decompressor
+        self.decompressor = decompressor() if decompressor else None
+        self.close_fileobj = close_fileobj
+        self.chunksize = chunksize
+        self.buffer = self.decompress(head)
+
+    def decompress(self, raw):
+        if self.decompressor is None:
+            return raw
+        out = []
+        while raw:
+            try:
+                out.append(self.decompressor.decompress(raw))
+            except EOFError:
+                # a bz2 member ended exactly at the end of the previous chunk, leaving no unused_data to start the
+                # next one with. zlib never raises this: data after the end of a gzip member goes to unused_data
+                self.decompressor = self.new_decompressor()
+                continue
+            # anything left over belongs to the next member of the stream
+            raw = self.decompressor.unused_data
+            if raw:
+                self.decompressor = self.new_decompressor()
+        return ''.join(out)
+
+    def next_chunk(self):
+        while True:
+            raw = self.fileobj.read(self.chunksize)
+            if not raw:
+                return ''
+            chunk = self.decompress(raw)
+            # a compressed chunk may not produce any output yet
+            if chunk:
+                return chunk
+
+    def close(self):
+        if self.close_fileobj:
+            self.fileobj.close()
+
+
+class ThreadedInputStream(ChunkedReader):
+
+    def __init__(self, stream, chunksize=CHUNK_SIZE, max_chunks=16):
+        """
+        Read ahead from stream in a background thread, so that decompression runs while the consumer parses.
+        :param max_chunks: Maximum number of chunks read ahead and held in memory.
+        """
+        self.stream = stream
+        self.chunksize = chunksize
+        self.queue = Queue.Queue(maxsize=max_chunks)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        try:
+            while not self.stopped.is_set():
+                chunk = self.stream.read(self.chunksize)
+                self.queue.put(chunk)
+                if not chunk:
+                    return
+        except Exception as exc:
+            self.queue.put(exc)
+
+    def next_chunk(self):
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            self.eof = True
+            raise chunk
+        return chunk
+
+    def close(self):
+        self.stopped.set()
+        # unblock the worker if it is waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.stream.close()
+
+
+def open_input(source, threaded=False):
+    """
+    Open a filename or file-like object for reading, decompressing gzip or bzip2 data transparently.
+    Compression is detected from the content rather than the file extension. File-like objects supplied by the
+    caller are not closed.
+    :param source: Filename or object with a read() method.
+    :param threaded: If True, decompression (and file reading) runs on a background thread.
+    :return: File-like object, also usable as a context manager.
+    """
+    if hasattr(source, 'read'):
+        fileobj = source
+        close_fileobj = False
+    else:
+        fileobj = open(source, 'rb')
+        close_fileobj = True
+
+    head = fileobj.read(len(BZ2_MAGIC))
+    if head.startswith(GZIP_MAGIC):
+        decompressor = gzip_decompressor
+    elif head.startswith(BZ2_MAGIC):
+        decompressor = bz2_decompressor
+    else:
+        decompressor = None
+
+    stream = InputStream(fileobj, head=head, decompressor=decompressor, close_fileobj=close_fileobj)
+    if threaded:
+        return ThreadedInputStream(stream)
+    return stream
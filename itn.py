@@ -10,6 +10,9 @@ an FID, some geometric information, and the rest is devolved to tags.
 
 The first step in the workflow is to read the GML using a custom-built XML parser -
 this produces these entitites, which are then held in an ITNData container class.
+For large files, iter_gml() yields the entities one at a time instead and
+read_gml_network() keeps only what is needed to build the network (an
+ITNNetworkData instance), so the full ITNData is never held in memory.
 
 The main class for the street network itself (used for all processing, modelling etc)
 is the ITNStreetNet - this can be built directly using an ITNData instance.
@@ -23,9 +26,15 @@ from shapely.geometry import Point, LineString, Polygon
 import xml.sax as sax
 import datetime
 import networkx as nx
+import numpy as np
 import cPickle
+import glob
+import multiprocessing as mp
+from collections import deque
 
-from streetnet import StreetNet
+from streetnet import StreetNet, BoundingRegion
+from fileio import open_input
+import cache
 from distutils.version import StrictVersion
 
 
@@ -75,6 +84,15 @@ class RoadRouteInformation():
         self.tags = tags
 
 
+def parse_coordinates(text):
+    '''
+    Decode the content of a gml:coordinates element ("x1,y1 x2,y2 ...") into an
+    (N, 2) float array in a single call, rather than splitting and converting each
+    point in Python. The array can be passed directly to LineString.
+    '''
+    return np.fromstring(text.replace(',', ' '), sep=' ').reshape(-1, 2)
+
+
 class ITNHandler(sax.handler.ContentHandler):
 
     '''
@@ -109,14 +127,40 @@ class ITNHandler(sax.handler.ContentHandler):
     you know.
     '''
 
-    def __init__(self):
+    #The GML element that opens each entity, and the name of the entity class
+    ENTITY_TYPES = {
+        'osgb:Road': 'Road',
+        'osgb:RoadNode': 'RoadNode',
+        'osgb:RoadLink': 'RoadLink',
+        'osgb:RoadLinkInformation': 'RoadLinkInformation',
+        'osgb:RoadRouteInformation': 'RoadRouteInformation',
+    }
+
+    #The attribute in which each entity class is stored
+    STORES = {
+        'Road': 'roads',
+        'RoadNode': 'roadNodes',
+        'RoadLink': 'roadLinks',
+        'RoadLinkInformation': 'roadLinkInformations',
+        'RoadRouteInformation': 'roadRouteInformations',
+    }
+
+    def __init__(self, callback=None, feature_types=None):
         sax.handler.ContentHandler.__init__(self)
+        # if a callback is supplied, each entity is passed to it as soon as it is closed rather than being stored
+        self.callback = callback
+        # if feature_types is supplied, entities of any other class are skipped without being parsed
+        self.feature_types = set(feature_types) if feature_types is not None else None
+        if self.feature_types is not None and not self.feature_types.issubset(self.STORES):
+            raise ValueError("Unrecognised feature types: %s" % ', '.join(self.feature_types.difference(self.STORES)))
+        self.skipping = None
         self.fid = None
         self.geometry = None
         self.tags = None
 
         self.current_type = None
-        self.current_content = ''
+        # text is buffered as a list of chunks and only joined when it is needed
+        self.content_chunks = []
 
         self.roads = {}
         self.roadNodes = {}
@@ -127,6 +171,13 @@ class ITNHandler(sax.handler.ContentHandler):
 
     def startElement(self,name,attrs):
 
+        if self.skipping is not None:
+            return
+
+        if self.feature_types is not None and name in self.ENTITY_TYPES and self.ENTITY_TYPES[name] not in self.feature_types:
+            self.skipping = name
+            return
+
         if name=='osgb:Road':
             self.fid = attrs['fid']
             self.tags = {}
@@ -184,16 +235,27 @@ class ITNHandler(sax.handler.ContentHandler):
             #For 'One way', the traffic flows TOWARDS the given orientation
             self.geometry[attrs['orientation']]=attrs['xlink:href'][1:]
 
-        self.current_content=''
+        self.content_chunks=[]
 
 
     def characters(self,content):
-        self.current_content = self.current_content+content
+        if self.skipping is None:
+            self.content_chunks.append(content)
+
+
+    @property
+    def current_content(self):
+        return ''.join(self.content_chunks)
 
 
     def endElement(self,name):
+        if self.skipping is not None:
+            if name==self.skipping:
+                self.skipping = None
+            return
+
         if name=='osgb:Road':
-            self.roads[self.fid] = Road(self.fid,self.geometry,self.tags)
+            self.emit(Road(self.fid,self.geometry,self.tags))
             self.reset()
 
         elif name=='osgb:roadName' and self.current_type=='osgb:Road':
@@ -208,15 +270,14 @@ class ITNHandler(sax.handler.ContentHandler):
             self.tags['descriptiveTerm']=self.current_content
 
         elif name=='osgb:RoadNode':
-            self.roadNodes[self.fid] = RoadNode(self.fid,self.geometry,self.tags)
+            self.emit(RoadNode(self.fid,self.geometry,self.tags))
             self.reset()
 
         elif name=='gml:coordinates' and self.current_type=='osgb:RoadNode':
-            coords=self.current_content.split(',')
-            self.geometry=tuple(map(float,coords))
+            self.geometry=tuple(parse_coordinates(self.current_content)[0].tolist())
 
         elif name=='osgb:RoadLink':
-            self.roadLinks[self.fid] = RoadLink(self.fid,self.geometry,self.tags)
+            self.emit(RoadLink(self.fid,self.geometry,self.tags))
             self.reset()
 
         elif name=='osgb:descriptiveTerm' and self.current_type=='osgb:RoadLink':
@@ -229,12 +290,10 @@ class ITNHandler(sax.handler.ContentHandler):
             self.tags['length']=float(self.current_content)
 
         elif name=='gml:coordinates' and self.current_type=='osgb:RoadLink':
-            points=self.current_content.split()
-            points_coords=[p.split(',') for p in points]
-            self.geometry=[tuple(map(float,p)) for p in points_coords]
+            self.geometry=parse_coordinates(self.current_content)
 
         elif name=='osgb:RoadLinkInformation':
-            self.roadLinkInformations[self.fid] = RoadLinkInformation(self.fid,self.geometry,self.tags)
+            self.emit(RoadLinkInformation(self.fid,self.geometry,self.tags))
             self.reset()
 
         elif name=='osgb:classification' and self.current_type=='osgb:RoadLinkInformation':
@@ -250,7 +309,7 @@ class ITNHandler(sax.handler.ContentHandler):
             self.tags['inches']=self.current_content
 
         elif name=='osgb:RoadRouteInformation':
-            self.roadRouteInformations[self.fid] = RoadRouteInformation(self.fid,self.geometry,self.tags)
+            self.emit(RoadRouteInformation(self.fid,self.geometry,self.tags))
             self.reset()
 
         elif name=='osgb:instruction' and self.current_type=='osgb:RoadRouteInformation':
@@ -280,6 +339,17 @@ class ITNHandler(sax.handler.ContentHandler):
             self.tags['endTime']=datetime_object.time()
 
 
+    def emit(self, entity):
+        if self.callback is None:
+            self.store(entity)
+        else:
+            self.callback(entity)
+
+
+    def store(self, entity):
+        getattr(self, self.STORES[entity.__class__.__name__])[entity.fid] = entity
+
+
     def reset (self):
         self.fid = None
         self.geometry = None
@@ -287,6 +357,99 @@ class ITNHandler(sax.handler.ContentHandler):
         self.current_type = None
 
 
+class ITNSpatialFilter(object):
+
+    '''
+    This sits between an ITNHandler and wherever its entities are going, and only
+    passes on those that are within a region or are needed by something that is.
+
+    RoadLinks are kept if their polyline intersects the region. RoadNodes are kept
+    if they lie in the region, or if they are a terminal node of a kept link - that
+    way links that cross the boundary are still complete, and can be clipped later
+    by StreetNet.within_boundary. RoadLinkInformations and RoadRouteInformations are
+    kept if the link they refer to is kept, and Roads if any of their members are.
+
+    Since the referring entity can appear later in the file than the one it refers
+    to, anything that can't be decided yet is held back until close() is called.
+    In OS files the links come first, so in practice only nodes that lie outside
+    the region are held back, and only until the end of the file.
+    '''
+
+    def __init__(self, callback, bbox=None, polygon=None):
+        self.callback = callback
+        self.region = BoundingRegion(bbox=bbox, polygon=polygon)
+        self.kept_links = set()
+        self.rejected_links = set()
+        self.kept_nodes = set()
+        self.referenced_nodes = set()
+        self.held = []
+
+
+    def __call__(self, entity):
+        if isinstance(entity, RoadLink):
+            if self.region.intersects_line(entity.polyline):
+                self.kept_links.add(entity.fid)
+                self.referenced_nodes.add(node_fid(entity.tags['orientation_neg']))
+                self.referenced_nodes.add(node_fid(entity.tags['orientation_pos']))
+                self.keep(entity)
+            else:
+                self.rejected_links.add(entity.fid)
+
+        elif isinstance(entity, RoadNode):
+            if entity.fid in self.referenced_nodes or self.region.contains_point(*entity.eas_nor):
+                self.keep(entity)
+            else:
+                self.held.append(entity)
+
+        elif isinstance(entity, RoadLinkInformation):
+            self.check_links(entity, [entity.roadLink_ref])
+
+        elif isinstance(entity, RoadRouteInformation):
+            self.check_links(entity, entity.route_members.values())
+
+        elif isinstance(entity, Road):
+            if self.kept_links.intersection(entity.members) or self.kept_nodes.intersection(entity.members):
+                self.keep(entity)
+            else:
+                self.held.append(entity)
+
+
+    def check_links(self, entity, link_fids):
+        if self.kept_links.intersection(link_fids):
+            self.keep(entity)
+        elif not self.rejected_links.issuperset(link_fids):
+            # one or more of the links hasn't been seen yet
+            self.held.append(entity)
+
+
+    def keep(self, entity):
+        if isinstance(entity, RoadNode):
+            self.kept_nodes.add(entity.fid)
+        self.callback(entity)
+
+
+    def close(self):
+        '''
+        Pass on any held-back entities that turned out to be needed.
+        '''
+        #Nodes first, so that Roads can check their members against kept_nodes
+        held = sorted(self.held, key=lambda x: not isinstance(x, RoadNode))
+        self.held = []
+        for entity in held:
+            if isinstance(entity, RoadNode):
+                if entity.fid in self.referenced_nodes:
+                    self.keep(entity)
+            elif isinstance(entity, RoadLinkInformation):
+                if entity.roadLink_ref in self.kept_links:
+                    self.keep(entity)
+            elif isinstance(entity, RoadRouteInformation):
+                if self.kept_links.intersection(entity.route_members.values()):
+                    self.keep(entity)
+            elif isinstance(entity, Road):
+                if self.kept_links.intersection(entity.members) or self.kept_nodes.intersection(entity.members):
+                    self.keep(entity)
+
+
 class ITNData():
 
     '''
@@ -309,6 +472,81 @@ class ITNData():
             cPickle.dump(self, f)
 
 
+class ITNNetworkData():
+
+    '''
+    A slimmed-down alternative to ITNData, holding only what ITNStreetNet needs
+    to build the network: the coordinates of each node, the attributes of each
+    link (including its LineString) and the one-way directives.
+
+    Entities are added one at a time via add(), so it can be filled directly from
+    iter_gml() - the Roads, RoadLinkInformations and non one-way
+    RoadRouteInformations are dropped as soon as they are read.
+    '''
+
+    def __init__(self):
+        self.node_locs = {}
+        self.links = {}
+        self.one_way = {}
+
+
+    @classmethod
+    def from_itn_data(cls, data):
+        obj = cls()
+        for store in (data.roadNodes, data.roadLinks, data.roadRouteInformations):
+            for entity in store.itervalues():
+                obj.add(entity)
+        return obj
+
+
+    def update(self, other):
+        '''
+        Merge in the contents of another ITNNetworkData, e.g. from a neighbouring
+        tile. Nodes and links that straddle a tile edge are repeated in both tiles
+        with the same FID, so keying on FID deduplicates them. Terminal node IDs
+        carry the gradeSeparation of the link end rather than anything tile-specific,
+        so they agree between tiles, and they are only resolved against node_locs
+        when the network is built - by which point every tile has been merged.
+        '''
+        self.node_locs.update(other.node_locs)
+        for fid, atts in other.links.iteritems():
+            if fid not in self.links:
+                self.links[fid] = atts
+        self.one_way.update(other.one_way)
+
+
+    def add(self, entity):
+        if isinstance(entity, RoadNode):
+            self.node_locs[entity.fid] = entity.eas_nor
+
+        elif isinstance(entity, RoadLink):
+            #Copy the tags so that the entity itself is left untouched, then add
+            #the geometry and FID as required for the edge attributes
+            atts = dict(entity.tags)
+            atts['linestring'] = LineString(entity.polyline)
+            atts['length'] = atts['linestring'].length
+            atts['fid'] = entity.fid
+            self.links[entity.fid] = atts
+
+        elif isinstance(entity, RoadRouteInformation):
+            #A one-way item has an 'instruction' attribute with value 'One Way'.
+            #The orientation is either positive or negative, and in either case
+            #the roadLink_fid to which it refers is specified
+            if entity.tags.get('instruction') == 'One Way':
+                if '+' in entity.route_members:
+                    self.one_way[entity.route_members['+']] = 'pos'
+                else:
+                    self.one_way[entity.route_members['-']] = 'neg'
+
+
+def node_fid(node_id):
+    '''
+    Strip the gradeSeparation suffix that ITNHandler appends to terminal node IDs,
+    giving the FID of the RoadNode.
+    '''
+    return node_id.rsplit('_', 1)[0]
+
+
 
 class ITNStreetNet(StreetNet):
     
@@ -337,74 +575,63 @@ class ITNStreetNet(StreetNet):
     and bloated.
     '''
 
+    @classmethod
+    def from_gml_tiles(cls, filenames, n_jobs=None, srid=None, bbox=None, polygon=None):
+        '''
+        Build a single network from a set of tiled GML files. See read_gml_tiles().
+        '''
+        return cls.from_data_structure(read_gml_tiles(filenames, n_jobs=n_jobs, bbox=bbox, polygon=polygon),
+                                       srid=srid)
+
+
     def build_network(self, data):
+        '''
+        Build the graph from either an ITNData or an ITNNetworkData instance. The
+        former is reduced to the latter first, so both routes are identical.
+        '''
+        if not isinstance(data, ITNNetworkData):
+            data = ITNNetworkData.from_itn_data(data)
 
         g=nx.MultiGraph()
 
-        for roadLink_fid in data.roadLinks:
+        for roadLink_fid, atts in data.links.iteritems():
 
             #In network terms, the roadlink is just encoded as a simple edge between
             #the two terminal nodes, but the full polyline geometry is included
             #as an attribute of the link, as is the FID.
 
-            atts = data.roadLinks[roadLink_fid].tags
-            # atts['polyline'] = data.roadLinks[roadLink_fid].polyline
-            atts['linestring'] = LineString(data.roadLinks[roadLink_fid].polyline)
-            atts['length'] = atts['linestring'].length
-            atts['fid']=roadLink_fid
-
             #This if statement just checks that both terminal nodes are in the roadNodes
             #dataset. Sometimes, around the edges, they are not - this causes problems
-            #down the line so such links are omitted. The [:-2] is to ignore the
+            #down the line so such links are omitted. node_fid() removes the
             #gradeSeparation tag that I added when parsing.
 
-            if atts['orientation_neg'][:-2] in data.roadNodes and atts['orientation_pos'][:-2] in data.roadNodes:
+            if node_fid(atts['orientation_neg']) in data.node_locs and node_fid(atts['orientation_pos']) in data.node_locs:
 
                 g.add_edge(atts['orientation_neg'],atts['orientation_pos'],key=atts['fid'],attr_dict=atts)
 
         #Only want the largest connected component - sometimes fragments appear
         #round the edge - so take that.
-        g=list(nx.connected_component_subgraphs(g))[0]
+        g=max(nx.connected_component_subgraphs(g), key=len)
 
         #Now record one-way status for every segment
-        #The idea is to go through all roadRouteInformations looking for the ones
-        #that correspond to a one-way directive
-        for roadRouteInformation_fid in data.roadRouteInformations:
-
-            #Get the actual content of the roadRouteInformation
-            atts = data.roadRouteInformations[roadRouteInformation_fid].tags
-
-            #A one-way item has an 'instruction' attribute with value 'One Way',
-            #so look for that
-            if 'instruction' in atts:
-
-                if atts['instruction']=='One Way':
-
-                    #The orientation is either positive of negative, and in either
-                    #case the roadLink_fid to which it refers is specified
-                    if '+' in data.roadRouteInformations[roadRouteInformation_fid].route_members:
-                        roadLink_fid = data.roadRouteInformations[roadRouteInformation_fid].route_members['+']
-                        orientation='pos'
-                    else:
-                        roadLink_fid = data.roadRouteInformations[roadRouteInformation_fid].route_members['-']
-                        orientation='neg'
-
-                    if roadLink_fid not in data.roadLinks:
-                        # this instruction refers to a link not included in our network (why??)
-                        # skip to avoid errors
-                        continue
-
-                    #Get the relevant terminal nodes so that we can look up the edge
-                    v0 = data.roadLinks[roadLink_fid].tags['orientation_pos']
-                    v1 = data.roadLinks[roadLink_fid].tags['orientation_neg']
-
-                    #A try method is used here because sometimes the link to which
-                    #the instruction refers is not actually in the graph (usually
-                    #an edge effect) - the lookup would throw an error in such cases.
-                    try:
-                        g.edge[v0][v1][roadLink_fid]['one_way']=orientation
-                    except:
-                        pass
+        for roadLink_fid, orientation in data.one_way.iteritems():
+
+            if roadLink_fid not in data.links:
+                # this instruction refers to a link not included in our network (why??)
+                # skip to avoid errors
+                continue
+
+            #Get the relevant terminal nodes so that we can look up the edge
+            v0 = data.links[roadLink_fid]['orientation_pos']
+            v1 = data.links[roadLink_fid]['orientation_neg']
+
+            #A try method is used here because sometimes the link to which
+            #the instruction refers is not actually in the graph (usually
+            #an edge effect) - the lookup would throw an error in such cases.
+            try:
+                g.edge[v0][v1][roadLink_fid]['one_way']=orientation
+            except KeyError:
+                pass
 
         self.g = g
 
@@ -414,9 +641,12 @@ class ITNStreetNet(StreetNet):
         Each node gets an attribute added for its geometric position. This is only
         really useful for plotting.
         '''
-
-        for v in self.g:
-            self.g.node[v]['loc'] = data.roadNodes[v[:-2]].eas_nor
+        if isinstance(data, ITNNetworkData):
+            for v in self.g:
+                self.g.node[v]['loc'] = data.node_locs[node_fid(v)]
+        else:
+            for v in self.g:
+                self.g.node[v]['loc'] = data.roadNodes[node_fid(v)].eas_nor
 
 
     def build_routing_network(self):
@@ -456,21 +686,147 @@ class ITNStreetNet(StreetNet):
         self.g_routing=g_routing
 
 
-def read_gml(filename):
-    CurrentHandler=ITNHandler()
-    sax.parse(filename, CurrentHandler)
+#Bump this whenever a change to ITNHandler alters its output, so that cached parses are discarded
+PARSER_VERSION = 1
+
+#How each entity class is laid out in the parse cache: (ITNData attribute, class, geometry attribute, kind)
+CACHE_SCHEMA = [
+    ('roads', Road, 'members', 'strings'),
+    ('roadNodes', RoadNode, 'eas_nor', 'point'),
+    ('roadLinks', RoadLink, 'polyline', 'coords'),
+    ('roadLinkInformations', RoadLinkInformation, 'roadLink_ref', 'string'),
+    ('roadRouteInformations', RoadRouteInformation, 'route_members', 'mapping'),
+]
+
+
+def read_gml(filename, bbox=None, polygon=None, feature_types=None, threaded=False, cache_dir=None):
+    '''
+    Parse a GML file into an ITNData instance.
+    :param filename: Path or file-like object. gzip and bzip2 compressed input is decompressed as it is parsed
+    (see fileio.open_input).
+    :param bbox: Optional (xmin, ymin, xmax, ymax). If supplied, only features in this box are kept (see
+    ITNSpatialFilter).
+    :param polygon: Optional Polygon (or sequence of vertices), used in the same way as bbox.
+    :param feature_types: Optional iterable of the entity classes to keep, e.g. ('RoadNode', 'RoadLink'). Other
+    entities are skipped without being parsed.
+    :param threaded: If True, decompression runs on a separate thread, overlapping with parsing.
+    :param cache_dir: Optional directory holding cached parses (see cache.py). If filename is a path, a previous
+    parse of the same file content with the same options is loaded from here if present; otherwise the result is
+    saved here.
+    '''
+    key = None
+    if cache_dir is not None and isinstance(filename, basestring):
+        key = cache.cache_key(filename, 'itn', PARSER_VERSION, bbox=bbox, polygon=polygon,
+                              feature_types=sorted(feature_types) if feature_types is not None else None)
+        stores = cache.load(cache_dir, key, CACHE_SCHEMA)
+        if stores is not None:
+            return ITNData(**stores)
+
+    CurrentHandler=ITNHandler(feature_types=feature_types)
+    if bbox is not None or polygon is not None:
+        CurrentHandler.callback = ITNSpatialFilter(CurrentHandler.store, bbox=bbox, polygon=polygon)
+    with open_input(filename, threaded=threaded) as f:
+        sax.parse(f, CurrentHandler)
+    if CurrentHandler.callback is not None:
+        CurrentHandler.callback.close()
     CurrentData = ITNData(CurrentHandler.roads,
                           CurrentHandler.roadNodes,
                           CurrentHandler.roadLinks,
                           CurrentHandler.roadLinkInformations,
                           CurrentHandler.roadRouteInformations)
+    if key is not None:
+        cache.save(cache_dir, key, CACHE_SCHEMA, vars(CurrentData))
     return CurrentData
 
 
+def iter_gml(filename, chunksize=2 ** 16, bbox=None, polygon=None, feature_types=None, threaded=False):
+    '''
+    Generator yielding the ITN entities in a GML file one at a time, as soon as each
+    one is closed. The file is fed to an incremental SAX parser in chunks, so only
+    the entities emitted by the current chunk are ever held in memory.
+    :param filename: Path or file-like object, optionally compressed, as for read_gml().
+    :param chunksize: Number of bytes read from the file per parser feed.
+    :param bbox, polygon, feature_types, threaded: As for read_gml().
+    '''
+    pending = deque()
+    spatial_filter = None
+    if bbox is not None or polygon is not None:
+        spatial_filter = ITNSpatialFilter(pending.append, bbox=bbox, polygon=polygon)
+    parser = sax.make_parser()
+    parser.setContentHandler(ITNHandler(callback=spatial_filter or pending.append, feature_types=feature_types))
+    with open_input(filename, threaded=threaded) as f:
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            while pending:
+                yield pending.popleft()
+    parser.close()
+    if spatial_filter is not None:
+        spatial_filter.close()
+    while pending:
+        yield pending.popleft()
+
+
+def read_gml_network(filename, bbox=None, polygon=None):
+    '''
+    Stream a GML file straight into an ITNNetworkData instance, which is all that
+    ITNStreetNet.from_data_structure() needs. Peak memory scales with the network
+    rather than with the size of the file. Roads and RoadLinkInformations are not
+    needed, so they are skipped by the parser.
+    :param bbox, polygon: Optional spatial filters, as for read_gml().
+    '''
+    data = ITNNetworkData()
+    for entity in iter_gml(filename,
+                           bbox=bbox,
+                           polygon=polygon,
+                           feature_types=('RoadNode', 'RoadLink', 'RoadRouteInformation')):
+        data.add(entity)
+    return data
+
+
+def _read_gml_network_star(args):
+    # module-level wrapper so that it can be pickled and sent to a worker process
+    return read_gml_network(*args)
+
+
+def read_gml_tiles(filenames, n_jobs=None, bbox=None, polygon=None):
+    '''
+    Read a set of tiled GML files, as supplied by OS, into one ITNNetworkData
+    instance. Tiles are parsed in parallel and merged as they complete; FIDs that
+    are repeated along tile edges are deduplicated by ITNNetworkData.update().
+    :param filenames: Either a list of filenames or a glob pattern string.
+    :param n_jobs: Number of worker processes. Defaults to the number of CPUs. If 1, tiles are read serially.
+    :param bbox, polygon: Optional spatial filters, as for read_gml(). Applied to every tile.
+    '''
+    if isinstance(filenames, basestring):
+        filenames = sorted(glob.glob(filenames))
+    if not len(filenames):
+        raise ValueError("No GML tiles supplied")
+
+    n_jobs = min(n_jobs or mp.cpu_count(), len(filenames))
+    data = ITNNetworkData()
+
+    if n_jobs == 1:
+        for fn in filenames:
+            data.update(read_gml_network(fn, bbox=bbox, polygon=polygon))
+        return data
+
+    pool = mp.Pool(n_jobs)
+    try:
+        for tile_data in pool.imap_unordered(_read_gml_network_star, [(fn, bbox, polygon) for fn in filenames]):
+            data.update(tile_data)
+    finally:
+        pool.close()
+        pool.join()
+
+    return data
+
+
 if __name__ == '__main__':
 
     import os
-    import numpy as np
 
     this_dir = os.path.dirname(os.path.realpath(__file__))
     ITNFILE = os.path.join(this_dir, 'test_data', 'mastermap-itn_417209_0_brixton_sample.gml')
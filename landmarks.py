@@ -0,0 +1,134 @@
+__author__ = 'gabriel'
+"""
+Landmark (ALT) distance bounds.
+
+The network distances from a small number of landmark nodes to every node (and, for directed routing, from every node
+to the landmarks) are computed once. The triangle inequality then bounds the distance between any two nodes x and y
+using each landmark L:
+
+    d(x, y) >= d(L, y) - d(L, x)
+    d(x, y) >= d(x, L) - d(y, L)
+    d(x, y) <= d(x, L) + d(L, y)
+
+so bounds cost O(k) for k landmarks, with no search. Landmarks on the edge of the network give the tightest bounds,
+so they are chosen one at a time as the node furthest from those already chosen.
+
+The lower bound is also a consistent A* heuristic (see StreetNet.path_points with method='alt').
+
+Nodes are referred to by ID, so the tables do not depend on the backend used by StreetNet.
+"""
+import operator
+import numpy as np
+
+import routing
+
+
+class Landmarks(object):
+
+    def __init__(self, node_ids, landmarks, dist_from, dist_to=None):
+        """
+        :param node_ids: List of node IDs, length N.
+        :param landmarks: List of the k landmark node IDs.
+        :param dist_from: (N, k) array of distances from each landmark to each node, np.inf if unreachable.
+        :param dist_to: (N, k) array of distances from each node to each landmark. If None, the network is taken to
+        be undirected and dist_from is used.
+        """
+        self.node_ids = list(node_ids)
+        self.node_index = dict((t, i) for i, t in enumerate(self.node_ids))
+        self.landmarks = list(landmarks)
+        self.dist_from = np.asarray(dist_from, dtype=float)
+        self.dist_to = self.dist_from if dist_to is None else np.asarray(dist_to, dtype=float)
+        self._rows = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rows'] = None
+        return state
+
+    @classmethod
+    def build(cls, keys, neighbours, node_id, reverse_neighbours=None, n_landmarks=16):
+        """
+        Choose landmarks and compute the distance tables.
+        :param keys: List of the keys used by neighbours for every node.
+        :param neighbours: Callable, key -> iterable of (next key, edge key, length), as in routing.py.
+        :param node_id: Function converting keys to node IDs.
+        :param reverse_neighbours: As neighbours, but following the edges backwards. Required for directed
+        networks; leave as None for undirected networks.
+        :param n_landmarks: Number of landmarks. This is reduced if the network has fewer nodes.
+        """
+        keys = list(keys)
+        index = dict((t, i) for i, t in enumerate(keys))
+        n = len(keys)
+        k = min(n_landmarks, n)
+
+        def table(nbrs, source):
+            res = np.empty(n)
+            res.fill(np.inf)
+            dist, _ = routing.dijkstra(nbrs, {source: 0.})
+            for t, d in dist.iteritems():
+                res[index[t]] = d
+            return res
+
+        dist_from = np.empty((n, k))
+        dist_to = np.empty((n, k)) if reverse_neighbours is not None else None
+        landmarks = []
+        # the first landmark is the node furthest from an arbitrary start; each subsequent one the node furthest from
+        # all those chosen so far. Nodes that cannot be reached from any landmark are infinitely far, so each
+        # disconnected part of the network receives a landmark if there are enough.
+        closest = table(neighbours, keys[0]) if n else None
+        for j in range(k):
+            i = int(np.argmax(closest))
+            landmarks.append(node_id(keys[i]))
+            dist_from[:, j] = table(neighbours, keys[i])
+            if dist_to is not None:
+                dist_to[:, j] = table(reverse_neighbours, keys[i])
+            closest = dist_from[:, j] if j == 0 else np.minimum(closest, dist_from[:, j])
+            closest[i] = -1
+
+        return cls([node_id(t) for t in keys], landmarks, dist_from, dist_to)
+
+    @property
+    def directed(self):
+        return self.dist_to is not self.dist_from
+
+    def node_bounds(self, x, y):
+        """
+        Bounds on the distances between pairs of nodes.
+        :param x, y: Equal length sequences of node IDs, giving the start and end of each pair.
+        :return: (lower, upper) arrays.
+        """
+        x = np.array([self.node_index[t] for t in x], dtype=int)
+        y = np.array([self.node_index[t] for t in y], dtype=int)
+        with np.errstate(invalid='ignore'):
+            # inf - inf is NaN, which fmax ignores; a pair with no usable landmark has a lower bound of zero
+            lower = np.fmax(self.dist_from[y] - self.dist_from[x], self.dist_to[x] - self.dist_to[y])
+            lower = np.fmax.reduce(lower, axis=1) if lower.shape[1] else np.zeros(x.size)
+            lower = np.where(lower > 0, lower, 0.)
+        upper = np.min(self.dist_to[x] + self.dist_from[y], axis=1) if self.landmarks else np.inf * np.ones(x.size)
+        same = x == y
+        lower[same] = 0.
+        upper[same] = 0.
+        return lower, upper
+
+    def heuristic(self, node_id, targets):
+        """
+        Consistent A* heuristic.
+        :param node_id: Function converting the keys used by the search to node IDs.
+        :param targets: Dictionary of target key: final distance, as for routing.dijkstra().
+        :return: Callable, key -> lower bound on the distance to the nearest target plus its final distance.
+        """
+        # called once per node reached, where plain lists are faster than numpy for a handful of landmarks
+        if self._rows is None:
+            rows_from = self.dist_from.tolist()
+            self._rows = (rows_from, rows_from if self.dist_to is self.dist_from else self.dist_to.tolist())
+        rows_from, rows_to = self._rows
+        index = self.node_index
+        ends = [(rows_from[index[node_id(t)]], rows_to[index[node_id(t)]], d) for t, d in targets.iteritems()]
+
+        def heuristic(v):
+            i = index[node_id(v)]
+            f, t = rows_from[i], rows_to[i]
+            # max(0., ...) skips the NaN given by inf - inf, as NaN never compares greater
+            return min(max(0., *(map(operator.sub, ft, f) + map(operator.sub, t, tt))) + d for ft, tt, d in ends)
+
+        return heuristic
@@ -17,8 +17,13 @@ import pickle as pk
 import networkx as nx
 from distutils.version import StrictVersion
 import numpy as np
+from array import array
+import multiprocessing as mp
+import pbf
+from fileio import open_input
+import cache
 
-from streetnet import StreetNet
+from streetnet import StreetNet, BoundingRegion
 
 
 
@@ -48,9 +53,27 @@ class Relation():
 
 
 class OSMHandler(sax.handler.ContentHandler):
+
+    # the attribute in which each entity class is stored
+    STORES = {
+        'Node': 'nodes',
+        'Way': 'ways',
+        'Relation': 'relations',
+    }
     
-    def __init__(self):
+    def __init__(self, callback=None, feature_types=None):
+        """
+        :param callback: Optional. If supplied, each entity is passed to this as soon as it is closed, rather than
+        being stored.
+        :param feature_types: Optional iterable of element names to keep ('node', 'way', 'relation'). Other elements
+        are skipped without being parsed.
+        """
         sax.handler.ContentHandler.__init__(self)
+        self.callback = callback
+        self.feature_types = set(feature_types) if feature_types is not None else None
+        if self.feature_types is not None and not self.feature_types.issubset(('node', 'way', 'relation')):
+            raise ValueError("Unrecognised feature types: %s" % ', '.join(self.feature_types))
+        self.skipping = None
         self.id = None
         self.geometry = None
         self.tags = None
@@ -59,6 +82,13 @@ class OSMHandler(sax.handler.ContentHandler):
         self.relations = {}
     
     def startElement(self, name, attrs):
+        if self.skipping is not None:
+            return
+
+        if self.feature_types is not None and name in ('node', 'way', 'relation') and name not in self.feature_types:
+            self.skipping = name
+            return
+
         if name == 'node':
             self.id = attrs['id']
             self.tags = {}
@@ -84,15 +114,29 @@ class OSMHandler(sax.handler.ContentHandler):
             self.tags[attrs['k']] = attrs['v']
     
     def endElement(self, name):
+        if self.skipping is not None:
+            if name == self.skipping:
+                self.skipping = None
+            return
+
         if name == 'node':
-            self.nodes[self.id] = Node(self.id, self.geometry, self.tags)
+            self.emit(Node(self.id, self.geometry, self.tags))
             self.reset()
         elif name == 'way':
-            self.ways[self.id] = Way(self.id, self.geometry, self.tags)
+            self.emit(Way(self.id, self.geometry, self.tags))
             self.reset()
         elif name == 'relation':
-            self.relations[self.id] = Relation(self.id, self.geometry, self.tags)
+            self.emit(Relation(self.id, self.geometry, self.tags))
             self.reset()
+
+    def emit(self, entity):
+        if self.callback is None:
+            self.store(entity)
+        else:
+            self.callback(entity)
+
+    def store(self, entity):
+        getattr(self, self.STORES[entity.__class__.__name__])[entity.feature_id] = entity
     
     def reset (self):
         self.id = None
@@ -100,12 +144,98 @@ class OSMHandler(sax.handler.ContentHandler):
         self.tags = None
 
 
+class OSMSpatialFilter(object):
+
+    def __init__(self, callback, bbox=None, polygon=None):
+        """
+        Sits between an OSMHandler and wherever its entities are going, passing on only those that are within a region
+        or are needed by something that is. Coordinates are those of the file (lon, lat).
+        Nodes in the region are passed on immediately. Ways are kept if any of their nodes is in the region, or if
+        their polyline crosses it; every node of a kept way is then passed on too, so that ways crossing the boundary
+        stay intact for later clipping. Nodes passed on only for that reason do not cause other ways to be kept.
+        Relations are kept if any member is kept.
+        OSM files list all nodes before any ways, so nodes outside the region are held back only until the ways that
+        might need them have been read; the remainder are discarded by close().
+        """
+        self.callback = callback
+        self.region = BoundingRegion(bbox=bbox, polygon=polygon)
+        # nodes in the region
+        self.inside_nodes = set()
+        # every node passed on, including those outside the region that belong to a kept way
+        self.kept_nodes = set()
+        # ways and relations (relation members are stored without their type, so are checked against both sets)
+        self.kept_other = set()
+        # nodes outside the region. These stay here once passed on, since later ways may still need their coordinates
+        self.held_nodes = {}
+
+    def __call__(self, entity):
+        if isinstance(entity, Node):
+            if self.region.contains_point(*entity.lonlat):
+                self.inside_nodes.add(entity.feature_id)
+                self.keep(entity)
+            else:
+                self.held_nodes[entity.feature_id] = entity
+
+        elif isinstance(entity, Way):
+            keep = any(nd in self.inside_nodes for nd in entity.nds)
+            if not keep:
+                # all of the nodes are outside the region
+                coords = [self.held_nodes[nd].lonlat for nd in entity.nds if nd in self.held_nodes]
+                keep = len(coords) > 1 and self.region.intersects_line(coords)
+            if keep:
+                for nd in entity.nds:
+                    if nd in self.held_nodes and nd not in self.kept_nodes:
+                        self.keep(self.held_nodes[nd])
+                self.keep(entity)
+
+        elif isinstance(entity, Relation):
+            if any(m in self.kept_nodes or m in self.kept_other for m in entity.members):
+                self.keep(entity)
+
+    def keep(self, entity):
+        if isinstance(entity, Node):
+            self.kept_nodes.add(entity.feature_id)
+        else:
+            self.kept_other.add(entity.feature_id)
+        self.callback(entity)
+
+    def close(self):
+        self.held_nodes = {}
+
+
+class OSMNodeCoordHandler(sax.handler.ContentHandler):
+
+    def __init__(self, wanted):
+        """
+        Minimal parser that records only the IDs and coordinates of the nodes in wanted, without creating a Node
+        object or reading any tags. Used for the second pass of read_highway_data().
+        :param wanted: Set of node IDs (as strings)
+        """
+        sax.handler.ContentHandler.__init__(self)
+        self.wanted = wanted
+        self.ids = array('l')
+        self.coords = array('d')
+
+    def startElement(self, name, attrs):
+        if name == 'node' and attrs['id'] in self.wanted:
+            self.ids.append(int(attrs['id']))
+            self.coords.append(float(attrs['lon']))
+            self.coords.append(float(attrs['lat']))
+
+
 class OSMData():
     
     def __init__(self, nodes, ways, relations):
         self.nodes = nodes
         self.ways = ways
         self.relations = relations
+
+    def lonlat(self, node_ids):
+        """
+        Look up the coordinates of the supplied nodes.
+        :return: (N, 2) array of lon, lat
+        """
+        return np.array([self.nodes[t].lonlat for t in node_ids], dtype=float).reshape(-1, 2)
     
     def save(self,filename):
         f=open(filename,'wb')
@@ -113,9 +243,57 @@ class OSMData():
         f.close()
 
 
+class OSMHighwayData():
+
+    def __init__(self, ways, node_ids, node_lonlat):
+        """
+        Compact alternative to OSMData containing only highway ways and the coordinates of the nodes that they
+        reference. Node coordinates are held in a single array sorted by integer node ID, rather than as Node objects.
+        Created by read_highway_data().
+        :param ways: Dictionary of Way objects
+        :param node_ids: Length N integer array of node IDs, sorted ascending
+        :param node_lonlat: (N, 2) array of the corresponding lon, lat
+        """
+        self.ways = ways
+        self.node_ids = node_ids
+        self.node_lonlat = node_lonlat
+
+    def lonlat(self, node_ids):
+        """
+        Look up the coordinates of the supplied nodes.
+        :return: (N, 2) array of lon, lat
+        """
+        ids = np.array([int(t) for t in node_ids], dtype=self.node_ids.dtype)
+        idx = np.searchsorted(self.node_ids, ids)
+        idx[idx == self.node_ids.size] = 0
+        missing = self.node_ids[idx] != ids
+        if np.any(missing):
+            raise KeyError("Node IDs not found: %s" % ', '.join(str(t) for t in ids[missing][:10]))
+        return self.node_lonlat[idx]
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pk.dump(self, f)
+
+
 class OSMStreetNet(StreetNet):
 
     input_srid = 4326
+
+    @classmethod
+    def from_pbf(cls, filename, n_jobs=None, srid=None, blacklist=('service',), intern_ids=False):
+        '''
+        Build the network directly from an OSM PBF file. See read_pbf().
+        :param intern_ids: If True, replace the node and edge IDs with integers (see StreetNet.intern_ids).
+        '''
+        data = read_pbf(filename, blacklist=blacklist, n_jobs=n_jobs)
+        obj = cls(srid=srid)
+        obj.build_network(data, blacklist=blacklist)
+        obj.build_posdict(data)
+        obj.build_routing_network()
+        if intern_ids:
+            obj.intern_ids()
+        return obj
     
     def build_network(self,
                       data,
@@ -138,11 +316,11 @@ class OSMStreetNet(StreetNet):
                 g_raw.add_edge(way.nds[i], way.nds[i+1])
 
         # add node locations to the raw network
-        for v in g_raw:
-            if self.srid is not None:
-                g_raw.node[v]['loc'] = pyproj.transform(self.input_proj, self.output_proj, *data.nodes[v].lonlat)
-            else:
-                g_raw.node[v]['loc'] = data.nodes[v].lonlat
+        # all nodes are projected in one call; the result is kept so that build_posdict can reuse it
+        node_ids = g_raw.nodes()
+        self._node_locs = dict(zip(node_ids, self.project(data.lonlat(node_ids))))
+        for v in node_ids:
+            g_raw.node[v]['loc'] = self._node_locs[v]
 
         g = nx.MultiGraph()
 
@@ -221,16 +399,27 @@ class OSMStreetNet(StreetNet):
         '''
         Each node gets an attribute added for its geometric position.
         '''
+        # reuse the locations computed in build_network if possible; this cache is only needed once
+        node_locs = getattr(self, '_node_locs', None)
+        if node_locs is None:
+            node_ids = self.g.nodes()
+            node_locs = dict(zip(node_ids, self.project(data.lonlat(node_ids))))
         for node_id in self.g:
-            try:
-                lon, lat = data.nodes[node_id].lonlat
-                if self.srid is not None:
-                    x, y = pyproj.transform(self.input_proj, self.output_proj, lon, lat)
-                else:
-                    x, y = lon, lat
-                self.g.node[node_id]['loc'] = (x, y)
-            except KeyError:
-                import ipdb; ipdb.set_trace()
+            self.g.node[node_id]['loc'] = node_locs[node_id]
+        self._node_locs = None
+
+    def project(self, lonlat):
+        '''
+        Project an (N, 2) array of lon, lat to the output srid in a single vectorised call.
+        :return: List of (x, y) tuples
+        '''
+        lonlat = np.asarray(lonlat, dtype=float).reshape(-1, 2)
+        if self.srid is not None:
+            x, y = pyproj.transform(self.input_proj, self.output_proj, lonlat[:, 0], lonlat[:, 1])
+            xy = np.column_stack((x, y))
+        else:
+            xy = lonlat
+        return [tuple(t) for t in xy.tolist()]
 
     
     def build_routing_network(self):
@@ -339,13 +528,131 @@ class OSMStreetNet(StreetNet):
 #        # plt.close('all')
 
 
-def read_data(filename):
-    CurrentHandler = OSMHandler()
-    sax.parse(filename, CurrentHandler)
+# bump this whenever a change to OSMHandler alters its output, so that cached parses are discarded
+PARSER_VERSION = 1
+
+# how each entity class is laid out in the parse cache: (OSMData attribute, class, geometry attribute, kind)
+CACHE_SCHEMA = [
+    ('nodes', Node, 'lonlat', 'point'),
+    ('ways', Way, 'nds', 'strings'),
+    ('relations', Relation, 'members', 'strings'),
+]
+
+
+def read_data(filename, bbox=None, polygon=None, feature_types=None, threaded=False, cache_dir=None):
+    """
+    Parse an OSM XML file into an OSMData instance.
+    :param filename: Path or file-like object. gzip and bzip2 compressed input (e.g. .osm.bz2 extracts) is
+    decompressed as it is parsed (see fileio.open_input).
+    :param bbox: Optional (lon_min, lat_min, lon_max, lat_max). If supplied, only features in this box are kept (see
+    OSMSpatialFilter).
+    :param polygon: Optional Polygon (or sequence of vertices) in lon, lat, used in the same way as bbox.
+    :param feature_types: Optional iterable of element names to keep ('node', 'way', 'relation'). Other elements are
+    skipped without being parsed.
+    :param threaded: If True, decompression runs on a separate thread, overlapping with parsing.
+    :param cache_dir: Optional directory holding cached parses (see cache.py). If filename is a path, a previous
+    parse of the same file content with the same options is loaded from here if present; otherwise the result is
+    saved here.
+    """
+    key = None
+    if cache_dir is not None and isinstance(filename, basestring):
+        key = cache.cache_key(filename, 'osm', PARSER_VERSION, bbox=bbox, polygon=polygon,
+                              feature_types=sorted(feature_types) if feature_types is not None else None)
+        stores = cache.load(cache_dir, key, CACHE_SCHEMA)
+        if stores is not None:
+            return OSMData(**stores)
+
+    CurrentHandler = OSMHandler(feature_types=feature_types)
+    if bbox is not None or polygon is not None:
+        CurrentHandler.callback = OSMSpatialFilter(CurrentHandler.store, bbox=bbox, polygon=polygon)
+    with open_input(filename, threaded=threaded) as f:
+        sax.parse(f, CurrentHandler)
+    if CurrentHandler.callback is not None:
+        CurrentHandler.callback.close()
     res = OSMData(CurrentHandler.nodes, CurrentHandler.ways, CurrentHandler.relations)
+    if key is not None:
+        cache.save(cache_dir, key, CACHE_SCHEMA, vars(res))
     return res
 
 
+def read_highway_data(filename, blacklist=('service',), threaded=False):
+    """
+    Read only what OSMStreetNet needs from an OSM file, in two passes. The first pass reads the ways and keeps those
+    with a highway tag that is not in the blacklist, collecting the IDs of the nodes they reference. The second pass
+    records the coordinates of just those nodes in a compact array. All other nodes (building outlines, POIs, ...)
+    are never stored.
+    :param filename: Path to the file, optionally gzip or bzip2 compressed. Not a file-like object, since it is
+    read twice.
+    :param blacklist: Highway types to exclude. Should match the blacklist later passed to
+    OSMStreetNet.build_network.
+    :param threaded: If True, decompression runs on a separate thread, overlapping with parsing.
+    :return: OSMHighwayData instance
+    """
+    ways = {}
+    refs = set()
+
+    def collect_highway(way):
+        if 'highway' in way.tags and way.tags['highway'] not in blacklist:
+            ways[way.feature_id] = way
+            refs.update(way.nds)
+
+    with open_input(filename, threaded=threaded) as f:
+        sax.parse(f, OSMHandler(callback=collect_highway, feature_types=('way',)))
+
+    handler = OSMNodeCoordHandler(refs)
+    with open_input(filename, threaded=threaded) as f:
+        sax.parse(f, handler)
+    node_ids = np.frombuffer(handler.ids, dtype=np.int64 if handler.ids.itemsize == 8 else np.int32)
+    node_lonlat = np.frombuffer(handler.coords, dtype=float).reshape(-1, 2)
+    sort_idx = np.argsort(node_ids)
+
+    return OSMHighwayData(ways, node_ids[sort_idx], node_lonlat[sort_idx])
+
+
+def read_pbf(filename, blacklist=('service',), n_jobs=None):
+    """
+    Read the highway ways and the nodes they reference from an OSM PBF file. Data blocks are decompressed and decoded
+    in parallel by a pool of worker processes; the results are merged into the same compact structure returned by
+    read_highway_data().
+    :param blacklist: Highway types to exclude, as for read_highway_data().
+    :param n_jobs: Number of worker processes. Defaults to the number of CPUs. If 1, blocks are decoded serially.
+    :return: OSMHighwayData instance
+    """
+    n_jobs = n_jobs or mp.cpu_count()
+    ways = {}
+    node_ids = []
+    node_lonlat = []
+
+    with open(filename, 'rb') as f:
+        args = ((blob, blacklist) for blob_type, blob in pbf.iter_blobs(f) if blob_type == 'OSMData')
+        if n_jobs == 1:
+            results = map(pbf.decode_data_blob, args)
+        else:
+            pool = mp.Pool(n_jobs)
+            try:
+                results = list(pool.imap(pbf.decode_data_blob, args))
+            finally:
+                pool.close()
+                pool.join()
+
+    for ids, lonlat, block_ways in results:
+        # nodes that no highway references are discarded once all ways are known
+        node_ids.append(ids)
+        node_lonlat.append(lonlat)
+        for way_id, refs, tags in block_ways:
+            ways[way_id] = Way(way_id, refs, tags)
+
+    node_ids = np.concatenate(node_ids) if node_ids else np.zeros(0, dtype=np.int64)
+    node_lonlat = np.concatenate(node_lonlat) if node_lonlat else np.zeros((0, 2))
+    refs = np.unique(np.array([int(t) for way in ways.itervalues() for t in way.nds], dtype=np.int64))
+    keep = np.in1d(node_ids, refs)
+    node_ids = node_ids[keep]
+    node_lonlat = node_lonlat[keep]
+    sort_idx = np.argsort(node_ids)
+
+    return OSMHighwayData(ways, node_ids[sort_idx], node_lonlat[sort_idx])
+
+
 if __name__ == '__main__':
     import os
     import matplotlib.pyplot as plt
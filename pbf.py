@@ -0,0 +1,345 @@
+__author__ = 'gabriel'
+"""
+Minimal reader (and fixture writer) for the OpenStreetMap PBF format.
+
+This works directly on the protobuf wire format, so no generated protobuf classes or
+compiled OSM libraries are needed. Only the parts required to build a street network
+are decoded: dense and plain nodes (ID and coordinates) and ways (ID, tags and node refs).
+Relations, metadata and node tags are skipped. The packed arrays that make up the bulk
+of the data are decoded with NumPy rather than one varint at a time.
+
+File layout: a sequence of (4 byte length, BlobHeader, Blob) records. Each Blob holds a
+zlib-compressed HeaderBlock or PrimitiveBlock. See http://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+import struct
+import zlib
+import numpy as np
+
+# protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Blob fields holding data compressed with methods other than zlib
+BLOB_COMPRESSION = {
+    4: 'lzma',
+    5: 'bzip2',
+    6: 'lz4',
+    7: 'zstd',
+}
+
+# maximum number of entities written per PrimitiveBlock (as recommended by the format spec)
+BLOCK_SIZE = 8000
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def to_int64(value):
+    """ Convert a decoded (unsigned) varint to a signed int64 """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def zigzag(value):
+    """ Decode a scalar sint64 """
+    return (value >> 1) ^ -(value & 1)
+
+
+def iter_fields(buf, start=0, end=None):
+    """
+    Iterate over the fields of a protobuf message held in buf[start:end].
+    :param buf: bytearray
+    :return: Generator of (field number, wire type, value) tuples. For varints the value is the (unsigned) integer,
+    otherwise it is a (start, end) tuple giving the location of the payload in buf.
+    """
+    end = len(buf) if end is None else end
+    pos = start
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == FIXED64:
+            value = (pos, pos + 8)
+            pos += 8
+        elif wire_type == FIXED32:
+            value = (pos, pos + 4)
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield field, wire_type, value
+
+
+def packed_varints(buf, span):
+    """
+    Decode a packed repeated varint field in one go.
+    :param span: (start, end) location of the payload in buf.
+    :return: uint64 array
+    """
+    start, end = span
+    b = np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start)
+    if not b.size:
+        return np.zeros(0, dtype=np.uint64)
+    last = b < 0x80
+    starts = np.concatenate(([0], np.flatnonzero(last)[:-1] + 1))
+    # the position of each byte within its varint
+    group = np.concatenate(([0], np.cumsum(last[:-1])))
+    shift = (7 * (np.arange(b.size) - starts[group])).astype(np.uint64)
+    return np.add.reduceat((b & 0x7f).astype(np.uint64) << shift, starts)
+
+
+def packed_sint64(buf, span):
+    """ Decode a packed repeated sint64 field """
+    v = packed_varints(buf, span)
+    return (v >> np.uint64(1)).astype(np.int64) ^ -(v & np.uint64(1)).astype(np.int64)
+
+
+def iter_blobs(f):
+    """
+    Iterate over the blobs in an open PBF file.
+    :return: Generator of (blob type, raw blob bytes) tuples. The type is 'OSMHeader' or 'OSMData'.
+    """
+    while True:
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        header = bytearray(f.read(struct.unpack('>i', head)[0]))
+        blob_type = None
+        datasize = None
+        for field, _, value in iter_fields(header):
+            if field == 1:
+                blob_type = str(header[value[0]:value[1]])
+            elif field == 3:
+                datasize = value
+        yield blob_type, f.read(datasize)
+
+
+def decode_blob(blob):
+    """
+    Extract the (uncompressed) block from a raw blob.
+    :return: bytearray
+    """
+    buf = bytearray(blob)
+    for field, _, value in iter_fields(buf):
+        if field == 1:
+            return buf[value[0]:value[1]]
+        elif field == 3:
+            return bytearray(zlib.decompress(str(buf[value[0]:value[1]])))
+        elif field in BLOB_COMPRESSION:
+            raise ValueError("Unsupported PBF blob compression %s: only raw and zlib blobs can be read"
+                             % BLOB_COMPRESSION[field])
+    # any other compression method is unknown to the format spec
+    raise ValueError("Unrecognised PBF blob: no raw or zlib compressed data found")
+
+
+def decode_primitive_block(buf, highway_blacklist=None):
+    """
+    Decode the nodes and ways of a PrimitiveBlock.
+    :param buf: bytearray containing the uncompressed block
+    :param highway_blacklist: Optional. If supplied, only ways with a highway tag that is not in this list are returned.
+    :return: (node_ids, node_lonlat, ways). node_ids is an int64 array, node_lonlat the corresponding (N, 2) array
+    and ways a list of (way ID, list of node refs, tag dict) tuples. IDs are returned as strings, matching the XML
+    reader.
+    """
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = 0
+    lon_offset = 0
+
+    for field, _, value in iter_fields(buf):
+        if field == 1:
+            strings = [buf[s:e].decode('utf-8') for _, _, (s, e) in iter_fields(buf, *value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = to_int64(value)
+        elif field == 20:
+            lon_offset = to_int64(value)
+
+    node_ids = []
+    node_lat = []
+    node_lon = []
+    ways = []
+
+    for group in groups:
+        for field, _, value in iter_fields(buf, *group):
+            if field == 1:
+                # plain Node
+                nid = lat = lon = 0
+                for f, _, v in iter_fields(buf, *value):
+                    if f == 1:
+                        nid = zigzag(v)
+                    elif f == 8:
+                        lat = zigzag(v)
+                    elif f == 9:
+                        lon = zigzag(v)
+                node_ids.append(np.array([nid], dtype=np.int64))
+                node_lat.append(np.array([lat], dtype=np.int64))
+                node_lon.append(np.array([lon], dtype=np.int64))
+
+            elif field == 2:
+                # DenseNodes: IDs and coordinates are delta coded
+                for f, _, v in iter_fields(buf, *value):
+                    if f == 1:
+                        node_ids.append(np.cumsum(packed_sint64(buf, v)))
+                    elif f == 8:
+                        node_lat.append(np.cumsum(packed_sint64(buf, v)))
+                    elif f == 9:
+                        node_lon.append(np.cumsum(packed_sint64(buf, v)))
+
+            elif field == 3:
+                # Way
+                wid = 0
+                keys = vals = refs = None
+                for f, _, v in iter_fields(buf, *value):
+                    if f == 1:
+                        wid = to_int64(v)
+                    elif f == 2:
+                        keys = packed_varints(buf, v)
+                    elif f == 3:
+                        vals = packed_varints(buf, v)
+                    elif f == 8:
+                        refs = np.cumsum(packed_sint64(buf, v))
+                tags = {}
+                if keys is not None:
+                    tags = dict((strings[k], strings[j]) for k, j in zip(keys, vals))
+                if highway_blacklist is not None:
+                    if 'highway' not in tags or tags['highway'] in highway_blacklist:
+                        continue
+                nds = [str(t) for t in refs] if refs is not None else []
+                ways.append((str(wid), nds, tags))
+
+    if node_ids:
+        ids = np.concatenate(node_ids)
+        lonlat = 1e-9 * np.column_stack((
+            lon_offset + granularity * np.concatenate(node_lon),
+            lat_offset + granularity * np.concatenate(node_lat),
+        ))
+    else:
+        ids = np.zeros(0, dtype=np.int64)
+        lonlat = np.zeros((0, 2))
+
+    return ids, lonlat, ways
+
+
+def decode_data_blob(args):
+    """
+    Decompress and decode a single OSMData blob. Takes a single (blob, highway_blacklist) tuple so that it can be
+    mapped over a process pool.
+    """
+    blob, highway_blacklist = args
+    return decode_primitive_block(decode_blob(blob), highway_blacklist=highway_blacklist)
+
+
+## Writing. This is only intended for generating small test fixtures from an OSMData instance.
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return out
+
+
+def encode_zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def field_varint(field, value):
+    return encode_varint(field << 3 | VARINT) + encode_varint(value)
+
+
+def field_bytes(field, payload):
+    return encode_varint(field << 3 | LENGTH_DELIMITED) + encode_varint(len(payload)) + bytearray(payload)
+
+
+def field_packed(field, values):
+    payload = bytearray()
+    for v in values:
+        payload += encode_varint(v)
+    return field_bytes(field, payload)
+
+
+def delta(values):
+    return [encode_zigzag(int(t)) for t in np.diff(np.concatenate(([0], values)))]
+
+
+def write_blob(f, blob_type, block):
+    blob = field_varint(2, len(block)) + field_bytes(3, zlib.compress(str(block)))
+    header = field_bytes(1, blob_type) + field_varint(3, len(blob))
+    f.write(struct.pack('>i', len(header)))
+    f.write(str(header))
+    f.write(str(blob))
+
+
+def write_pbf(filename, data, granularity=100):
+    """
+    Write the nodes and ways of an OSMData instance to a PBF file, using dense nodes. Node tags and relations are not
+    written.
+    """
+    blocks = []
+    header_block = field_bytes(4, 'OsmSchema-V0.6') + field_bytes(4, 'DenseNodes')
+    blocks.append(('OSMHeader', header_block))
+
+    node_ids = sorted(data.nodes, key=int)
+    for i in range(0, len(node_ids), BLOCK_SIZE):
+        chunk = node_ids[i:(i + BLOCK_SIZE)]
+        ids = [int(t) for t in chunk]
+        lat = [int(round(data.nodes[t].lat * 1e9 / granularity)) for t in chunk]
+        lon = [int(round(data.nodes[t].lon * 1e9 / granularity)) for t in chunk]
+        dense = field_packed(1, delta(ids)) + field_packed(8, delta(lat)) + field_packed(9, delta(lon))
+        block = field_bytes(1, field_bytes(1, '')) + field_bytes(2, field_bytes(2, dense))
+        if granularity != 100:
+            block += field_varint(17, granularity)
+        blocks.append(('OSMData', block))
+
+    way_ids = sorted(data.ways, key=int)
+    for i in range(0, len(way_ids), BLOCK_SIZE):
+        strings = ['']
+        string_idx = {}
+
+        def sid(s):
+            if s not in string_idx:
+                string_idx[s] = len(strings)
+                strings.append(s)
+            return string_idx[s]
+
+        group = bytearray()
+        for wid in way_ids[i:(i + BLOCK_SIZE)]:
+            way = data.ways[wid]
+            keys = [sid(k) for k in way.tags]
+            vals = [sid(way.tags[k]) for k in way.tags]
+            msg = field_varint(1, int(wid)) + field_packed(2, keys) + field_packed(3, vals)
+            msg += field_packed(8, delta([int(t) for t in way.nds]))
+            group += field_bytes(3, msg)
+
+        string_table = bytearray()
+        for s in strings:
+            string_table += field_bytes(1, s.encode('utf-8'))
+        block = field_bytes(1, string_table) + field_bytes(2, group)
+        blocks.append(('OSMData', block))
+
+    with open(filename, 'wb') as f:
+        for blob_type, block in blocks:
+            write_blob(f, blob_type, block)
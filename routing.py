@@ -0,0 +1,210 @@
+__author__ = 'gabriel'
+"""
+Graph searches that do not depend on how the graph is stored.
+
+The graph is described by a neighbours callable, which takes a node and returns an iterable of
+(next node, edge key, edge length) tuples. Searches start from a set of seed nodes, each with an initial distance,
+and may finish at a set of target nodes, each with a final distance to add. This is how points part way along an
+edge are handled: rather than splitting the edge by inserting a temporary node into the graph, the point's
+distance to each end of its edge is used to seed (or finish) the search. The graph is never modified, so searches
+can safely run concurrently.
+
+A search may also be given a heuristic: a lower bound on the remaining distance from a node to the targets. The
+search then becomes A*, which settles far fewer nodes when the targets are known. The heuristic must be consistent
+(e.g. the straight-line distance, when no edge is shorter than the straight line between its ends), otherwise the
+route found may not be the shortest.
+
+A bidirectional search needs a second callable giving the edges that arrive at a node, so that it can search
+backwards from the targets at the same time as forwards from the seeds. For an undirected graph this is the same as
+neighbours.
+"""
+import heapq
+import math
+
+
+def dijkstra(neighbours, sources, targets=None, cutoff=None, until=None, heuristic=None):
+    """
+    Single-source (or multi-seed) Dijkstra search, or A* search if a heuristic is supplied.
+    :param neighbours: Callable, node -> iterable of (next node, edge key, edge length).
+    :param sources: Dictionary of seed node: initial distance.
+    :param targets: Optional dictionary of target node: final distance. If supplied, the search stops as soon as the
+    shortest route to any target (including its final distance) is known.
+    :param cutoff: Optional. Nodes further than this are not explored. With a heuristic, nodes are not explored if
+    the distance plus the heuristic exceeds this.
+    :param until: Optional collection of nodes. If supplied, the search stops once all of them have been settled.
+    :param heuristic: Optional callable, node -> lower bound on the distance from that node to the targets.
+    :return: (dist, pred). dist is a dictionary of settled node: distance. pred is a dictionary of node:
+    (previous node, edge key, edge length), with None for seed nodes.
+    """
+    dist = {}
+    pred = {}
+    seen = {}
+    heap = []
+    counter = 0
+    for node, d in sources.iteritems():
+        if node not in seen or d < seen[node]:
+            seen[node] = d
+            pred[node] = None
+            heapq.heappush(heap, (d if heuristic is None else d + heuristic(node), counter, node))
+            counter += 1
+
+    best = float('inf')
+    remaining = set(until) if until is not None else None
+    while heap:
+        f, _, u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        # f is a lower bound on the length of any route through u
+        if f >= best:
+            break
+        d = seen[u]
+        dist[u] = d
+        if targets is not None and u in targets:
+            best = min(best, d + targets[u])
+        if remaining is not None:
+            remaining.discard(u)
+            if not remaining:
+                break
+        for v, key, length in neighbours(u):
+            dv = d + length
+            if v not in dist and (v not in seen or dv < seen[v]):
+                fv = dv if heuristic is None else dv + heuristic(v)
+                # with a heuristic, fv bounds the length of any route to a target through v
+                if cutoff is not None and fv > cutoff:
+                    continue
+                seen[v] = dv
+                pred[v] = (u, key, length)
+                heapq.heappush(heap, (fv, counter, v))
+                counter += 1
+
+    return dist, pred
+
+
+def euclidean_heuristic(loc, targets):
+    """
+    Straight-line distance heuristic for A* search.
+    :param loc: Callable, node -> (x, y).
+    :param targets: Dictionary of target node: final distance, as for dijkstra().
+    :return: Callable, node -> the smallest straight-line distance to a target plus its final distance.
+    """
+    ends = [tuple(loc(t)) + (d,) for t, d in targets.iteritems()]
+
+    def heuristic(node):
+        x, y = loc(node)
+        return min(math.hypot(x - tx, y - ty) + d for tx, ty, d in ends)
+
+    return heuristic
+
+
+def shortest_path(neighbours, sources, targets, cutoff=None, heuristic=None):
+    """
+    Shortest route from any of the seeds to any of the targets.
+    :param sources, targets, cutoff, heuristic: As for dijkstra(). targets is required.
+    :return: (distance, nodes, edges, lengths) or None if no target can be reached. nodes lists every node traversed,
+    from the seed to the target inclusive, and edges and lengths the key and length of each edge between consecutive
+    nodes.
+    """
+    dist, pred = dijkstra(neighbours, sources, targets=targets, cutoff=cutoff, heuristic=heuristic)
+    reached = [t for t in targets if t in dist]
+    if not reached:
+        return None
+    end = min(reached, key=lambda t: dist[t] + targets[t])
+    total = dist[end] + targets[end]
+    if cutoff is not None and total > cutoff:
+        return None
+    nodes = [end]
+    edges = []
+    lengths = []
+    while pred[nodes[-1]] is not None:
+        u, key, length = pred[nodes[-1]]
+        nodes.append(u)
+        edges.append(key)
+        lengths.append(length)
+    return total, nodes[::-1], edges[::-1], lengths[::-1]
+
+
+def bidirectional_shortest_path(neighbours, reverse_neighbours, sources, targets, cutoff=None):
+    """
+    Shortest route from any of the seeds to any of the targets, searching forwards from the seeds and backwards from
+    the targets until the two searches meet. Each search only needs to reach about half way, so far fewer nodes are
+    settled than by dijkstra().
+    :param neighbours: Callable, node -> iterable of (next node, edge key, edge length) for the edges leaving a node.
+    :param reverse_neighbours: Callable, node -> iterable of (previous node, edge key, edge length) for the edges
+    arriving at a node.
+    :param sources, targets, cutoff: As for shortest_path().
+    :return: As for shortest_path().
+    """
+    # side 0 searches forwards from the sources, side 1 backwards from the targets
+    nbrs = (neighbours, reverse_neighbours)
+    seen = ({}, {})
+    pred = ({}, {})
+    heaps = ([], [])
+    done = (set(), set())
+    counter = 0
+    for side, init in enumerate((sources, targets)):
+        for node, d in init.iteritems():
+            if node not in seen[side] or d < seen[side][node]:
+                seen[side][node] = d
+                pred[side][node] = None
+                heapq.heappush(heaps[side], (d, counter, node))
+                counter += 1
+
+    if cutoff is None:
+        cutoff = float('inf')
+    best = float('inf')
+    meet = None
+    for node, d in seen[0].iteritems():
+        if node in seen[1] and d + seen[1][node] < best:
+            best = d + seen[1][node]
+            meet = node
+
+    h0, h1 = heaps
+    while h0 or h1:
+        # every route not yet found is at least as long as the sum of the tops of the heaps. Once one search has
+        # run out of nodes the other carries on alone, with that search contributing nothing to the bound.
+        t0 = h0[0][0] if h0 else 0.
+        t1 = h1[0][0] if h1 else 0.
+        if t0 + t1 >= best or t0 + t1 > cutoff:
+            break
+        side = 0 if h0 and (not h1 or t0 <= t1) else 1
+        heap = heaps[side]
+        d, _, u = heapq.heappop(heap)
+        this_done = done[side]
+        if u in this_done:
+            continue
+        this_done.add(u)
+        this_seen = seen[side]
+        this_pred = pred[side]
+        other = seen[1 - side]
+        for v, key, length in nbrs[side](u):
+            dv = d + length
+            if dv > cutoff or v in this_done or dv >= this_seen.get(v, cutoff + 1.):
+                continue
+            this_seen[v] = dv
+            this_pred[v] = (u, key, length)
+            heapq.heappush(heap, (dv, counter, v))
+            counter += 1
+            if v in other and dv + other[v] < best:
+                best = dv + other[v]
+                meet = v
+
+    if meet is None or best > cutoff:
+        return None
+
+    nodes = [meet]
+    edges = []
+    lengths = []
+    while pred[0][nodes[-1]] is not None:
+        u, key, length = pred[0][nodes[-1]]
+        nodes.append(u)
+        edges.append(key)
+        lengths.append(length)
+    nodes.reverse()
+    edges.reverse()
+    lengths.reverse()
+    while pred[1][nodes[-1]] is not None:
+        u, key, length = pred[1][nodes[-1]]
+        nodes.append(u)
+        edges.append(key)
+        lengths.append(length)
+    return best, nodes, edges, lengths
@@ -0,0 +1,165 @@
+__author__ = 'gabriel'
+"""
+Binary snapshot format for StreetNet, written by StreetNet.save(fmt='snapshot') and read by
+StreetNet.from_snapshot().
+
+A snapshot is a directory holding one .npy file per array plus a small JSON metadata file:
+
+    node_ids, node_id_offsets   node IDs, as one UTF-8 buffer with offsets
+    node_loc                    (N, 2) node coordinates
+    edge_fids, edge_fid_offsets edge FIDs, as for the node IDs
+    edge_nodes                  (E, 2) indices of the NODE0_KEY and NODE1_KEY (orientation_neg, orientation_pos) nodes
+    edge_length                 edge lengths
+    edge_oneway                 0 if travel is allowed in both directions, 1 if only neg -> pos, -1 if only pos -> neg
+    edge_coords, edge_coord_offsets   all polyline vertices in one (M, 2) buffer, with per-edge offsets
+    attr_<name>                 one column per remaining edge attribute (see below)
+    ch_<routing>_<name>         contraction hierarchies, if any have been built (see ch.py). Nodes and edges are
+                                referred to by their position in node_ids and edge_fids.
+
+Every file is a plain .npy array, so it can be memory-mapped: loading costs no copying and processes that open the
+same snapshot share the same pages. String attribute columns hold int32 codes into a per-column table
+(attr_<name>_strings); -1 marks a missing value. Numeric columns use NaN and boolean columns -1 for missing values.
+"""
+import os
+import json
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+META_FILE = 'meta.json'
+
+# attributes that are held in dedicated arrays rather than attribute columns (along with the edge ID and node keys)
+CORE_ATTRIBUTES = ('linestring', 'length')
+
+
+def encode_strings(strings):
+    data = [unicode(t).encode('utf-8') for t in strings]
+    offsets = np.cumsum([0] + [len(t) for t in data])
+    return np.array(bytearray(''.join(data)), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets):
+    buf = data.tostring()
+    offsets = offsets.tolist()
+    return [buf[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def column_type(values):
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, bool) for v in present):
+        return 'bool'
+    if all(isinstance(v, (int, long, float)) and not isinstance(v, bool) for v in present):
+        return 'float'
+    if all(isinstance(v, basestring) for v in present):
+        return 'string'
+    raise TypeError("Edge attribute values of type %s cannot be saved in a snapshot" %
+                    ', '.join(sorted(set(type(v).__name__ for v in present))))
+
+
+def to_arrays(net):
+    """
+    Encode a StreetNet as flat arrays. This is also used to build the CSR backend (see csr.CSRGraph).
+    :return: (meta, arrs), as for read().
+    """
+    node_ids = net.g.nodes()
+    node_idx = dict((t, i) for i, t in enumerate(node_ids))
+    edges = net.g.edges(keys=True, data=True)
+
+    # interned networks are saved with their original IDs and interned again when loaded
+    node_fid = net.node_table.to_fid if net.node_table is not None else lambda t: t
+    edge_fid = net.edge_table.to_fid if net.edge_table is not None else lambda t: t
+
+    arrs = {}
+    arrs['node_ids'], arrs['node_id_offsets'] = encode_strings([node_fid(t) for t in node_ids])
+    arrs['node_loc'] = np.array([net.g.node[t]['loc'] for t in node_ids], dtype=float).reshape(-1, 2)
+
+    fids = [attr[net.EDGE_ID_KEY] for _, _, _, attr in edges]
+    arrs['edge_fids'], arrs['edge_fid_offsets'] = encode_strings([edge_fid(t) for t in fids])
+    arrs['edge_nodes'] = np.array([(node_idx[attr[net.NODE0_KEY]], node_idx[attr[net.NODE1_KEY]])
+                                   for _, _, _, attr in edges], dtype=np.int32).reshape(-1, 2)
+    arrs['edge_length'] = np.array([attr['length'] for _, _, _, attr in edges], dtype=float)
+
+    # one-way status is read from the routing graph, so it does not depend on how each subclass tags it
+    oneway = []
+    for _, _, fid, attr in edges:
+        fwd = net.g_routing.has_edge(attr[net.NODE0_KEY], attr[net.NODE1_KEY], key=fid)
+        bwd = net.g_routing.has_edge(attr[net.NODE1_KEY], attr[net.NODE0_KEY], key=fid)
+        oneway.append(0 if fwd == bwd else (1 if fwd else -1))
+    arrs['edge_oneway'] = np.array(oneway, dtype=np.int8)
+
+    coords = [np.asarray(attr['linestring'].coords, dtype=float).reshape(-1, 2) for _, _, _, attr in edges]
+    arrs['edge_coords'] = np.concatenate(coords) if coords else np.zeros((0, 2))
+    arrs['edge_coord_offsets'] = np.cumsum([0] + [len(t) for t in coords])
+
+    columns = {}
+    names = set(k for _, _, _, attr in edges for k in attr).difference(
+        CORE_ATTRIBUTES + (net.EDGE_ID_KEY, net.NODE0_KEY, net.NODE1_KEY)
+    )
+    for name in sorted(names):
+        values = [attr.get(name) for _, _, _, attr in edges]
+        columns[name] = column_type(values)
+        if columns[name] == 'bool':
+            arrs['attr_' + name] = np.array([-1 if v is None else int(v) for v in values], dtype=np.int8)
+        elif columns[name] == 'float':
+            arrs['attr_' + name] = np.array([np.nan if v is None else v for v in values], dtype=float)
+        else:
+            table = sorted(set(v for v in values if v is not None))
+            code = dict((t, i) for i, t in enumerate(table))
+            arrs['attr_' + name] = np.array([-1 if v is None else code[v] for v in values], dtype=np.int32)
+            arrs['attr_%s_strings' % name], arrs['attr_%s_string_offsets' % name] = encode_strings(table)
+
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'class': net.__class__.__name__,
+        'srid': net.srid,
+        'directed': net.directed,
+        'interned': net.node_table is not None,
+        'columns': columns,
+        'arrays': sorted(arrs),
+    }
+    return meta, arrs
+
+
+def hierarchy_name(directed):
+    return 'directed' if directed else 'undirected'
+
+
+def write(net, path):
+    """
+    Write a StreetNet to a snapshot directory, which is created if necessary.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    meta, arrs = to_arrays(net)
+
+    # contraction hierarchies, with nodes and edges numbered as in the snapshot (i.e. in the order used by to_arrays)
+    meta['hierarchies'] = []
+    if net._ch:
+        node_idx = dict((t, i) for i, t in enumerate(net.g.nodes()))
+        edge_idx = dict((fid, i) for i, (_, _, fid) in enumerate(net.g.edges(keys=True)))
+        for directed, hierarchy in net._ch.items():
+            name = hierarchy_name(directed)
+            for k, arr in hierarchy.to_arrays(node_idx.__getitem__, edge_idx.__getitem__).items():
+                arrs['ch_%s_%s' % (name, k)] = arr
+            meta['hierarchies'].append(name)
+        meta['arrays'] = sorted(arrs)
+    for name, arr in arrs.items():
+        np.save(os.path.join(path, name + '.npy'), arr)
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def read(path, mmap_mode='r'):
+    """
+    Open a snapshot directory.
+    :param mmap_mode: Passed to np.load. The default maps the arrays read-only; use None to read them into memory.
+    :return: (meta, arrs). meta is the metadata dictionary and arrs a dictionary of (memory-mapped) arrays.
+    """
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version %s" % meta['version'])
+    arrs = dict(
+        (name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)) for name in meta['arrays']
+    )
+    return meta, arrs
+
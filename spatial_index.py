@@ -0,0 +1,64 @@
+__author__ = 'gabriel'
+"""
+R-tree index over the edges and nodes of a network (see StreetNet.spatial_index), so that spatial queries only test
+the edges and nodes whose bounding boxes meet the query geometry, rather than all of them.
+
+The trees are shapely STRtrees (sort-tile-recursive packed R-trees), which are built in one go and cannot be updated,
+so the index is rebuilt if the network changes. A query returns the indexed geometries themselves; these are mapped
+back to edges and nodes by object identity.
+"""
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+class SpatialIndex(object):
+
+    def __init__(self, edges, nodes):
+        """
+        :param edges: List of (neg node ID, pos node ID, FID, linestring).
+        :param nodes: List of (node ID, (x, y)).
+        """
+        self.edges = list(edges)
+        self.nodes = [(t, tuple(loc)) for t, loc in nodes]
+        self.build_trees()
+
+    def __getstate__(self):
+        # the trees are rebuilt when loading
+        return {'edges': self.edges, 'nodes': self.nodes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_trees()
+
+    def build_trees(self):
+        lines = [t[3] for t in self.edges]
+        points = [Point(*loc) for _, loc in self.nodes]
+        self.edge_tree = STRtree(lines)
+        self.node_tree = STRtree(points)
+        # the trees keep a reference to every geometry, so their ids are not reused
+        self.edge_lookup = dict((id(ls), k) for k, ls in enumerate(lines))
+        self.node_lookup = dict((id(pt), k) for k, pt in enumerate(points))
+
+    def edge_candidates(self, geom):
+        """
+        :return: Sorted indices of the edges whose bounding boxes intersect that of geom.
+        """
+        return sorted(self.edge_lookup[id(t)] for t in self.edge_tree.query(geom))
+
+    def edges_intersecting(self, geom):
+        """
+        :return: List of (neg node ID, pos node ID, FID, linestring) for the edges that intersect geom, in the order
+        in which they were indexed.
+        """
+        geom_prep = prep(geom)
+        return [self.edges[k] for k in self.edge_candidates(geom) if geom_prep.intersects(self.edges[k][3])]
+
+    def nodes_intersecting(self, geom):
+        """
+        :return: List of (node ID, (x, y)) for the nodes that intersect geom, in the order in which they were
+        indexed.
+        """
+        geom_prep = prep(geom)
+        res = sorted(self.node_lookup[id(t)] for t in self.node_tree.query(geom) if geom_prep.intersects(t))
+        return [self.nodes[k] for k in res]
@@ -2,6 +2,7 @@ __author__ = 'Toby, refactor by Gabs'
 
 from shapely.geometry import Point, LineString, Polygon, MultiLineString
 from shapely import geometry
+from shapely.prepared import prep
 import networkx as nx
 import cPickle
 import scipy as sp
@@ -11,6 +12,19 @@ import bisect as bs
 import pysal as psl
 import copy
 import math
+import operator
+import time
+import multiprocessing as mp
+from scipy import sparse
+import snapshot
+import routing
+from csr import CSRGraph
+from ch import ContractionHierarchy
+from landmarks import Landmarks
+from chains import ChainOverlay
+from spatial_index import SpatialIndex
+import distance_table
+from distance_cache import DistanceCache
 
 try:
     import matplotlib.pyplot as plt
@@ -37,9 +51,9 @@ class Edge(object):
         assert orientation_pos is not None, "Positive node ID not provided"
         assert fid is not None, "Edge ID not provided"
         if verify:
-            assert orientation_neg in street_net.g.node, "Negative node ID %s not found" % orientation_neg
-            assert orientation_pos in street_net.g.node, "Positive node ID %s not found" % orientation_pos
-            assert fid in street_net.g.edge[orientation_neg][orientation_pos], "Edge ID %s not found" % fid
+            assert street_net.has_node(orientation_neg), "Negative node ID %s not found" % orientation_neg
+            assert street_net.has_node(orientation_pos), "Positive node ID %s not found" % orientation_pos
+            assert street_net.has_edge(orientation_neg, orientation_pos, fid), "Edge ID %s not found" % fid
         self.graph = street_net
         self.orientation_neg = orientation_neg
         self.orientation_pos = orientation_pos
@@ -64,11 +78,11 @@ class Edge(object):
 
     @property
     def attrs(self):
-        return self.graph.g.edge[self.orientation_neg][self.orientation_pos][self.fid]
+        return self.graph.edge_attrs(self.orientation_neg, self.orientation_pos, self.fid)
 
     @property
     def linestring(self):
-        return self.attrs['linestring']
+        return self.graph.edge_linestring(self.orientation_neg, self.orientation_pos, self.fid)
 
     # ADDED BY KK
     @property
@@ -79,7 +93,7 @@ class Edge(object):
 
     @property
     def length(self):
-        return self.attrs['length']
+        return self.graph.edge_length(self.orientation_neg, self.orientation_pos, self.fid)
 
     @property
     def centroid(self):
@@ -101,11 +115,11 @@ class Edge(object):
 
     @property
     def node_pos_coords(self):
-        return self.graph.g.node[self.orientation_pos]['loc']
+        return self.graph.node_loc(self.orientation_pos)
 
     @property
     def node_neg_coords(self):
-        return self.graph.g.node[self.orientation_neg]['loc']
+        return self.graph.node_loc(self.orientation_neg)
 
     ## ADDED BY KK
     def plot_edge(self):
@@ -247,7 +261,7 @@ class NetPoint(object):
 
     @property
     def cartesian_coords(self):
-        ls = self.edge['linestring']
+        ls = self.edge.linestring
         pt = ls.interpolate(self.node_dist[self.edge.orientation_neg])
         return pt.x, pt.y
 
@@ -273,17 +287,16 @@ class NetPoint(object):
         else:
             return self.graph.path_undirected(self, other)
 
-    def distance(self, other, method=None):
+    def distance(self, other, method=None, cutoff=None):
         """
         NetPoint.distance(NetPoint) -> scalar distance
         :param method: optionally specify the algorithm used to compute distance.
+        :param cutoff: optionally stop searching beyond this distance, returning np.inf.
         """
         if self.graph.directed:
-            # TODO: update the path_directed method to accept length_only kwarg
-            # return self.graph.path_directed(self, other, length_only=True, method=method)
-            return (self - other).length
+            return self.graph.path_directed(self, other, length_only=True, method=method, cutoff=cutoff)
         else:
-            return self.graph.path_undirected(self, other, length_only=True, method=method)
+            return self.graph.path_undirected(self, other, length_only=True, method=method, cutoff=cutoff)
 
 
     def euclidean_distance(self, other):
@@ -394,7 +407,7 @@ class NetPath(object):
     @property
     def splits(self):
         if self._splits is None:
-            self._splits = [max(self.graph.g.degree(t) - 1, 1) for t in self.nodes]
+            self._splits = [max(self.graph.degree(t) - 1, 1) for t in self.nodes]
         return self._splits
 
     @property
@@ -418,6 +431,138 @@ class GridEdgeIndex(object):
         self.edge_index = edge_index
 
 
+class IdTable(object):
+
+    def __init__(self, fids):
+        """
+        Bidirectional lookup between the original node or edge IDs (FIDs) of a network and the dense integers that
+        replace them once the network is interned (see StreetNet.intern_ids).
+        :param fids: Iterable of FIDs. The integer ID of each is its position.
+        """
+        self.fids = list(fids)
+        self.index = dict((t, i) for i, t in enumerate(self.fids))
+
+    def __len__(self):
+        return len(self.fids)
+
+    def to_fid(self, i):
+        return self.fids[i]
+
+    def to_int(self, fid):
+        return self.index[fid]
+
+    def add(self, fid):
+        """
+        Get the integer ID of a FID, assigning a new one if necessary.
+        """
+        if fid not in self.index:
+            self.index[fid] = len(self.fids)
+            self.fids.append(fid)
+        return self.index[fid]
+
+    def copy(self):
+        return self.__class__(self.fids)
+
+
+class BoundingRegion(object):
+
+    def __init__(self, bbox=None, polygon=None):
+        """
+        A region used to filter features by location while they are being parsed, before any network is built.
+        Cheap bounding box tests are applied first; the (prepared) polygon is only consulted for features whose
+        envelope overlaps the box.
+        :param bbox: Optional (xmin, ymin, xmax, ymax) tuple.
+        :param polygon: Optional shapely Polygon or sequence of vertices. If both are supplied, features must lie in
+        both.
+        """
+        if bbox is None and polygon is None:
+            raise AttributeError("Must supply either bbox or polygon")
+        if polygon is not None and not hasattr(polygon, 'geom_type'):
+            polygon = Polygon(polygon)
+        if bbox is None:
+            bbox = polygon.bounds
+        elif polygon is not None:
+            # the box can be shrunk to the overlap with the polygon envelope
+            a, b, c, d = polygon.bounds
+            bbox = (max(bbox[0], a), max(bbox[1], b), min(bbox[2], c), min(bbox[3], d))
+        self.bbox = tuple(bbox)
+        # a polygon test is only needed for points if one was supplied
+        self.point_polygon = prep(polygon) if polygon is not None else None
+        # lines always need an exact test, since a segment can cross the box without any vertex lying inside it
+        self.line_polygon = prep(polygon if polygon is not None else geometry.box(*self.bbox))
+
+    def contains_point(self, x, y):
+        xmin, ymin, xmax, ymax = self.bbox
+        if not (xmin <= x <= xmax and ymin <= y <= ymax):
+            return False
+        return self.point_polygon is None or self.point_polygon.intersects(Point(x, y))
+
+    def intersects_line(self, coords):
+        """
+        :param coords: (N, 2) array or list of coordinate pairs
+        """
+        coords = np.asarray(coords, dtype=float)
+        xmin, ymin, xmax, ymax = self.bbox
+        lo = coords.min(axis=0)
+        hi = coords.max(axis=0)
+        if hi[0] < xmin or lo[0] > xmax or hi[1] < ymin or lo[1] > ymax:
+            return False
+        return self.line_polygon.intersects(LineString(coords))
+
+
+class TargetEnds(object):
+
+    def __init__(self, net, targets):
+        """
+        How each of a set of target NetPoints can be reached: the ends of its edge, the distance from each end and
+        whether the edge may be entered there. Used by StreetNet.distance_block.
+        """
+        _, allows, node_key, _, _ = net.routing_adapter(directed=net.directed)
+        self.nodes = []
+        index = {}
+        n = len(targets)
+        self.idx_neg = np.empty(n, dtype=int)
+        self.idx_pos = np.empty(n, dtype=int)
+        self.d_neg = np.empty(n)
+        self.d_pos = np.empty(n)
+        self.enter_neg = np.ones(n, dtype=bool)
+        self.enter_pos = np.ones(n, dtype=bool)
+        self.fids = []
+        for k, t in enumerate(targets):
+            a, b = node_key(t.edge.orientation_neg), node_key(t.edge.orientation_pos)
+            for x in (a, b):
+                if x not in index:
+                    index[x] = len(self.nodes)
+                    self.nodes.append(x)
+            self.idx_neg[k] = index[a]
+            self.idx_pos[k] = index[b]
+            self.d_neg[k] = t.distance_negative
+            self.d_pos[k] = t.distance_positive
+            self.fids.append(t.edge.fid)
+            if net.directed:
+                self.enter_neg[k] = allows(t.edge.fid, a, b)
+                self.enter_pos[k] = allows(t.edge.fid, b, a)
+
+    def __len__(self):
+        return len(self.fids)
+
+
+# the network and targets used by distance_matrix worker processes, set by _init_distance_worker
+_distance_worker = None
+
+
+def _init_distance_worker(net, targets, max_distance):
+    global _distance_worker
+    _distance_worker = (net, TargetEnds(net, targets), max_distance)
+
+
+def _distance_worker_block(args):
+    # module-level function so that it can be pickled and sent to a worker process
+    net, ends, max_distance = _distance_worker
+    rows = args[0]
+    return rows, net.distance_block(*args[1:], ends=ends, max_distance=max_distance)
+
+
 class StreetNet(object):
 
     '''
@@ -448,6 +593,26 @@ class StreetNet(object):
 
     All cleaning routines stripped out for now because they're uncommented, ugly
     and bloated.
+
+    Optionally, the network can instead be held in compact arrays (see csr.CSRGraph and
+    set_backend('csr')). Edges, NetPoints, next_turn, degree and the path methods then work
+    directly on the arrays, and the networkx graphs g and g_routing are only built if they are
+    accessed. Note that changes made to those graphs are not seen by the CSR backend until
+    graph_changed() is called, which rebuilds the arrays; alternatively, switch back with
+    set_backend('networkx') before editing the network.
+
+    Node and edge IDs can also be replaced by dense integers (see intern_ids), with node_table and
+    edge_table mapping them back to the original FIDs.
+
+    For many repeated path queries, build_contraction_hierarchy preprocesses the network so that the path
+    methods only need to search a small part of it, and build_landmarks precomputes distances from a few nodes
+    that bound the distance between any two points (see distance_bounds). Both are discarded if the graphs are
+    replaced.
+    Alternatively, enable_distance_cache remembers the distances between nodes found by earlier queries, and
+    build_chain_overlay lets searches skip the many nodes that only join two edges.
+
+    Selecting edges or nodes by location (edges, nodes, closest_edges_euclidean_brute_force, within_boundary) uses an
+    R-tree index that is built on first use and discarded if the graphs are replaced (see spatial_index).
     '''
     EDGE_ID_KEY = 'fid'
     NODE0_KEY = 'orientation_neg'
@@ -460,14 +625,28 @@ class StreetNet(object):
         :param routing: Defines the behaviour upon subtracting two NetPoints
         '''
         self.srid = srid
+        self._csr = None
+        self._ch = {}
+        self._landmarks = {}
+        self._tables = {}
+        self._distance_cache = None
+        self._routing_graphs = {}
+        self._chains = {}
+        self._spatial_index = None
         self.g = nx.MultiGraph()
         self.g_routing = nx.MultiDiGraph()
         self.directed = routing.lower() == 'directed'
         self.edge_index = None
         self.edge_coord_map = None
+        self.node_table = None
+        self.edge_table = None
 
     @classmethod
-    def from_data_structure(cls, data, srid=None):
+    def from_data_structure(cls, data, srid=None, intern_ids=False):
+        '''
+        :param intern_ids: If True, replace the node and edge IDs with integers once the network is built (see
+        intern_ids()).
+        '''
         obj = cls(srid=srid)
         print 'Building the network'
         obj.build_network(data)
@@ -478,6 +657,9 @@ class StreetNet(object):
         print 'Building routing network'
         obj.build_routing_network()
 
+        if intern_ids:
+            obj.intern_ids()
+
         return obj
 
     @classmethod
@@ -486,6 +668,36 @@ class StreetNet(object):
             obj = cPickle.load(f)
         return obj
 
+    @classmethod
+    def from_snapshot(cls, path, mmap_mode='r', backend='networkx'):
+        '''
+        Load a network written by save(fmt='snapshot'). The arrays are memory-mapped, so several processes loading
+        the same snapshot share its pages.
+        :param mmap_mode: Passed to np.load. Use None to read the arrays into memory instead.
+        :param backend: 'networkx' or 'csr'. With the CSR backend, the network is used directly from the
+        (memory-mapped) arrays and no networkx graph is built.
+        '''
+        meta, arrs = snapshot.read(path, mmap_mode=mmap_mode)
+        obj = cls(srid=meta['srid'], routing='directed' if meta['directed'] else 'undirected')
+        # the routing graph is rebuilt from the stored one-way flags rather than by build_routing_network
+        obj._csr = CSRGraph.from_arrays(meta, arrs,
+                                        edge_id_key=cls.EDGE_ID_KEY,
+                                        node0_key=cls.NODE0_KEY,
+                                        node1_key=cls.NODE1_KEY)
+        obj._g = obj._g_routing = None
+        if meta.get('interned'):
+            obj.intern_ids()
+        for directed in (False, True):
+            name = snapshot.hierarchy_name(directed)
+            if name in meta.get('hierarchies', []):
+                prefix = 'ch_%s_' % name
+                obj._ch[directed] = ContractionHierarchy.from_arrays(
+                    dict((k[len(prefix):], v) for k, v in arrs.items() if k.startswith(prefix)),
+                    obj._csr.node_ids,
+                    obj._csr.edge_fids)
+        obj.set_backend(backend)
+        return obj
+
     @classmethod
     def from_shapefile(cls,
                        filename,
@@ -539,6 +751,156 @@ class StreetNet(object):
         obj.build_routing_network()
         return obj
 
+    def __setstate__(self, state):
+        # networks pickled before the CSR backend was added store the graphs directly
+        if 'g' in state:
+            state['_g'] = state.pop('g')
+            state['_g_routing'] = state.pop('g_routing', None)
+        state.setdefault('_csr', None)
+        state.setdefault('_ch', {})
+        state.setdefault('_landmarks', {})
+        state.setdefault('_tables', {})
+        state.setdefault('_distance_cache', None)
+        state.setdefault('_routing_graphs', {})
+        state.setdefault('_chains', {})
+        state.setdefault('_spatial_index', None)
+        state.setdefault('node_table', None)
+        state.setdefault('edge_table', None)
+        self.__dict__.update(state)
+
+    @property
+    def g(self):
+        if self._g is None and self._csr is not None:
+            self._g, self._g_routing = self._csr.to_networkx()
+        return self._g
+
+    @g.setter
+    def g(self, value):
+        self.drop_csr()
+        self.graph_changed()
+        self._g = value
+
+    @property
+    def g_routing(self):
+        if self._g_routing is None and self._csr is not None:
+            self._g, self._g_routing = self._csr.to_networkx()
+        return self._g_routing
+
+    @g_routing.setter
+    def g_routing(self, value):
+        self.drop_csr()
+        self.graph_changed()
+        self._g_routing = value
+
+    @property
+    def backend(self):
+        return 'networkx' if self._csr is None else 'csr'
+
+    def set_backend(self, backend):
+        '''
+        Switch the network representation.
+        :param backend: 'csr' to hold the network in compact arrays, discarding the networkx graphs (these are
+        rebuilt if g or g_routing are accessed), or 'networkx' to go back to the networkx graphs.
+        '''
+        if backend == 'csr':
+            if self._csr is None:
+                self._csr = CSRGraph.from_streetnet(self)
+                self._g = self._g_routing = None
+        elif backend == 'networkx':
+            self.drop_csr()
+        else:
+            raise ValueError("Supported backend values are 'networkx', 'csr'.")
+
+    def drop_csr(self):
+        '''
+        Discard the CSR backend, building the networkx graphs first if necessary.
+        '''
+        if self._csr is not None:
+            if self._g is None or self._g_routing is None:
+                self._g, self._g_routing = self._csr.to_networkx()
+            self._csr = None
+
+    def graph_changed(self):
+        '''
+        Discard everything derived from the graphs for routing. This is called when g or g_routing is replaced; call
+        it after editing the graphs in place.
+        With the CSR backend, the graphs can only have been edited if they were built (by accessing g or
+        g_routing), in which case the arrays are rebuilt from them.
+        '''
+        if self._csr is not None and self._g is not None and self._g_routing is not None:
+            self._csr = None
+            self._csr = CSRGraph.from_streetnet(self)
+        self._ch = {}
+        self._landmarks = {}
+        # deletes any temporary table files
+        for table in self._tables.itervalues():
+            table.close()
+        self._tables = {}
+        self._routing_graphs = {}
+        self._chains = {}
+        self._spatial_index = None
+        if self._distance_cache is not None:
+            self._distance_cache.clear()
+
+    def intern_ids(self):
+        '''
+        Replace the node and edge IDs with dense integers, throughout the graphs and the edge attributes. Integers
+        are assigned in sorted order of the original IDs, so the same network is always interned in the same way.
+        The original IDs are kept in the IdTable objects node_table and edge_table, e.g.
+        net.node_table.to_fid(edge.orientation_neg) and net.edge_table.to_int(fid).
+        This has no effect if the network is already interned.
+        '''
+        if self.node_table is not None:
+            return
+        if self._csr is not None:
+            node_table = IdTable(sorted(self._csr.node_ids))
+            edge_table = IdTable(sorted(self._csr.edge_fids))
+            self._csr.relabel([node_table.to_int(t) for t in self._csr.node_ids],
+                              [edge_table.to_int(t) for t in self._csr.edge_fids])
+            # any materialised networkx graphs still use the original IDs
+            self._g = self._g_routing = None
+        else:
+            node_table = IdTable(sorted(self.g.nodes()))
+            edge_table = IdTable(sorted(set(fid for _, _, fid in self.g.edges(keys=True))))
+            g = self.relabel_graph(self.g, node_table.to_int, edge_table.to_int)
+            g_routing = self.relabel_graph(self.g_routing, node_table.to_int, edge_table.to_int)
+            self.g = g
+            self.g_routing = g_routing
+        self.node_table = node_table
+        self.edge_table = edge_table
+        # the snapping index and contraction hierarchies refer to edges by ID
+        self.edge_index = None
+        self.edge_coord_map = None
+        self.graph_changed()
+
+    def relabel_graph(self, g, node_map, edge_map):
+        '''
+        Copy a graph, mapping the node and edge IDs with the supplied functions.
+        '''
+        new_g = g.__class__()
+        for v, attr in g.nodes_iter(data=True):
+            new_g.add_node(node_map(v), attr_dict=attr)
+        for n1, n2, fid, attr in g.edges_iter(keys=True, data=True):
+            new_g.add_edge(node_map(n1), node_map(n2), key=edge_map(fid),
+                           attr_dict=self.relabel_edge_attrs(attr, node_map, edge_map))
+        return new_g
+
+    def relabel_edge_attrs(self, attr, node_map, edge_map):
+        attr = dict(attr)
+        attr[self.EDGE_ID_KEY] = edge_map(attr[self.EDGE_ID_KEY])
+        attr[self.NODE0_KEY] = node_map(attr[self.NODE0_KEY])
+        attr[self.NODE1_KEY] = node_map(attr[self.NODE1_KEY])
+        return attr
+
+    def original_edge_attrs(self, attr):
+        '''
+        Edge attribute dictionary with the original node and edge IDs, for export. This is the dictionary itself if
+        the network is not interned and a copy otherwise.
+        '''
+        if self.node_table is None:
+            return attr
+        return self.relabel_edge_attrs(attr, self.node_table.to_fid, self.edge_table.to_fid)
+
     def save(self, filename, fmt='pickle'):
         '''
         Save the network to a file
@@ -549,8 +911,13 @@ class StreetNet(object):
 
         elif fmt in ('shp', 'shapefile'):
             self.save_to_shapefile(filename)
+
+        elif fmt == 'snapshot':
+            # filename is a directory in this case
+            snapshot.write(self, filename)
+
         else:
-            raise ValueError("Supported fmt values are 'pickle', 'shp'.")
+            raise ValueError("Supported fmt values are 'pickle', 'shp', 'snapshot'.")
 
     def save_to_shapefile(self, filename):
         import shapefile
@@ -560,26 +927,28 @@ class StreetNet(object):
         bool_fields = set()
         lens = {}
         short_names = {}
-        for e in self.edges():
-            for f in e.attrs:
+        # exported with the original node and edge IDs
+        edge_attrs = [self.original_edge_attrs(e.attrs) for e in self.edges()]
+        for attrs in edge_attrs:
+            for f in attrs:
                 if f not in fields:
                     # shorten name if necessary (10 character limit in shapefiles)
                     short_name = f.replace('orientation', 'orient')
                     short_names[f] = short_name
-                    if isinstance(e.attrs[f], str) or isinstance(e.attrs[f], unicode):
+                    if isinstance(attrs[f], str) or isinstance(attrs[f], unicode):
                         fields[f] = 'C'
-                        lens[f] = len(e.attrs[f])
-                    elif isinstance(e.attrs[f], bool):
+                        lens[f] = len(attrs[f])
+                    elif isinstance(attrs[f], bool):
                         fields[f] = 'N'  # 0: False, 1: True
                         bool_fields.add(f)
-                    elif isinstance(e.attrs[f], float):
+                    elif isinstance(attrs[f], float):
                         fields[f] = 'F'
-                    elif isinstance(e.attrs[f], int):
+                    elif isinstance(attrs[f], int):
                         fields[f] = 'N'
 
                 elif fields[f] == 'C':
                     # keep track of max length
-                    lens[f] = max(len(e.attrs[f]), lens[f])
+                    lens[f] = max(len(attrs[f]), lens[f])
         for f in fields:
             if f in short_names:
                 field_name = short_names[f]
@@ -591,12 +960,12 @@ class StreetNet(object):
                 w.field(field_name, 'F', 12, 6)
             else:
                 w.field(field_name, 'N', 12)
-        for e in self.edges():
-            w.line(parts=[e.linestring.coords[:]])
+        for attrs in edge_attrs:
+            w.line(parts=[attrs['linestring'].coords[:]])
             rec = {}
             for f in fields:
                 key = short_names.get(f, f)
-                val = e.attrs.get(f, None)
+                val = attrs.get(f, None)
                 # custom retrieval operation depending on type
                 if f in bool_fields:
                     rec[key] = int(val)
@@ -639,40 +1008,73 @@ class StreetNet(object):
 
     def shortest_edges_network(self):
         """
-        Compute the Graph containing only the shortest edges between nodes.
+        Copy of the network keeping only the shortest of any parallel edges between each pair of nodes, as searched
+        by the path methods (see routing_graph). The edges keep their FIDs and attributes. If the network is
+        directed, an edge is kept if it is the shortest in either direction in which it may be travelled.
         """
-        if self.directed:
-            raise NotImplementedError()
-        # 99% of the work can be done in one line
-        g = nx.Graph(self.g)
-
-        # now identify where multiple lines existed and choose the shortest one
-        for x in self.g.edge.iteritems():
-            for y in x[1].iteritems():
-                if len(y[1]) > 1:
-                    # print "Multiple choice edge"
-                    # find the minimum length edge in old graph
-                    ls = [t['length'] for t in y[1].values()]
-                    fids = y[1].keys()
-
-                    # print "Arbitrarily chosen length: %f" % g.edge[x[0]][y[0]]['length']
-                    # print "Min length: %f" % min(ls)
-
-                    # if g.edge[x[0]][y[0]]['length'] != min(ls):
-                    #     print "Swapping edge..."
-
-                    # update new graph
-                    g.edge[x[0]][y[0]] = self.g.edge[x[0]][y[0]][fids[np.argmin(ls)]]
-
-                    # print "New length: %f" % g.edge[x[0]][y[0]]['length']
+        directed = self.directed
+        arcs = set((u, v, fid) for u, x in self.routing_graph(directed=directed).iteritems() for v, fid, _ in x)
+        keep = set(fid for _, _, fid in arcs)
+        g = nx.MultiGraph()
+        g.add_nodes_from(self.g.nodes(data=True))
+        g.add_edges_from((u, v, fid, attr) for u, v, fid, attr in self.g.edges(keys=True, data=True) if fid in keep)
+        g_routing = nx.MultiDiGraph()
+        g_routing.add_nodes_from(self.g_routing.nodes(data=True))
+        g_routing.add_edges_from(
+            (u, v, fid, attr) for u, v, fid, attr in self.g_routing.edges(keys=True, data=True)
+            if ((u, v, fid) in arcs if directed else fid in keep)
+        )
 
-        obj = self.__class__()
+        obj = self.__class__(routing='directed' if directed else 'undirected', srid=self.srid)
         obj.g = g
+        obj.g_routing = g_routing
+        obj.node_table = self.node_table
+        obj.edge_table = self.edge_table
         return obj
 
     def degree(self, node):
+        if self._csr is not None:
+            return self._csr.degree(self._csr.node_index[node])
         return self.g.degree(node)
 
+    def has_node(self, node):
+        if self._csr is not None:
+            return node in self._csr.node_index
+        return node in self.g.node
+
+    def has_edge(self, node_neg, node_pos, fid):
+        if self._csr is not None:
+            e = self._csr.edge_index.get(fid)
+            if e is None:
+                return False
+            u, v, _ = self._csr.edge_ends(e)
+            return (node_neg, node_pos) in ((u, v), (v, u))
+        return fid in self.g.edge.get(node_neg, {}).get(node_pos, {})
+
+    def node_loc(self, node):
+        if self._csr is not None:
+            return tuple(self._csr.node_loc[self._csr.node_index[node]].tolist())
+        return self.g.node[node]['loc']
+
+    def edge_attrs(self, node_neg, node_pos, fid):
+        '''
+        The attribute dictionary of an edge. With the CSR backend this is rebuilt on each call, so changes to it
+        are not stored.
+        '''
+        if self._csr is not None:
+            return self._csr.edge_attrs(self._csr.edge_index[fid])
+        return self.g.edge[node_neg][node_pos][fid]
+
+    def edge_linestring(self, node_neg, node_pos, fid):
+        if self._csr is not None:
+            return self._csr.linestring(self._csr.edge_index[fid])
+        return self.g.edge[node_neg][node_pos][fid]['linestring']
+
+    def edge_length(self, node_neg, node_pos, fid):
+        if self._csr is not None:
+            return float(self._csr.edge_length[self._csr.edge_index[fid]])
+        return self.g.edge[node_neg][node_pos][fid]['length']
+
     def plot_network(self,
                      ax=None,
                      extent=None,
@@ -704,50 +1106,39 @@ class StreetNet(object):
 
             path_patches = []
 
-            for e in self.edges():
-                fid = e.fid
-                ls = e.linestring
-            # for n1,n2,fid,attr in self.g.edges(data=True, keys=True):
-
-                # bbox_check=[min_x<=p[0]<=max_x and min_y<=p[1]<=max_y for p in attr['polyline']]
-                bbox_check = bounding_poly.intersects(ls)
-
-                #This checks that at least some of the line lies within the bounding
-                #box. This is to avoid creating unnecessary lines which will not
-                #actually be seen.
-                # if any(bbox_check):
-                if bbox_check:
-
-                    path = Path(ls)
-                    path_patches.append(patches.PathPatch(path, facecolor='none', edgecolor=edge_outer_col, lw=edge_width))
-                    # patch = patches.PathPatch(path, facecolor='none', edgecolor=edge_outer_col, lw=edge_width)
+            #Only the lines that at least partly lie within the bounding box are
+            #drawn. This is to avoid creating unnecessary lines which will not
+            #actually be seen.
+            for _, _, fid, ls in self.spatial_index().edges_intersecting(bounding_poly):
+                path = Path(ls)
+                path_patches.append(patches.PathPatch(path, facecolor='none', edgecolor=edge_outer_col, lw=edge_width))
+                # patch = patches.PathPatch(path, facecolor='none', edgecolor=edge_outer_col, lw=edge_width)
+                # ax.add_patch(patch)
+
+                if edge_inner_col is not None:
+                    if isinstance(edge_inner_col, dict):
+                        ec = edge_inner_col.get(fid, 'w')
+                    else:
+                        ec = edge_inner_col
+                    # patch = patches.PathPatch(path, facecolor='none', edgecolor=ec, lw=0.6*edge_width, zorder=2)
                     # ax.add_patch(patch)
-
-                    if edge_inner_col is not None:
-                        if isinstance(edge_inner_col, dict):
-                            ec = edge_inner_col.get(fid, 'w')
-                        else:
-                            ec = edge_inner_col
-                        # patch = patches.PathPatch(path, facecolor='none', edgecolor=ec, lw=0.6*edge_width, zorder=2)
-                        # ax.add_patch(patch)
-                        path_patches.append(patches.PathPatch(path, facecolor='none', edgecolor=ec, lw=0.6*edge_width, zorder=2))
-
-                    #These circles are a massive fudge to give the lines 'rounded'
-                    #ends. They look nice, but best to only do them at the last
-                    #minute because it is hard to work out what radius they should
-                    #be - the units scale differently to edge_width so need to be
-                    #trial-and-errored each time.
-                    #TODO: Calculate these radii automatically
-#                    end1=patches.Circle(attr['polyline'][0],radius=3.2*edge_width,facecolor='k',edgecolor='k',lw=0,zorder=1)
-#                    ax.add_patch(end1)
-#                    end2=patches.Circle(attr['polyline'][-1],radius=3.2*edge_width,facecolor='k',edgecolor='k',lw=0,zorder=1)
-#                    ax.add_patch(end2)
+                    path_patches.append(patches.PathPatch(path, facecolor='none', edgecolor=ec, lw=0.6*edge_width, zorder=2))
+
+                #These circles are a massive fudge to give the lines 'rounded'
+                #ends. They look nice, but best to only do them at the last
+                #minute because it is hard to work out what radius they should
+                #be - the units scale differently to edge_width so need to be
+                #trial-and-errored each time.
+                #TODO: Calculate these radii automatically
+#                end1=patches.Circle(attr['polyline'][0],radius=3.2*edge_width,facecolor='k',edgecolor='k',lw=0,zorder=1)
+#                ax.add_patch(end1)
+#                end2=patches.Circle(attr['polyline'][-1],radius=3.2*edge_width,facecolor='k',edgecolor='k',lw=0,zorder=1)
+#                ax.add_patch(end2)
 
             ax.add_collection(PatchCollection(path_patches, match_original=True))
 
         if show_nodes:
-            node_points=[self.g.node[v]['loc'] for v in self.g]
-            node_points_bbox=[p for p in node_points if min_x<=p[0]<=max_x and min_y<=p[1]<=max_y]
+            node_points_bbox=[loc for _, loc in self.spatial_index().nodes_intersecting(bounding_poly)]
             x,y = zip(*node_points_bbox)
             ax.scatter(x,y,c=node_col,s=node_size,zorder=5)
 
@@ -805,8 +1196,17 @@ class StreetNet(object):
         # dict to store the location of any nodes that need moving
         node_shift = {}
 
-        #Loop the edges
-        for n1, n2, fid, attr in self.g.edges(data=True, keys=True):
+        # clipped nodes get new IDs, which need entries in the lookup table if the network is interned
+        node_table = self.node_table.copy() if self.node_table is not None else None
+
+        def clip_node(v):
+            if node_table is None:
+                return v + '_clip'
+            return node_table.add(node_table.to_fid(v) + '_clip')
+
+        #Loop the edges that may be inside the boundary
+        for n1, n2, fid, _ in self.spatial_index().edges_intersecting(boundary):
+            attr = self.g.edge[n1][n2][fid]
             edge_line = attr['linestring']
             n_neg = attr['orientation_neg']
             n_pos = attr['orientation_pos']
@@ -831,12 +1231,12 @@ class StreetNet(object):
                         continue
                     # mark one or both of the nodes as clipped
                     if not pt_neg.within(boundary):
-                        n_neg += '_clip'
-                        attr['orientation_neg'] += '_clip'
+                        n_neg = clip_node(n_neg)
+                        attr['orientation_neg'] = n_neg
                         node_shift[n_neg] = new_edge.coords[0]
                     if not pt_pos.within(boundary):
-                        n_pos += '_clip'
-                        attr['orientation_pos'] += '_clip'
+                        n_pos = clip_node(n_pos)
+                        attr['orientation_pos'] = n_pos
                         node_shift[n_pos] = new_edge.coords[-1]
                     # update attribute dict
                     attr['length'] = new_edge.length
@@ -848,7 +1248,7 @@ class StreetNet(object):
 
         #Add all nodes to the new posdict
         for v in g_new:
-            if '_clip' in v and clip_lines:
+            if v in node_shift:
                 # find the new (clipped) location of this node
                 loc = node_shift[v]
             else:
@@ -856,7 +1256,10 @@ class StreetNet(object):
             g_new.node[v]['loc'] = loc
 
         # generate a new object from this multigraph
-        return self.__class__.from_multigraph(g_new)
+        obj = self.__class__.from_multigraph(g_new)
+        obj.node_table = node_table
+        obj.edge_table = self.edge_table
+        return obj
 
     def build_grid_edge_index(self, gridsize, extent=None):
         '''
@@ -899,9 +1302,7 @@ class StreetNet(object):
         edge_index=defaultdict(list)
 
         #Loop edges
-        for n1, n2, fid, attr in self.g.edges(data=True, keys=True):
-
-            edge_line = attr['linestring']
+        for n1, n2, fid, edge_line in self.edge_lines_iter():
 
             #Get bounding box of polyline
             (bbox_min_x, bbox_min_y, bbox_max_x, bbox_max_y) = edge_line.bounds
@@ -977,7 +1378,7 @@ class StreetNet(object):
 
         #candidate_edges now contains all candidates for closest edge
         #Calculate the distances to each
-        candidate_edge_distances=[point.distance(self.g[n1][n2][fid]['linestring']) for (n1, n2, fid) in candidate_edges]
+        candidate_edge_distances=[point.distance(self.edge_linestring(n1, n2, fid)) for (n1, n2, fid) in candidate_edges]
 
         valid_edges_distances = sorted(
             zip(candidate_edges, candidate_edge_distances),
@@ -993,7 +1394,8 @@ class StreetNet(object):
 
             #Do various proximity calculations
 
-            polyline = self.g[n1][n2][fid]['linestring']
+            attrs = self.edge_attrs(n1, n2, fid)
+            polyline = attrs['linestring']
 
             #node_dist is a lookup, indexed by each of the terminal nodes of closest_edge,
             #which gives the distance from that node to the point on the line to which
@@ -1001,10 +1403,10 @@ class StreetNet(object):
             #The polyline is specified from negative to positive orientation BTW.
             node_dist={}
 
-            node_dist[self.g[n1][n2][fid]['orientation_neg']]=polyline.project(point)
-            node_dist[self.g[n1][n2][fid]['orientation_pos']]=polyline.length-polyline.project(point)
+            node_dist[attrs['orientation_neg']]=polyline.project(point)
+            node_dist[attrs['orientation_pos']]=polyline.length-polyline.project(point)
 
-            edge = Edge(self, **self.g[n1][n2][fid])
+            edge = Edge(self, **attrs)
             net_point = NetPoint(self, edge, node_dist)
 
             closest_edges.append((net_point, snap_distance))
@@ -1017,340 +1419,702 @@ class StreetNet(object):
         
         return closest_edges
 
-    def path_undirected(self, net_point_from, net_point_to, length_only=False, method=None):
+    def path_undirected(self, net_point_from, net_point_to, length_only=False, method=None, cutoff=None):
 
         known_methods = (
             'single_source',
-            'bidirectional'
+            'bidirectional',
+            'astar',
+            'alt',
+            'ch',
+            'table',
         )
         if method is None:
-            method = 'bidirectional'
+            method = self.default_path_method(False, length_only)
         if method not in known_methods:
             raise AttributeError("Unrecognised method")
 
-        graph = net_point_from.graph
-
-        node_from_neg = net_point_from.edge.orientation_neg
-        node_from_pos = net_point_from.edge.orientation_pos
-        fid_from = net_point_from.edge.fid
-
-        node_to_neg = net_point_to.edge.orientation_neg
-        node_to_pos = net_point_to.edge.orientation_pos
-        fid_to = net_point_to.edge.fid
+        return self.path_points(net_point_from, net_point_to, directed=False, length_only=length_only,
+                                method=method, cutoff=cutoff)
 
-        node_dist_from = net_point_from.node_dist
-        node_dist_to = net_point_to.node_dist
-
-        if net_point_from.edge == net_point_to.edge:  # both points on same edge
-
-            dist_diff = node_dist_to[node_from_neg] - node_dist_from[node_from_neg]
-
-            if length_only:
-                return abs(dist_diff)
-
-            path_edges=[fid_from]
-            path_distances=[abs(dist_diff)]
-            path_nodes=[]
-            path = NetPath(
-                graph,
-                start=net_point_from,
-                end=net_point_to,
-                edges=path_edges,
-                distance=path_distances,
-                nodes=path_nodes)
-
-        else:
-            # Insert a new 'from' node
-            self.g.add_edge(node_from_neg, 'point1', key=fid_from, length=node_dist_from[node_from_neg])
-            self.g.add_edge('point1', node_from_pos, key=fid_from, length=node_dist_from[node_from_pos])
-
-            # store edge data before removal
-            removed_edge1_atts = self.g[node_from_neg][node_from_pos][fid_from]
-            self.g.remove_edge(node_from_neg, node_from_pos, fid_from)
-
-            #Insert a new 'to' node
-            self.g.add_edge(node_to_neg, 'point2', key=fid_to, length=node_dist_to[node_to_neg])
-            self.g.add_edge('point2', node_to_pos, key=fid_to, length=node_dist_to[node_to_pos])
-
-            # store edge data before removal
-            removed_edge2_atts = self.g[node_to_neg][node_to_pos][fid_to]
-            self.g.remove_edge(node_to_neg, node_to_pos, fid_to)
-
-            #Get the path between the new nodes
-            try:
-                if method == 'single_source':
-                    # single_source_djikstra returns two dicts:
-                    # distances holds the shortest distance to each node en route from point1 to point2
-                    # paths holds the shortest partial path for each node en route from point1 to point2
-
-                    distances, paths = nx.single_source_dijkstra(self.g, 'point1', target='point2', weight='length')
-                    node_path = paths['point2']
-                    distance = distances['point2']
-
-                if method == 'bidirectional':
-                    # bidirectional_dijkstra returns a scalar length and a list of nodes
-                    distance, node_path = nx.bidirectional_dijkstra(self.g, 'point1', target='point2', weight='length')
-
-                # if we only need a distance, can quit here
-                if length_only:
-                    return distance
-
-                # to get a proper path, we need to stitch together the edges, choosing the shortest one each time.
-
-                path_edges = []
-                path_distances = []
-                path_nodes = node_path[1:-1]
-
-                for j in xrange(len(node_path) - 1):
-
-                    v = node_path[j]
-                    w = node_path[j+1]
-
-                    fid_shortest = min(self.g[v][w], key=lambda x: self.g[v][w][x]['length'])
-
-                    path_edges.append(fid_shortest)
-                    path_distances.append(self.g[v][w][fid_shortest]['length'])
-
-                path = NetPath(
-                    graph,
-                    start=net_point_from,
-                    end=net_point_to,
-                    edges=path_edges,
-                    distance=path_distances,
-                    nodes=path_nodes)
-
-            except Exception:
-
-                path = None
-
-            finally:
-                # Restore the network to original state
-                # This is run even after an early return, which is useful
-                self.g.remove_node('point1')
-                self.g.remove_node('point2')
-
-                self.g.add_edge(node_from_neg, node_from_pos, key=fid_from, attr_dict=removed_edge1_atts)
-                self.g.add_edge(node_to_neg, node_to_pos, key=fid_to, attr_dict=removed_edge2_atts)
-
-        return path
+    def path_directed(self, net_point_from, net_point_to, length_only=False, method=None, cutoff=None):
 
+        known_methods = (
+            'single_source',
+            'bidirectional',
+            'astar',
+            'alt',
+            'ch',
+            'table',
+        )
+        if method is None:
+            method = self.default_path_method(True, length_only)
+        if method not in known_methods:
+            raise AttributeError("Unrecognised method")
 
-    def path_directed(self, net_point_from, net_point_to, **kwargs):
+        return self.path_points(net_point_from, net_point_to, directed=True, length_only=length_only,
+                                method=method, cutoff=cutoff)
 
-        graph = net_point_from.graph
+    def default_path_method(self, directed, length_only):
+        """
+        The fastest method available to path_undirected or path_directed, given what has been precomputed.
+        """
+        if length_only and directed in self._tables:
+            return 'table'
+        if directed in self._ch:
+            return 'ch'
+        return 'bidirectional'
 
-        n1_1 = net_point_from.edge.orientation_neg
-        n2_1 = net_point_from.edge.orientation_pos
-        fid_1 = net_point_from.edge.fid
+    def routing_adapter(self, directed=False, reverse=False):
+        """
+        Functions used by path_points to search either backend.
+        :param reverse: If True (and directed), neighbours follows the edges backwards, giving the edges that arrive
+        at a node.
+        :return: (neighbours, allows, node_key, node_id, fid). neighbours(node) gives (node, edge, length) for the
+        edges leaving a node; allows(fid, node, node) tests whether travel along an edge is allowed in the given
+        direction. Within these functions, nodes and edges are referred to by the backend's own keys, which
+        node_key(node ID), node_id(key) and fid(key) convert.
+        """
+        if self._csr is not None:
+            csr = self._csr
 
-        n1_2 = net_point_to.edge.orientation_neg
-        n2_2 = net_point_to.edge.orientation_pos
-        fid_2 = net_point_to.edge.fid
+            indptr, indices, edge_ids, lengths = csr.routing_adjacency[(directed, directed and reverse)]
 
-        # n1_1,n2_1,fid_1=net_point1.edge
-        # n1_2,n2_2,fid_2=net_point2.edge
+            def neighbours(i):
+                # as csr.routing_neighbours
+                a, b = indptr[i], indptr[i + 1]
+                return zip(indices[a:b], edge_ids[a:b], lengths[a:b])
 
-        node_dist1=net_point_from.node_dist
-        node_dist2=net_point_to.node_dist
+            def allows(fid, i, j):
+                return csr.allows(csr.edge_index[fid], i, j)
 
-        if fid_1==fid_2:
+            return neighbours, allows, csr.node_index.__getitem__, csr.node_ids.__getitem__, csr.edge_fids.__getitem__
 
-            dist_diff = node_dist2[n1_1] - node_dist1[n1_1]
+        # the adjacency dictionaries are only read, so any number of searches can run at once
+        adj = self.g_routing.succ if directed else self.g.adj
+        neighbours = self.routing_graph(directed=directed, reverse=reverse).__getitem__
 
-            if dist_diff==0:
+        def allows(fid, u, v):
+            return fid in adj[u].get(v, {})
 
-                path_edges=[fid_1]
-                path_distances=[dist_diff]
-                path_nodes=[]
+        def identity(t):
+            return t
 
-                path = NetPath(
-                    graph,
-                    start=net_point_from,
-                    end=net_point_to,
-                    edges=path_edges,
-                    distance=path_distances,
-                    nodes=path_nodes)
+        return neighbours, allows, identity, identity, identity
 
+    def routing_graph(self, directed=False, reverse=False):
+        """
+        The graph searched by the path methods, in which only the shortest of any parallel edges between two nodes
+        (in each direction, if directed) is kept. It is built when first needed and discarded if the graphs are
+        replaced (see graph_changed). With the CSR backend, searches use the equivalent arrays (see
+        csr.collapse_adjacency) and this dictionary is only built on request.
+        :param directed: If True, follow the allowed directions of travel (i.e. the routing network).
+        :param reverse: If True (and directed), list the edges arriving at each node instead.
+        :return: Dictionary of node ID: list of (neighbouring node ID, FID, length).
+        """
+        key = (directed, directed and reverse)
+        graph = self._routing_graphs.get(key)
+        if graph is None:
+            if self._csr is not None:
+                csr = self._csr
+                graph = dict(
+                    (csr.node_ids[i], [(csr.node_ids[j], csr.edge_fids[e], length)
+                                       for j, e, length in csr.routing_neighbours(i, *key)])
+                    for i in xrange(csr.n_nodes)
+                )
             else:
-
-                #p1_node is the node for which p1 is the closer of the two points
-
-                if dist_diff>0:
-
-                    p1_node=n1_1
-                    p2_node=n2_1
-
-                else:
-
-                    p1_node=n2_1
-                    p2_node=n1_1
-
-                if p2_node in self.g_routing[p1_node]:
-
-                    path_edges=[fid_1]
-                    path_distances=[node_dist2[p1_node]-node_dist1[p1_node]]
-                    path_nodes=[]
-
-                    path = NetPath(
-                        graph,
-                        start=net_point_from,
-                        end=net_point_to,
-                        edges=path_edges,
-                        distance=path_distances,
-                        nodes=path_nodes)
-
+                if directed:
+                    adj = self.g_routing.pred if reverse else self.g_routing.succ
                 else:
+                    adj = self.g.adj
+                graph = {}
+                for u, nbrs in adj.iteritems():
+                    graph[u] = [min(((v, fid, attr['length']) for fid, attr in edges.iteritems()),
+                                    key=operator.itemgetter(2))
+                                for v, edges in nbrs.iteritems()]
+            self._routing_graphs[key] = graph
+        return graph
+
+    def routing_keys(self):
+        """
+        :return: The keys of all nodes, as used by the functions of routing_adapter.
+        """
+        if self._csr is not None:
+            return range(self._csr.n_nodes)
+        return self.g.nodes()
 
-                    try:
-
-                        distances, paths = nx.single_source_dijkstra(self.g_routing,p1_node,target=p2_node,weight='length')
-
-                        node_path=paths[p2_node]
-
-                        path_edges=[fid_1]
-                        path_distances=[node_dist1[p1_node]]
-                        path_nodes=[p1_node]
-
-                        for j in xrange(len(node_path)-1):
-
-                            v=node_path[j]
-                            w=node_path[j+1]
-
-                            fid_shortest=min(self.g_routing[v][w],key=lambda x: self.g_routing[v][w][x]['length'])
-
-                            path_edges.append(fid_shortest)
-                            path_distances.append(self.g_routing[v][w][fid_shortest]['length'])
-                            path_nodes.append(w)
-
-                        path_edges.append(fid_1)
-                        path_distances.append(node_dist2[p2_node])
-
-                        path = NetPath(
-                            graph,
-                            start=net_point_from,
-                            end=net_point_to,
-                            edges=path_edges,
-                            distance=path_distances,
-                            nodes=path_nodes)
-
-                    except:
+    def routing_locator(self):
+        """
+        :return: Function giving the (x, y) location of a node from its key in the functions of routing_adapter.
+        """
+        if self._csr is not None:
+            loc = self._csr.node_loc
+            return lambda i: (loc.item(i, 0), loc.item(i, 1))
+        node = self.g.node
+        return lambda u: node[u]['loc']
 
-                        path=None
+    def build_contraction_hierarchy(self, directed=None, witness_limit=100):
+        """
+        Preprocess the network for fast repeated path queries (see ch.py). Once built, the hierarchy is used by
+        path_undirected or path_directed unless another method is requested. It is saved with the network, and
+        discarded if the graphs are replaced (see graph_changed).
+        :param directed: True to build for the routing network, False for the undirected network, None for both.
+        :param witness_limit: Passed to ContractionHierarchy.build.
+        """
+        for d in ((False, True) if directed is None else (directed,)):
+            neighbours, _, _, node_id, fid = self.routing_adapter(directed=d)
+            keys = self.routing_keys()
+            arcs = [(node_id(k), node_id(j), fid(e), length) for k in keys for j, e, length in neighbours(k)]
+            self._ch[d] = ContractionHierarchy.build([node_id(k) for k in keys], arcs, witness_limit=witness_limit)
 
+    def contraction_hierarchy(self, directed=False):
+        """
+        :return: The ContractionHierarchy for directed or undirected routing, or None if it has not been built.
+        """
+        return self._ch.get(directed)
 
+    def build_chain_overlay(self, directed=None):
+        """
+        Contract each chain of edges through nodes that join only two edges into a single super-edge (see chains.py).
+        Once built, the 'single_source' and 'bidirectional' path methods search between junctions only, and
+        next_turn (so the network walker) passes through chains without inspecting the graph. Discarded if the
+        graphs are replaced (see graph_changed).
+        :param directed: True to build for the routing network, False for the undirected network, None for both.
+        """
+        if self._csr is not None:
+            csr = self._csr
+            edges = [csr.edge_ends(e) + (csr.edge_length.item(e),) for e in xrange(csr.n_edges)]
         else:
+            edges = [(attr[self.NODE0_KEY], attr[self.NODE1_KEY], fid, attr['length'])
+                     for _, _, fid, attr in self.g.edges_iter(keys=True, data=True)]
+        _, allows, node_key, _, _ = self.routing_adapter(directed=True)
+        for d in ((False, True) if directed is None else (directed,)):
+            if d:
+                arcs = [(u, v, fid, length,
+                         allows(fid, node_key(u), node_key(v)), allows(fid, node_key(v), node_key(u)))
+                        for u, v, fid, length in edges]
+            else:
+                arcs = [(u, v, fid, length, True, True) for u, v, fid, length in edges]
+            self._chains[d] = ChainOverlay.build(arcs)
 
-            removed_edges1=[]
-            removed_edges1_atts=[]
-
-            if n2_1 in self.g_routing[n1_1]:
-                if fid_1 in self.g_routing[n1_1][n2_1]:
-
-                    self.g_routing.add_edge(n1_1,'point1',key=fid_1,length=node_dist1[n1_1])
-                    self.g_routing.add_edge('point1',n2_1,key=fid_1,length=node_dist1[n2_1])
-
-                    removed_edge1=(n1_1,n2_1,fid_1)
-                    removed_edge1_atts=self.g_routing[n1_1][n2_1][fid_1]
-
-                    removed_edges1.append(removed_edge1)
-                    removed_edges1_atts.append(removed_edge1_atts)
-
-                    self.g_routing.remove_edge(n1_1,n2_1,fid_1)
-
-            if n1_1 in self.g_routing[n2_1]:
-                if fid_1 in self.g_routing[n2_1][n1_1]:
-
-                    self.g_routing.add_edge(n2_1,'point1',key=fid_1,length=node_dist1[n2_1])
-                    self.g_routing.add_edge('point1',n1_1,key=fid_1,length=node_dist1[n1_1])
-
-                    removed_edge1=(n2_1,n1_1,fid_1)
-                    removed_edge1_atts=self.g_routing[n2_1][n1_1][fid_1]
-
-                    removed_edges1.append(removed_edge1)
-                    removed_edges1_atts.append(removed_edge1_atts)
-
-                    self.g_routing.remove_edge(n2_1,n1_1,fid_1)
-
-
-
-            removed_edges2=[]
-            removed_edges2_atts=[]
-
-            if n2_2 in self.g_routing[n1_2]:
-                if fid_2 in self.g_routing[n1_2][n2_2]:
-
-                    self.g_routing.add_edge(n1_2,'point2',key=fid_2,length=node_dist2[n1_2])
-                    self.g_routing.add_edge('point2',n2_2,key=fid_2,length=node_dist2[n2_2])
-
-                    removed_edge2=(n1_2,n2_2,fid_2)
-                    removed_edge2_atts=self.g_routing[n1_2][n2_2][fid_2]
-
-                    removed_edges2.append(removed_edge2)
-                    removed_edges2_atts.append(removed_edge2_atts)
-
-                    self.g_routing.remove_edge(n1_2,n2_2,fid_2)
-
-            if n1_2 in self.g_routing[n2_2]:
-                if fid_2 in self.g_routing[n2_2][n1_2]:
-
-                    self.g_routing.add_edge(n2_2,'point2',key=fid_2,length=node_dist2[n2_2])
-                    self.g_routing.add_edge('point2',n1_2,key=fid_2,length=node_dist2[n1_2])
-
-                    removed_edge2=(n2_2,n1_2,fid_2)
-                    removed_edge2_atts=self.g_routing[n2_2][n1_2][fid_2]
-
-                    removed_edges2.append(removed_edge2)
-                    removed_edges2_atts.append(removed_edge2_atts)
-
-                    self.g_routing.remove_edge(n2_2,n1_2,fid_2)
+    def chain_overlay(self, directed=False):
+        """
+        :return: The ChainOverlay for directed or undirected routing, or None if it has not been built.
+        """
+        return self._chains.get(directed)
 
+    def build_landmarks(self, n_landmarks=16, directed=None):
+        """
+        Precompute network distances from a set of landmark nodes (see landmarks.py). These give bounds on the
+        distance between any two NetPoints without searching (distance_bounds), and a heuristic for A* search
+        (method='alt' in the path methods). Discarded if the graphs are replaced (see graph_changed).
+        :param n_landmarks: Number of landmarks. Each costs one search (two for directed routing) to build.
+        :param directed: True to build for the routing network, False for the undirected network, None for both.
+        """
+        for d in ((False, True) if directed is None else (directed,)):
+            neighbours, _, _, node_id, _ = self.routing_adapter(directed=d)
+            reverse_neighbours = self.routing_adapter(directed=True, reverse=True)[0] if d else None
+            self._landmarks[d] = Landmarks.build(self.routing_keys(), neighbours, node_id,
+                                                 reverse_neighbours=reverse_neighbours, n_landmarks=n_landmarks)
 
-            #Get the path between the new nodes
-            #TODO: CONSIDER BIDIRECTIONAL DIJKSTRA
-            try:
+    def landmarks(self, directed=False):
+        """
+        :return: The Landmarks for directed or undirected routing, or None if they have not been built.
+        """
+        return self._landmarks.get(directed)
 
-                distances, paths = nx.single_source_dijkstra(self.g_routing,'point1',target='point2',weight='length')
+    def distance_bounds(self, sources, targets, directed=None):
+        """
+        Lower and upper bounds on the network distance between pairs of NetPoints, from the landmark distances (see
+        build_landmarks). No search is needed, so this can be used to discard or accept pairs before routing. Pairs
+        on the same edge follow the rules of path_points, and their distance is given exactly where it is known
+        without searching.
+        :param sources, targets: Equal length sequences of NetPoints. Pair k runs from sources[k] to targets[k].
+        :param directed: If True, bound the distance on the routing network. Defaults to self.directed.
+        :return: (lower, upper) arrays, np.inf where no route is possible.
+        """
+        directed = self.directed if directed is None else directed
+        lm = self.landmarks(directed)
+        if lm is None:
+            raise ValueError("No landmarks have been built for %s routing" % ('directed' if directed else 'undirected'))
+        exact, pair, xs, ys, offset = self.pair_ends(sources, targets, directed)
+        lower = np.where(np.isnan(exact), np.inf, exact)
+        upper = lower.copy()
+        if pair:
+            lo, up = lm.node_bounds(xs, ys)
+            np.minimum.at(lower, pair, lo + offset)
+            np.minimum.at(upper, pair, up + offset)
+        return lower, upper
+
+    def pair_ends(self, sources, targets, directed):
+        """
+        How the route between each pair of NetPoints can begin and end, following the rules of path_points. Used to
+        turn node-to-node distances (or bounds on them) into distances between NetPoints.
+        :param sources, targets: Equal length sequences of NetPoints.
+        :return: (exact, pair, xs, ys, offset). exact is an array giving the distance of each pair that is reached
+        directly along a shared edge, NaN otherwise. For the other pairs, pair, xs, ys and offset list every
+        combination of a node x at which the source can leave its edge and a node y at which the target can be
+        reached: the pair index, the two node IDs, and the distance from the source to x plus that from y to the
+        target.
+        """
+        _, allows, node_key, _, _ = self.routing_adapter(directed=directed)
+
+        def ends(net_point, entering):
+            # the ends of the point's edge at which it can be left (or entered) in the allowed directions
+            edge = net_point.edge
+            u, v = edge.orientation_neg, edge.orientation_pos
+            if not directed:
+                return u, v
+            i, j = node_key(u), node_key(v)
+            if entering:
+                return [t for t, ok in ((u, allows(edge.fid, i, j)), (v, allows(edge.fid, j, i))) if ok]
+            return [t for t, ok in ((u, allows(edge.fid, j, i)), (v, allows(edge.fid, i, j))) if ok]
+
+        sources = list(sources)
+        targets = list(targets)
+        exact = np.empty(len(sources))
+        exact.fill(np.nan)
+        pair, xs, ys, offset = [], [], [], []
+        for k, (a, b) in enumerate(zip(sources, targets)):
+            edge = a.edge
+            if edge.fid == b.edge.fid:
+                diff = b.node_dist[edge.orientation_neg] - a.node_dist[edge.orientation_neg]
+                i, j = node_key(edge.orientation_neg), node_key(edge.orientation_pos)
+                if not directed or diff == 0 or allows(edge.fid, *((i, j) if diff > 0 else (j, i))):
+                    exact[k] = abs(diff)
+                    continue
+            for x in ends(a, False):
+                for y in ends(b, True):
+                    pair.append(k)
+                    xs.append(x)
+                    ys.append(y)
+                    offset.append(a.node_dist[x] + b.node_dist[y])
+        return exact, pair, xs, ys, offset
+
+    def build_distance_table(self, filename=None, directed=None, n_jobs=1):
+        """
+        Precompute the distance between every pair of nodes (see distance_table.py), after which the distance between
+        any two NetPoints is found by lookup (see table_distances). The path methods then use the table whenever only
+        the length is required, so this includes NetPoint.distance. Only suitable for networks of up to a few tens of
+        thousands of nodes, as the table holds 4 bytes for every pair of nodes.
+        The table is discarded if the graphs are replaced (see graph_changed) or the table is rebuilt. A file given
+        by filename is kept.
+        :param filename: The .npy file to write. If None, a temporary file is used, which is deleted when the table
+        is discarded.
+        :param directed: True to respect one-way restrictions (i.e. use the routing network). Defaults to
+        self.directed.
+        :param n_jobs: Number of worker processes. If None, use the number of CPUs.
+        """
+        directed = self.directed if directed is None else directed
+        csr = self._csr if self._csr is not None else CSRGraph.from_streetnet(self)
+        indptr, indices, _, lengths = csr.adjacency(directed=directed)
+        graph = distance_table.node_graph(csr.n_nodes, indptr, indices, lengths)
+        if directed in self._tables:
+            self._tables.pop(directed).close()
+        self._tables[directed] = distance_table.DistanceTable.build(csr.node_ids, graph, directed,
+                                                                    filename=filename, n_jobs=n_jobs)
+
+    def distance_table(self, directed=False):
+        """
+        :return: The DistanceTable for directed or undirected routing, or None if it has not been built.
+        """
+        return self._tables.get(directed)
 
-                node_path=paths['point2']
+    def enable_distance_cache(self, max_bytes=64 * 2 ** 20):
+        """
+        Remember the distances between pairs of nodes found by the path methods when only the length is required
+        (including NetPoint.distance), so that repeated queries between the same parts of the network need no search.
+        The least recently used distances are discarded to keep within the memory limit. The cache is emptied if the
+        graphs are replaced (see graph_changed). Its contents are not saved with the network.
+        A query that is not answered from the cache costs more than an uncached one, as each distance between nodes
+        needs its own search, so this only pays off when queries repeatedly involve the same edges.
+        :param max_bytes: Approximate limit on the memory used by the cache.
+        """
+        self._distance_cache = DistanceCache(max_bytes=max_bytes)
 
-                path_edges=[]
-                path_distances=[]
-                path_nodes=node_path[1:-1]
+    def disable_distance_cache(self):
+        self._distance_cache = None
 
-                for j in xrange(len(node_path)-1):
+    def distance_cache(self):
+        """
+        :return: The DistanceCache, or None if it is not enabled. Its stats() method gives the hit and miss counts.
+        """
+        return self._distance_cache
 
-                    v=node_path[j]
-                    w=node_path[j+1]
+    def table_distances(self, sources, targets, directed=None):
+        """
+        Network distances between pairs of NetPoints, looked up in the distance table (see build_distance_table).
+        The distances follow the rules of path_points.
+        :param sources, targets: Equal length sequences of NetPoints. Pair k runs from sources[k] to targets[k].
+        :param directed: If True, use the table for the routing network. Defaults to self.directed.
+        :return: Array of distances, np.inf where there is no route.
+        """
+        directed = self.directed if directed is None else directed
+        table = self.distance_table(directed)
+        if table is None:
+            raise ValueError("No distance table has been built for %s routing" %
+                             ('directed' if directed else 'undirected'))
+        exact, pair, xs, ys, offset = self.pair_ends(sources, targets, directed)
+        res = np.where(np.isnan(exact), np.inf, exact)
+        if pair:
+            d = table.dist[[table.node_index[t] for t in xs], [table.node_index[t] for t in ys]]
+            np.minimum.at(res, pair, d + offset)
+        return res
+
+    def path_points(self, net_point_from, net_point_to, directed=False, length_only=False, method=None,
+                    cutoff=None):
+        """
+        Shortest path between two NetPoints. Rather than inserting the points into the graph, the distances from each
+        point to the ends of its edge are used to seed and finish the search (see routing.py). The network is not
+        modified, so paths can be computed concurrently from several threads.
+        :param directed: If True, only travel in the allowed directions (i.e. use the routing network).
+        :param length_only: If True, return only the path length.
+        :param method: If 'astar', guide the search with the straight-line distance to the end point's edge. This
+        relies on no edge being shorter than the straight line between its end nodes. If 'ch', use the contraction
+        hierarchy (see build_contraction_hierarchy). If 'alt', use A* guided by the landmark distances (see
+        build_landmarks). If 'table', look up the length in the distance table (see build_distance_table), which
+        requires length_only. If 'bidirectional', search forwards from the start point and backwards from the end
+        point at once (see routing.bidirectional_shortest_path). Otherwise use Dijkstra's algorithm. Both
+        'bidirectional' and Dijkstra's algorithm search the chain overlay if one has been built (see
+        build_chain_overlay).
+        :param cutoff: Optional, requires length_only. The search stops once no path shorter than this can remain,
+        and np.inf is returned if there is no path within this distance.
+        :return: NetPath, or the path length if length_only is True. None if there is no path.
+        """
+        if cutoff is not None and not length_only:
+            raise ValueError("A cutoff can only be applied when length_only is True")
+
+        def length(d):
+            # the value returned when only the length is required. d is None if there is no path.
+            if cutoff is None:
+                return d
+            return np.inf if d is None or d > cutoff else d
+
+        if method == 'table':
+            if not length_only:
+                raise ValueError("The distance table only gives path lengths")
+            d = self.table_distances([net_point_from], [net_point_to], directed=directed)[0]
+            return length(None if np.isinf(d) else d)
+
+        neighbours, allows, node_key, node_id, fid = self.routing_adapter(directed=directed)
+
+        # each search gives (distance, node keys, FIDs, lengths) or None
+        if method == 'ch':
+            hierarchy = self.contraction_hierarchy(directed)
+            if hierarchy is None:
+                raise ValueError("No contraction hierarchy has been built for %s routing" %
+                                 ('directed' if directed else 'undirected'))
+
+            def search(sources, targets):
+                res = hierarchy.query(dict((node_id(k), d) for k, d in sources.iteritems()),
+                                      dict((node_id(k), d) for k, d in targets.iteritems()), cutoff=cutoff)
+                if res is None:
+                    return None
+                total, nodes, fids, lengths = res
+                return total, [node_key(t) for t in nodes], fids, lengths
+        elif method in ('single_source', 'bidirectional') and self.chain_overlay(directed) is not None:
+            overlay = self.chain_overlay(directed)
+
+            def search(sources, targets):
+                res = overlay.query(dict((node_id(k), d) for k, d in sources.iteritems()),
+                                    dict((node_id(k), d) for k, d in targets.iteritems()), cutoff=cutoff,
+                                    bidirectional=method == 'bidirectional')
+                if res is None:
+                    return None
+                total, nodes, fids, lengths = res
+                return total, [node_key(t) for t in nodes], fids, lengths
+        elif method == 'bidirectional':
+            # the backward search follows the edges arriving at each node
+            reverse_neighbours = self.routing_adapter(directed=True, reverse=True)[0] if directed else neighbours
+
+            def search(sources, targets):
+                res = routing.bidirectional_shortest_path(neighbours, reverse_neighbours, sources, targets,
+                                                          cutoff=cutoff)
+                if res is None:
+                    return None
+                total, nodes, edges, lengths = res
+                return total, nodes, [fid(e) for e in edges], lengths
+        else:
+            if method == 'astar':
+                loc = self.routing_locator()
+                make_heuristic = lambda targets: routing.euclidean_heuristic(loc, targets)
+            elif method == 'alt':
+                lm = self.landmarks(directed)
+                if lm is None:
+                    raise ValueError("No landmarks have been built for %s routing" %
+                                     ('directed' if directed else 'undirected'))
+                make_heuristic = lambda targets: lm.heuristic(node_id, targets)
+            else:
+                make_heuristic = lambda targets: None
+
+            def search(sources, targets):
+                res = routing.shortest_path(neighbours, sources, targets, cutoff=cutoff,
+                                            heuristic=make_heuristic(targets))
+                if res is None:
+                    return None
+                total, nodes, edges, lengths = res
+                return total, nodes, [fid(e) for e in edges], lengths
+
+        cache = self._distance_cache
+        if length_only and cache is not None:
+            # the length is the shortest combination of the distances between the ends of the two edges. Those
+            # between nodes are cached, so only the missing ones need a search.
+            exact, _, xs, ys, offset = self.pair_ends([net_point_from], [net_point_to], directed)
+            if not np.isnan(exact[0]):
+                return length(exact[0])
+            keys = [(x, y, directed) if directed or x <= y else (y, x, directed) for x, y in zip(xs, ys)]
+            known = {}
+            missing = defaultdict(set)
+            for k in keys:
+                if k not in known:
+                    known[k] = cache.get(k)
+                    if known[k] is None:
+                        missing[k[0]].add(k[1])
+            # the cached distances must be exact, so these searches are not cut off
+            for x, ends in missing.iteritems():
+                if method in ('astar', 'alt', 'ch'):
+                    found = dict((y, search({node_key(x): 0.}, {node_key(y): 0.})) for y in ends)
+                    found = dict((y, np.inf if res is None else res[0]) for y, res in found.iteritems())
+                else:
+                    # one search from x reaches all of its missing ends
+                    dist, _ = routing.dijkstra(neighbours, {node_key(x): 0.}, until=set(node_key(y) for y in ends))
+                    found = dict((y, dist.get(node_key(y), np.inf)) for y in ends)
+                for y, d in found.iteritems():
+                    known[(x, y, directed)] = d
+                    cache.put((x, y, directed), d)
+            total = min(known[k] + o for k, o in zip(keys, offset))
+            return length(None if np.isinf(total) else total)
+
+        edge_from = net_point_from.edge
+        edge_to = net_point_to.edge
+        fid_from = edge_from.fid
+        fid_to = edge_to.fid
+        u1, v1 = node_key(edge_from.orientation_neg), node_key(edge_from.orientation_pos)
+        u2, v2 = node_key(edge_to.orientation_neg), node_key(edge_to.orientation_pos)
+        # distance from each point to the ends of its edge, by node key
+        d1 = {u1: net_point_from.distance_negative, v1: net_point_from.distance_positive}
+        d2 = {u2: net_point_to.distance_negative, v2: net_point_to.distance_positive}
+
+        def make_path(edges, distances, nodes):
+            return NetPath(
+                self,
+                start=net_point_from,
+                end=net_point_to,
+                edges=edges,
+                distance=distances,
+                nodes=nodes)
 
-                    fid_shortest=min(self.g_routing[v][w],key=lambda x: self.g_routing[v][w][x]['length'])
+        if fid_from == fid_to:  # both points on same edge
+            dist_diff = d2[u1] - d1[u1]
+            if not directed or dist_diff == 0:
+                if length_only:
+                    return length(abs(dist_diff))
+                return make_path([fid_from], [abs(dist_diff)], [])
 
-                    path_edges.append(fid_shortest)
-                    path_distances.append(self.g_routing[v][w][fid_shortest]['length'])
+            # p1_node is the node for which the start point is the closer of the two points
+            p1_node, p2_node = (u1, v1) if dist_diff > 0 else (v1, u1)
+            if allows(fid_from, p1_node, p2_node):
+                if length_only:
+                    return length(d2[p1_node] - d1[p1_node])
+                return make_path([fid_from], [d2[p1_node] - d1[p1_node]], [])
 
-                path = NetPath(
-                    graph,
-                    start=net_point_from,
-                    end=net_point_to,
-                    edges=path_edges,
-                    distance=path_distances,
-                    nodes=path_nodes)
+            # the edge must be left backwards and rejoined at its other end
+            res = search({p1_node: d1[p1_node]}, {p2_node: d2[p2_node]})
 
-            except:
+        else:
+            if directed:
+                # the start point can only leave its edge, and the end point only be reached, in the allowed directions
+                sources = dict((j, d1[j]) for i, j in ((u1, v1), (v1, u1)) if allows(fid_from, i, j))
+                targets = dict((i, d2[i]) for i, j in ((u2, v2), (v2, u2)) if allows(fid_to, i, j))
+            else:
+                sources = d1
+                targets = d2
+            res = search(sources, targets)
 
-                path = None
+        if length_only:
+            return length(None if res is None else res[0])
+        if res is None:
+            return None
+        total, nodes, fids, lengths = res
+        path_edges = [fid_from] + fids + [fid_to]
+        path_distances = [d1[nodes[0]]] + lengths + [d2[nodes[-1]]]
+        return make_path(path_edges, path_distances, [node_id(t) for t in nodes])
 
+    def distances_from(self, net_point, targets, max_distance=None):
+        """
+        Network distances from one NetPoint to many, using a single search. The distances are the same as those
+        given by NetPoint.distance (or the path length in the directed case), including for targets on the same
+        edge as the source.
+        :param net_point: The source NetPoint.
+        :param targets: Iterable of target NetPoints.
+        :param max_distance: Optional. The search is not extended beyond this distance, and targets further away
+        are given a distance of infinity.
+        :return: Array of distances, with np.inf for targets that are unreachable or beyond max_distance.
+        """
+        neighbours, allows, node_key, node_id, fid = self.routing_adapter(directed=self.directed)
+        targets = list(targets)
+        edge = net_point.edge
+        u, v = node_key(edge.orientation_neg), node_key(edge.orientation_pos)
+        d = {u: net_point.distance_negative, v: net_point.distance_positive}
+        if self.directed:
+            # the source can only leave its edge in the allowed directions
+            sources = dict((j, d[j]) for i, j in ((u, v), (v, u)) if allows(edge.fid, i, j))
+        else:
+            sources = d
+
+        # (node key, distance to the target) for each way into each target
+        ends = []
+        for t in targets:
+            a, b = node_key(t.edge.orientation_neg), node_key(t.edge.orientation_pos)
+            ends.append([(i, t.node_dist[node_id(i)]) for i, j in ((a, b), (b, a))
+                         if not self.directed or allows(t.edge.fid, i, j)])
+
+        dist, _ = routing.dijkstra(neighbours, sources, cutoff=max_distance,
+                                   until=set(i for x in ends for i, _ in x))
+
+        res = np.empty(len(targets))
+        for k, (t, x) in enumerate(zip(targets, ends)):
+            if t.edge.fid == edge.fid:
+                dist_diff = t.node_dist[edge.orientation_neg] - net_point.distance_negative
+                if not self.directed or dist_diff == 0:
+                    res[k] = abs(dist_diff)
+                    continue
+                # travel directly along the edge if that direction is allowed, otherwise leave it and come back
+                p1_node, p2_node = (u, v) if dist_diff > 0 else (v, u)
+                if allows(edge.fid, p1_node, p2_node):
+                    res[k] = abs(dist_diff)
+                    continue
+            res[k] = min([dist[i] + dt for i, dt in x if i in dist] or [np.inf])
+        if max_distance is not None:
+            res[res > max_distance] = np.inf
+        return res
 
-            #Restore the network to original state
-            self.g_routing.remove_node('point1')
-            self.g_routing.remove_node('point2')
+    def distance_block(self, fid, node_neg, node_pos, d_neg, d_pos, ends, max_distance=None):
+        """
+        Network distances from a set of points on one edge to a set of targets. At most two searches are needed,
+        one from each end of the edge, however many points there are. The distances follow the same rules as
+        distances_from.
+        :param fid, node_neg, node_pos: The edge on which the sources lie.
+        :param d_neg, d_pos: Arrays giving the distance from each source to node_neg and node_pos.
+        :param ends: TargetEnds instance describing the targets.
+        :param max_distance: Optional. Distances beyond this are not searched and are set to infinity.
+        :return: (n_sources, n_targets) array.
+        """
+        neighbours, allows, node_key, _, _ = self.routing_adapter(directed=self.directed)
+        u, v = node_key(node_neg), node_key(node_pos)
+        d_neg = np.asarray(d_neg, dtype=float)
+        d_pos = np.asarray(d_pos, dtype=float)
 
-            for (n1,n2,fid),removed_edge_atts in zip(removed_edges1,removed_edges1_atts):
-                self.g_routing.add_edge(n1,n2,key=fid,attr_dict=removed_edge_atts)
+        # the sources leave their edge through either end, if travel in that direction is allowed
+        exits = [(u, d_neg), (v, d_pos)]
+        if self.directed:
+            exits = [(x, d) for (x, d), (i, j) in zip(exits, ((v, u), (u, v))) if allows(fid, i, j)]
+
+        res = np.empty((d_neg.size, len(ends)))
+        res.fill(np.inf)
+        for x, d in exits:
+            cutoff = max_distance - d.min() if max_distance is not None else None
+            if cutoff is not None and cutoff < 0:
+                continue
+            dist, _ = routing.dijkstra(neighbours, {x: 0.}, cutoff=cutoff, until=ends.nodes)
+            dx = np.array([dist.get(t, np.inf) for t in ends.nodes])
+            to_target = np.minimum(
+                np.where(ends.enter_neg, dx[ends.idx_neg] + ends.d_neg, np.inf),
+                np.where(ends.enter_pos, dx[ends.idx_pos] + ends.d_pos, np.inf),
+            )
+            res = np.minimum(res, d[:, None] + to_target[None, :])
+
+        # targets on the same edge are reached directly along it, if travel in that direction is allowed
+        same = np.array([k for k, t in enumerate(ends.fids) if t == fid], dtype=int)
+        if same.size:
+            # distance of each target from node_neg, allowing for edges given with the opposite orientation
+            t_neg = np.array([ends.d_neg[k] if ends.nodes[ends.idx_neg[k]] == u else ends.d_pos[k] for k in same])
+            diff = t_neg[None, :] - d_neg[:, None]
+            if self.directed:
+                ok = (diff == 0) | ((diff > 0) & allows(fid, u, v)) | ((diff < 0) & allows(fid, v, u))
+                res[:, same] = np.where(ok, np.abs(diff), res[:, same])
+            else:
+                res[:, same] = np.abs(diff)
 
-            for (n1,n2,fid),removed_edge_atts in zip(removed_edges2,removed_edges2_atts):
-                self.g_routing.add_edge(n1,n2,key=fid,attr_dict=removed_edge_atts)
+        if max_distance is not None:
+            res[res > max_distance] = np.inf
+        return res
 
-        return path
+    def distance_matrix(self, sources, targets=None, max_distance=None, n_jobs=1, sparse_result=False):
+        """
+        Network distances between every pair of source and target NetPoints. Sources are grouped by edge and each
+        group is searched from the ends of its edge (see distance_block), optionally in parallel. Worker processes
+        inherit the network rather than receiving a copy, where the platform allows it.
+        The distances follow the same rules as distances_from. Throughput is printed on completion.
+        :param sources: Iterable of NetPoints.
+        :param targets: Optional iterable of NetPoints. Defaults to the sources.
+        :param max_distance: Optional upper limit. Searches are bounded by it, and more distant pairs are set to
+        infinity (or omitted from a sparse result).
+        :param n_jobs: Number of worker processes. If None, use the number of CPUs. If 1, run serially.
+        :param sparse_result: If True, return a scipy.sparse.csr_matrix holding only the finite distances, including
+        any zeros. Otherwise return a dense array, with np.inf for unreachable pairs.
+        :return: (n_sources, n_targets) dense array or sparse matrix
+        """
+        tic = time.time()
+        sources = list(sources)
+        targets = sources if targets is None else list(targets)
+
+        groups = defaultdict(list)
+        for i, s in enumerate(sources):
+            groups[s.edge.fid].append(i)
+        jobs = []
+        for rows in groups.itervalues():
+            edge = sources[rows[0]].edge
+            jobs.append((
+                rows,
+                edge.fid,
+                edge.orientation_neg,
+                edge.orientation_pos,
+                [sources[i].node_dist[edge.orientation_neg] for i in rows],
+                [sources[i].node_dist[edge.orientation_pos] for i in rows],
+            ))
+
+        if sparse_result:
+            coo_rows, coo_cols, coo_data = [], [], []
+        else:
+            res = np.empty((len(sources), len(targets)))
+            res.fill(np.inf)
+
+        n_jobs = min(n_jobs or mp.cpu_count(), len(jobs))
+        if n_jobs <= 1:
+            ends = TargetEnds(self, targets)
+            results = ((job[0], self.distance_block(*job[1:], ends=ends, max_distance=max_distance))
+                       for job in jobs)
+            pool = None
+        else:
+            pool = mp.Pool(n_jobs, initializer=_init_distance_worker, initargs=(self, targets, max_distance))
+            results = pool.imap_unordered(_distance_worker_block, jobs, chunksize=max(1, len(jobs) // (4 * n_jobs)))
+
+        try:
+            for rows, block in results:
+                if sparse_result:
+                    i, j = np.nonzero(np.isfinite(block))
+                    coo_rows.append(np.asarray(rows)[i])
+                    coo_cols.append(j)
+                    coo_data.append(block[i, j])
+                else:
+                    res[rows] = block
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if sparse_result:
+            if coo_data:
+                coo_rows, coo_cols, coo_data = (np.concatenate(t) for t in (coo_rows, coo_cols, coo_data))
+            res = sparse.csr_matrix((coo_data, (coo_rows, coo_cols)), shape=(len(sources), len(targets)))
+
+        elapsed = time.time() - tic
+        print "Computed %d x %d network distances from %d source edges in %.2fs (%.0f pairs/s, %d processes)" % (
+            len(sources), len(targets), len(jobs), elapsed,
+            len(sources) * len(targets) / max(elapsed, 1e-9), max(n_jobs, 1)
+        )
+        return res
 
     ### ADDED BY GABS
     def next_turn(self, node, exclude_edges=None):
@@ -1361,6 +2125,20 @@ class StreetNet(object):
         Useful for avoiding reversals.
         :return: List of Edges
         """
+        overlay = self.chain_overlay(self.directed)
+        if overlay is not None and isinstance(exclude_edges, (list, tuple)) and len(exclude_edges) == 1:
+            # a walk through the middle of a chain can only continue along it
+            res = overlay.next_edge(node, exclude_edges[0], self.directed)
+            if res is not None:
+                return [Edge(self, orientation_neg=u, orientation_pos=v, fid=fid, verify=False) for u, v, fid in res]
+        if self._csr is not None:
+            exclude_edges = set(exclude_edges or [])
+            edges = []
+            for _, e, _ in self._csr.neighbours(self._csr.node_index[node], directed=self.directed):
+                node_neg, node_pos, fid = self._csr.edge_ends(e)
+                if fid not in exclude_edges:
+                    edges.append(Edge(self, orientation_neg=node_neg, orientation_pos=node_pos, fid=fid))
+            return edges
         if self.directed:
             graph = self.g_routing
         else:
@@ -1389,11 +2167,14 @@ class StreetNet(object):
         if bounding_poly:
             if radius:
                 bounding_poly = bounding_poly.buffer(radius)
-            return [Edge(self, **x[2])
-                    for x in self.g.edges(data=True) if bounding_poly.intersects(x[2]['linestring'])]
-            # g.edges ==> function inherited from networkx
-        else:
-            return [Edge(self, **x[2]) for x in self.g.edges(data=True)]
+            return [Edge(self, orientation_neg=n1, orientation_pos=n2, fid=fid)
+                    for n1, n2, fid, _ in self.spatial_index().edges_intersecting(bounding_poly)]
+
+        if self._csr is not None:
+            return [Edge(self, orientation_neg=n1, orientation_pos=n2, fid=fid)
+                    for n1, n2, fid in (self._csr.edge_ends(e) for e in xrange(self._csr.n_edges))]
+        # g.edges ==> function inherited from networkx
+        return [Edge(self, **x[2]) for x in self.g.edges(data=True)]
 
     ### ADDED BY GABS
     def nodes(self, bounding_poly=None):
@@ -1401,9 +2182,27 @@ class StreetNet(object):
         Get all nodes in the network. Optionally return only those that intersect the provided bounding polygon
         """
         if bounding_poly:
-            return [x[0] for x in self.g.nodes(data=True) if bounding_poly.intersects(Point(*x[1]['loc']))]
-        else:
-            return self.g.nodes()
+            return [t for t, _ in self.spatial_index().nodes_intersecting(bounding_poly)]
+        if self._csr is not None:
+            return list(self._csr.node_ids)
+        return self.g.nodes()
+
+    def spatial_index(self):
+        """
+        R-tree index of the edges and nodes (see spatial_index.py), used by the methods that select edges or nodes by
+        location. It is built when first needed and discarded if the graphs are replaced (see graph_changed).
+        """
+        if self._spatial_index is None:
+            if self._csr is not None:
+                csr = self._csr
+                edges = [csr.edge_ends(e) + (csr.linestring(e),) for e in xrange(csr.n_edges)]
+                nodes = zip(csr.node_ids, csr.node_loc.tolist())
+            else:
+                edges = [(attr[self.NODE0_KEY], attr[self.NODE1_KEY], fid, attr['linestring'])
+                         for _, _, fid, attr in self.g.edges_iter(keys=True, data=True)]
+                nodes = [(t, attr['loc']) for t, attr in self.g.nodes_iter(data=True)]
+            self._spatial_index = SpatialIndex(edges, nodes)
+        return self._spatial_index
 
     @property
     def edge(self):
@@ -1415,26 +2214,37 @@ class StreetNet(object):
         Returns a generator that iterates over all edge linestrings.
         This is useful for various spatial operations.
         """
-        for e in self.g.edges_iter(data=True):
-            yield e[2]['linestring']
+        for _, _, _, ls in self.edge_lines_iter():
+            yield ls
+
+    def edge_lines_iter(self):
+        """
+        Returns a generator that iterates over (node, node, edge ID, linestring) for all edges.
+        """
+        if self._csr is not None:
+            for e in xrange(self._csr.n_edges):
+                n1, n2, fid = self._csr.edge_ends(e)
+                yield n1, n2, fid, self._csr.linestring(e)
+        else:
+            for n1, n2, fid, attr in self.g.edges_iter(data=True, keys=True):
+                yield n1, n2, fid, attr['linestring']
 
     ### ADDED BY GABS
     def closest_edges_euclidean_brute_force(self, x, y, radius=None):
         pt = Point(x, y)
         if radius:
-            bpoly = pt.buffer(radius)
+            edges = self.spatial_index().edges_intersecting(pt.buffer(radius))
         else:
-            bpoly = None
-
-        edges = self.edges(bounding_poly=bpoly)  # FIXME: this looks inefficient?
+            edges = self.spatial_index().edges
         if not len(edges):
             # no valid edges found, bail.
             return None
 
-        snap_distances = [x.linestring.distance(pt) for x in edges]
+        snap_distances = [t[3].distance(pt) for t in edges]
         idx = np.argmin(snap_distances)
         snap_distance = snap_distances[idx]
-        closest_edge = edges[idx]
+        n1, n2, fid, _ = edges[idx]
+        closest_edge = Edge(self, orientation_neg=n1, orientation_pos=n2, fid=fid)
 
         da = closest_edge.linestring.project(pt)
         dist_along = {
@@ -1450,6 +2260,9 @@ class StreetNet(object):
         """
         Compute the rectangular bounding coordinates of the edges
         """
+        if self._csr is not None:
+            return self._csr.extent
+
         xmin = np.inf
         ymin = np.inf
         xmax = -np.inf
@@ -2,10 +2,12 @@ from network.utils import network_point_coverage
 
 __author__ = 'gabriel'
 from network import TEST_DATA_FILE
-from network.itn import read_gml, ITNStreetNet
+from network.itn import read_gml, read_gml_network, read_gml_tiles, ITNStreetNet, RoadNode, node_fid
 from network.streetnet import NetPath, NetPoint, Edge, GridEdgeIndex
+from network import osm, pbf, fileio, cache
 from data import models
 import os
+import re
 import unittest
 import settings
 import numpy as np
@@ -13,7 +15,16 @@ from matplotlib import pyplot as plt
 from network import utils
 from validation import hotspot, roc
 import networkx as nx
-from shapely.geometry import LineString
+from shapely.geometry import LineString, Point, box
+import tempfile
+import gzip
+import bz2
+import shutil
+import pyproj
+import zlib
+import StringIO
+import datetime
+import cPickle
 
 
 def load_test_network():
@@ -120,6 +131,9 @@ def toy_network(loop=False):
 
 class TestNetworkData(unittest.TestCase):
 
+    # points around the centre of the Brixton sample
+    SAMPLE_XY = [(531190, 175214), (531149, 175185), (531210, 175214), (531198, 174962), (531090, 175180)]
+
     def setUp(self):
         # this_dir = os.path.dirname(os.path.realpath(__file__))
         # IN_FILE = os.path.join(this_dir, 'test_data', 'mastermap-itn_417209_0_brixton_sample.gml')
@@ -128,6 +142,19 @@ class TestNetworkData(unittest.TestCase):
 
         self.itn_net = ITNStreetNet.from_data_structure(self.test_data)
 
+    def sample_points(self, net=None, same_edge=True):
+        '''
+        NetPoints snapped from SAMPLE_XY, for comparing the routing methods.
+        :param net: Defaults to self.itn_net.
+        :param same_edge: If True, a final point is added on the same edge as the first.
+        '''
+        net = net or self.itn_net
+        pts = [NetPoint.from_cartesian(net, x, y) for x, y in self.SAMPLE_XY]
+        if same_edge:
+            edge = pts[0].edge
+            pts.append(NetPoint(net, edge, {edge.orientation_neg: 0.2 * edge.length}))
+        return pts
+
     def test_grid_index(self):
         xmin, ymin, xmax, ymax =  self.itn_net.extent
         grid_edge_index = self.itn_net.build_grid_edge_index(50)
@@ -139,6 +166,667 @@ class TestNetworkData(unittest.TestCase):
         for eo, ee in zip(expected_extent, self.itn_net.extent):
             self.assertAlmostEqual(eo, ee)
 
+    def test_streaming_build(self):
+        # building from the streamed reader should give exactly the same network
+        net = ITNStreetNet.from_data_structure(read_gml_network(TEST_DATA_FILE))
+        self.assertItemsEqual(net.g.nodes(), self.itn_net.g.nodes())
+        self.assertItemsEqual(net.g.edges(keys=True), self.itn_net.g.edges(keys=True))
+        self.assertItemsEqual(net.g_routing.edges(keys=True), self.itn_net.g_routing.edges(keys=True))
+        for n1, n2, fid, attr in self.itn_net.g.edges(keys=True, data=True):
+            other = net.g[n1][n2][fid]
+            self.assertEqual(other.get('one_way'), attr.get('one_way'))
+            self.assertAlmostEqual(other['length'], attr['length'])
+
+    def test_largest_component(self):
+        # small fragments that are not joined to the rest of the network are dropped, whatever order they come in
+        data = read_gml_network(TEST_DATA_FILE)
+        atts = data.links.values()[0]
+        for i in range(200):
+            a, b = 'frag%d_a_0' % i, 'frag%d_b_0' % i
+            data.node_locs[node_fid(a)] = (i, 0.)
+            data.node_locs[node_fid(b)] = (i, 1.)
+            data.links['frag%d' % i] = dict(atts, fid='frag%d' % i, orientation_neg=a, orientation_pos=b,
+                                            linestring=LineString([(i, 0.), (i, 1.)]), length=1.)
+        net = ITNStreetNet.from_data_structure(data)
+        self.assertItemsEqual(net.g.nodes(), self.itn_net.g.nodes())
+
+    def test_tiled_build(self):
+        # split the sample into two overlapping tiles, as OS supplies them: every node and link goes in the tile(s)
+        # its geometry touches, so links crossing the boundary (and their FIDs) appear in both
+        with open(TEST_DATA_FILE, 'rb') as f:
+            raw = f.read()
+        members = list(re.finditer(r'<osgb:(networkMember|roadInformationMember|roadMember)>.*?</osgb:\1>', raw,
+                                   flags=re.S))
+        head = raw[:members[0].start()]
+        tail = raw[members[-1].end():]
+        x_split = 531400.
+        tiles = ([], [])
+        for m in members:
+            block = m.group(0)
+            if '<osgb:RoadNode ' in block or '<osgb:RoadLink ' in block:
+                xs = [float(t) for t in re.findall(r'([0-9.]+),[0-9.]+', ' '.join(
+                    re.findall(r'<gml:coordinates>(.*?)</gml:coordinates>', block)))]
+                if min(xs) <= x_split:
+                    tiles[0].append(block)
+                if max(xs) >= x_split:
+                    tiles[1].append(block)
+            else:
+                tiles[0].append(block)
+                tiles[1].append(block)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for i, blocks in enumerate(tiles):
+                filenames.append(os.path.join(tmp_dir, 'tile%d.gml' % i))
+                with open(filenames[-1], 'wb') as f:
+                    f.write(head + '\n'.join(blocks) + tail)
+            tile_data = [read_gml_network(fn) for fn in filenames]
+            shared = set(tile_data[0].links).intersection(tile_data[1].links)
+            self.assertTrue(len(shared))
+            self.assertLess(len(tile_data[0].links), len(self.test_data.roadLinks))
+            self.assertLess(len(tile_data[1].links), len(self.test_data.roadLinks))
+            for n_jobs in (1, 2):
+                net = ITNStreetNet.from_data_structure(read_gml_tiles(filenames, n_jobs=n_jobs))
+                self.assertItemsEqual(net.g.nodes(), self.itn_net.g.nodes())
+                # edges along the boundary are only added once
+                self.assertItemsEqual(net.g.edges(keys=True), self.itn_net.g.edges(keys=True))
+                self.assertItemsEqual(net.g_routing.edges(keys=True), self.itn_net.g_routing.edges(keys=True))
+                for n1, n2, fid, attr in self.itn_net.g.edges(keys=True, data=True):
+                    self.assertEqual(net.g[n1][n2][fid].get('one_way'), attr.get('one_way'))
+                    self.assertTrue(net.g[n1][n2][fid]['linestring'].equals(attr['linestring']))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_gml_filtered(self):
+        bbox = (531000, 174900, 531400, 175250)
+        data = read_gml(TEST_DATA_FILE, bbox=bbox, feature_types=('RoadNode', 'RoadLink', 'RoadRouteInformation'))
+        self.assertEqual(len(data.roads), 0)
+        self.assertEqual(len(data.roadLinkInformations), 0)
+        # exactly those links that intersect the box are kept
+        poly = box(*bbox)
+        expected = [k for k, v in self.test_data.roadLinks.items() if LineString(v.polyline).intersects(poly)]
+        self.assertItemsEqual(data.roadLinks.keys(), expected)
+        # links crossing the boundary keep both terminal nodes
+        for link in data.roadLinks.values():
+            self.assertTrue(node_fid(link.tags['orientation_neg']) in data.roadNodes)
+            self.assertTrue(node_fid(link.tags['orientation_pos']) in data.roadNodes)
+        # route information is only kept for the retained links
+        for rri in data.roadRouteInformations.values():
+            self.assertTrue(set(rri.route_members.values()).intersection(data.roadLinks))
+
+    def test_read_gml_compressed(self):
+        with open(TEST_DATA_FILE, 'rb') as f:
+            raw = f.read()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gz_file = os.path.join(tmp_dir, 'sample.gml.gz')
+            with gzip.open(gz_file, 'wb') as f:
+                f.write(raw)
+            bz2_file = os.path.join(tmp_dir, 'sample.gml.bz2')
+            with open(bz2_file, 'wb') as f:
+                f.write(bz2.compress(raw))
+            for threaded in (False, True):
+                for source in (gz_file, bz2_file):
+                    data = read_gml(source, threaded=threaded)
+                    self.assertItemsEqual(data.roadLinks.keys(), self.test_data.roadLinks.keys())
+                    self.assertItemsEqual(data.roadNodes.keys(), self.test_data.roadNodes.keys())
+                # file-like objects are read without being closed
+                with open(bz2_file, 'rb') as f:
+                    data = read_gml(f, threaded=threaded)
+                    self.assertFalse(f.closed)
+                self.assertItemsEqual(data.roadLinks.keys(), self.test_data.roadLinks.keys())
+            net = ITNStreetNet.from_data_structure(read_gml_network(gz_file))
+            self.assertItemsEqual(net.g.edges(keys=True), self.itn_net.g.edges(keys=True))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_multi_member_stream(self):
+        with open(TEST_DATA_FILE, 'rb') as f:
+            raw = f.read()
+        parts = [raw[:100000], raw[100000:500000], raw[500000:]]
+
+        def gzip_compress(s):
+            out = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                f.write(s)
+            return out.getvalue()
+
+        for compress, decompressor in ((bz2.compress, fileio.bz2_decompressor),
+                                       (gzip_compress, fileio.gzip_decompressor)):
+            members = [compress(t) for t in parts]
+            data = ''.join(members)
+            # member boundaries falling exactly on a chunk boundary, and inside a chunk
+            for chunksize in (len(members[0]), len(members[0]) + len(members[1]), 1000):
+                stream = fileio.InputStream(StringIO.StringIO(data), decompressor=decompressor, chunksize=chunksize)
+                self.assertEqual(stream.read(), raw)
+
+    def test_cache_tag_types(self):
+        tags = {
+            'count': 3,
+            'big': -2 ** 40,
+            'length': 2.5,
+            'whole': 4.,
+            'name': u'Acre Lane',
+            'time': datetime.time(7, 30, 15),
+        }
+        schema = [('roadNodes', RoadNode, 'eas_nor', 'point')]
+        stores = {'roadNodes': {u'n1': RoadNode(u'n1', (1., 2.), tags)}}
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache.save(tmp_dir, 'test', schema, stores)
+            res = cache.load(tmp_dir, 'test', schema)['roadNodes'][u'n1']
+            self.assertEqual(res.tags, tags)
+            # numbers come back with the type they went in with
+            for k, v in tags.items():
+                self.assertIs(type(res.tags[k]), type(v))
+            # integers that cannot be held exactly are refused
+            stores['roadNodes'][u'n1'].tags = {'huge': 2 ** 60}
+            self.assertRaises(TypeError, cache.save, tmp_dir, 'test2', schema, stores)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_gml_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            read_gml(TEST_DATA_FILE, cache_dir=tmp_dir)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            data = read_gml(TEST_DATA_FILE, cache_dir=tmp_dir)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            for store in ('roads', 'roadNodes', 'roadLinks', 'roadLinkInformations', 'roadRouteInformations'):
+                self.assertItemsEqual(getattr(data, store).keys(), getattr(self.test_data, store).keys())
+            for fid, link in self.test_data.roadLinks.items():
+                self.assertTrue(np.all(data.roadLinks[fid].polyline == link.polyline))
+                self.assertEqual(data.roadLinks[fid].tags, link.tags)
+                for k, v in link.tags.items():
+                    if not isinstance(v, basestring):
+                        self.assertIs(type(data.roadLinks[fid].tags[k]), type(v))
+            for fid, rri in self.test_data.roadRouteInformations.items():
+                self.assertEqual(data.roadRouteInformations[fid].route_members, rri.route_members)
+                self.assertEqual(data.roadRouteInformations[fid].tags, rri.tags)
+            net = ITNStreetNet.from_data_structure(data)
+            self.assertItemsEqual(net.g_routing.edges(keys=True), self.itn_net.g_routing.edges(keys=True))
+            # different options are cached separately
+            read_gml(TEST_DATA_FILE, cache_dir=tmp_dir, feature_types=('RoadNode', 'RoadLink'))
+            self.assertEqual(len(os.listdir(tmp_dir)), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_snapshot(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'itn_snapshot')
+            self.itn_net.save(path, fmt='snapshot')
+            net = ITNStreetNet.from_snapshot(path)
+            self.assertEqual(net.srid, self.itn_net.srid)
+            self.assertItemsEqual(net.g.nodes(data=True), self.itn_net.g.nodes(data=True))
+            self.assertItemsEqual(net.g.edges(keys=True), self.itn_net.g.edges(keys=True))
+            self.assertItemsEqual(net.g_routing.edges(keys=True), self.itn_net.g_routing.edges(keys=True))
+            for n1, n2, fid, attr in self.itn_net.g.edges(keys=True, data=True):
+                other = net.g[n1][n2][fid]
+                self.assertItemsEqual(other.keys(), attr.keys())
+                self.assertEqual(list(other['linestring'].coords), list(attr['linestring'].coords))
+                for k in attr:
+                    if k != 'linestring':
+                        self.assertEqual(other[k], attr[k])
+            # routing works on the loaded network
+            pt1 = NetPoint.from_cartesian(net, 531190, 175214)
+            pt2 = NetPoint.from_cartesian(net, 531149, 175185)
+            self.assertAlmostEqual((pt1 - pt2).length,
+                                   (NetPoint.from_cartesian(self.itn_net, 531190, 175214) -
+                                    NetPoint.from_cartesian(self.itn_net, 531149, 175185)).length)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_csr_backend(self):
+        net = ITNStreetNet.from_data_structure(self.test_data)
+        net.set_backend('csr')
+        self.assertEqual(net.backend, 'csr')
+        self.assertIsNone(net._g)
+        self.assertItemsEqual(net.nodes(), self.itn_net.nodes())
+        self.assertItemsEqual([(e.orientation_neg, e.orientation_pos, e.fid) for e in net.edges()],
+                              [(e.orientation_neg, e.orientation_pos, e.fid) for e in self.itn_net.edges()])
+        for eo, ee in zip(self.itn_net.extent, net.extent):
+            self.assertAlmostEqual(eo, ee)
+
+        def turns(n, v):
+            return sorted((e.orientation_neg, e.orientation_pos, e.fid) for e in n.next_turn(v))
+
+        for v in self.itn_net.nodes():
+            self.assertEqual(net.degree(v), self.itn_net.degree(v))
+            self.assertEqual(turns(net, v), turns(self.itn_net, v))
+        # directed routing only allows the one-way edges in one direction
+        net.directed = self.itn_net.directed = True
+        for v in self.itn_net.nodes():
+            self.assertEqual(turns(net, v), turns(self.itn_net, v))
+
+        # paths match those found by networkx, in both routing modes
+        pts_nx = self.sample_points(same_edge=False)
+        pts_csr = self.sample_points(net, same_edge=False)
+        self.assertEqual(pts_csr[0].cartesian_coords, pts_nx[0].cartesian_coords)
+        for directed in (False, True):
+            net.directed = self.itn_net.directed = directed
+            for a, b in zip(pts_nx, pts_csr):
+                for c, d in zip(pts_nx, pts_csr):
+                    p = a - c
+                    q = b - d
+                    self.assertAlmostEqual(q.length, p.length)
+                    self.assertEqual(q.edges, p.edges)
+                    self.assertEqual(q.nodes, p.nodes)
+                    self.assertEqual(q.splits, p.splits)
+
+        # the networkx graphs are built on demand
+        self.assertItemsEqual(net.g.edges(keys=True), self.itn_net.g.edges(keys=True))
+        self.assertItemsEqual(net.g_routing.edges(keys=True), self.itn_net.g_routing.edges(keys=True))
+
+        # a snapshot can be opened directly into the CSR backend
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'itn_snapshot')
+            self.itn_net.save(path, fmt='snapshot')
+            net = ITNStreetNet.from_snapshot(path, backend='csr')
+            self.assertIsNone(net._g)
+            pt1 = NetPoint.from_cartesian(net, *self.SAMPLE_XY[0])
+            pt2 = NetPoint.from_cartesian(net, *self.SAMPLE_XY[3])
+            self.assertAlmostEqual(pt1.distance(pt2), pts_nx[0].distance(pts_nx[3]))
+            net.set_backend('networkx')
+            self.assertEqual(net.backend, 'networkx')
+            self.assertEqual(len(net.g.edges()), len(self.itn_net.g.edges()))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_distances_from(self):
+        # includes a second point on the same edge as the first
+        pts = self.sample_points()
+        for directed in (False, True):
+            self.itn_net.directed = directed
+            for a in pts:
+                expected = np.array([(a - b).length for b in pts])
+                d = self.itn_net.distances_from(a, pts)
+                self.assertTrue(np.allclose(d, expected))
+                # targets beyond max_distance are infinitely far away
+                d = self.itn_net.distances_from(a, pts, max_distance=200)
+                self.assertTrue(np.all(np.isinf(d[expected > 200])))
+                self.assertTrue(np.allclose(d[expected <= 200], expected[expected <= 200]))
+
+    def test_astar(self):
+        pts = self.sample_points(same_edge=False)
+        for a in pts:
+            for b in pts:
+                p = self.itn_net.path_undirected(a, b, method='single_source')
+                q = self.itn_net.path_undirected(a, b, method='astar')
+                self.assertAlmostEqual(p.length, q.length)
+                self.assertEqual(p.nodes, q.nodes)
+                p = self.itn_net.path_directed(a, b)
+                q = self.itn_net.path_directed(a, b, method='astar')
+                self.assertAlmostEqual(p.length, q.length)
+                self.assertEqual(p.nodes, q.nodes)
+                self.assertAlmostEqual(self.itn_net.path_directed(a, b, length_only=True, method='astar'), p.length)
+        with self.assertRaises(AttributeError):
+            self.itn_net.path_directed(pts[0], pts[1], method='foo')
+
+    def test_bidirectional(self):
+        # includes a pair on the same edge, one of which is not reachable directly along a one-way edge
+        pts = self.sample_points()
+        for f in (self.itn_net.path_undirected, self.itn_net.path_directed):
+            for a in pts:
+                for b in pts:
+                    p = f(a, b, method='single_source')
+                    q = f(a, b, method='bidirectional')
+                    self.assertAlmostEqual(p.length, q.length)
+                    self.assertAlmostEqual(sum(q.distances), q.length)
+                    self.assertEqual(p.edges, q.edges)
+                    self.assertEqual(p.nodes, q.nodes)
+                    self.assertAlmostEqual(f(a, b, length_only=True, method='bidirectional'), p.length)
+
+    def test_routing_graph(self):
+        parallel = [(u, v, x) for u, nbrs in self.itn_net.g.adj.iteritems() for v, x in nbrs.iteritems() if len(x) > 1]
+        self.assertEqual(len(parallel), 6)
+        for backend in ('networkx', 'csr'):
+            self.itn_net.set_backend(backend)
+            graph = self.itn_net.routing_graph()
+            for u, v, x in parallel:
+                res = [t for t in graph[u] if t[0] == v]
+                self.assertEqual(len(res), 1)
+                self.assertEqual(res[0][1], min(x, key=lambda fid: x[fid]['length']))
+            self.assertEqual(sum(len(t) for t in graph.itervalues()),
+                             sum(len(x) for x in self.itn_net.g.adj.itervalues()))
+        self.itn_net.set_backend('networkx')
+
+        pts = self.sample_points(same_edge=False)
+        for directed in (False, True):
+            self.itn_net.directed = directed
+            net = self.itn_net.shortest_edges_network()
+            # in the directed case, two of the pairs of parallel edges are both needed, for travel in each direction
+            self.assertEqual(net.g.number_of_edges(), self.itn_net.g.number_of_edges() - (1 if directed else 3))
+            for u, v, fid, attr in net.g.edges(keys=True, data=True):
+                self.assertEqual(attr['fid'], fid)
+            # the same points on the reduced network
+            copies = [NetPoint(net, Edge(net, orientation_neg=t.edge.orientation_neg,
+                                         orientation_pos=t.edge.orientation_pos, fid=t.edge.fid), t.node_dist)
+                      for t in pts]
+            for a, a2 in zip(pts, copies):
+                for b, b2 in zip(pts, copies):
+                    p = a - b
+                    q = a2 - b2
+                    self.assertAlmostEqual(p.length, q.length)
+                    self.assertEqual(p.edges, q.edges)
+
+    def test_chain_overlay(self):
+        pts = self.sample_points()
+        # points on nodes that only join two edges
+        for n in [t for t in self.itn_net.g.nodes() if self.itn_net.degree(t) == 2][:3]:
+            e = self.itn_net.next_turn(n)[0]
+            m = e.orientation_pos if e.orientation_neg == n else e.orientation_neg
+            pts.append(NetPoint(self.itn_net, e, {n: 0., m: e.length}))
+        expected = [[(self.itn_net.path_undirected(a, b), self.itn_net.path_directed(a, b)) for b in pts] for a in pts]
+        turns = dict(((n, e.fid), sorted(t.fid for t in self.itn_net.next_turn(n, exclude_edges=[e.fid])))
+                     for n in self.itn_net.g.nodes() for e in self.itn_net.next_turn(n))
+
+        self.itn_net.build_chain_overlay()
+        overlay = self.itn_net.chain_overlay()
+        self.assertLess(overlay.n_junctions, self.itn_net.g.number_of_nodes())
+        for directed in (False, True):
+            self.itn_net.directed = directed
+            for a, row in zip(pts, expected):
+                for b, (p, q) in zip(pts, row):
+                    for method in ('single_source', 'bidirectional'):
+                        path = (self.itn_net.path_directed if directed else self.itn_net.path_undirected)(
+                            a, b, method=method)
+                        ref = q if directed else p
+                        self.assertEqual(path is None, ref is None)
+                        if ref is None:
+                            continue
+                        self.assertAlmostEqual(path.length, ref.length)
+                        self.assertEqual(path.edges, ref.edges)
+                        self.assertEqual(path.nodes, ref.nodes)
+                        self.assertTrue(np.allclose(path.distances, ref.distances))
+        # the walker continues through chains as before
+        self.itn_net.directed = False
+        for (n, fid), res in turns.iteritems():
+            self.assertEqual(sorted(t.fid for t in self.itn_net.next_turn(n, exclude_edges=[fid])), res)
+        self.itn_net.graph_changed()
+        self.assertIsNone(self.itn_net.chain_overlay())
+
+    def test_spatial_index(self):
+        xy = self.SAMPLE_XY
+        polys = [Point(x, y).buffer(r) for x, y in xy for r in (5., 50., 200.)]
+        csr_net = ITNStreetNet.from_multigraph(self.itn_net.g)
+        csr_net.set_backend('csr')
+        for net in (self.itn_net, csr_net):
+            for poly in polys:
+                ref = sorted(e.fid for e in net.edges() if poly.intersects(e.linestring))
+                self.assertEqual(sorted(e.fid for e in net.edges(bounding_poly=poly)), ref)
+                ref = sorted(t for t in net.nodes() if poly.intersects(Point(*net.node_loc(t))))
+                self.assertEqual(sorted(net.nodes(bounding_poly=poly)), ref)
+            for x, y in xy:
+                for radius in (None, 50.):
+                    pt, snap_distance = net.closest_edges_euclidean_brute_force(x, y, radius=radius)
+                    ref = min(net.edges(), key=lambda e: e.linestring.distance(Point(x, y)))
+                    self.assertEqual(pt.edge.fid, ref.fid)
+                    self.assertAlmostEqual(snap_distance, ref.linestring.distance(Point(x, y)))
+        # clipping only looks at the edges near the boundary
+        poly = polys[-1]
+        clipped = self.itn_net.within_boundary(poly.exterior.coords)
+        self.assertEqual(sorted(e.fid for e in clipped.edges()),
+                         sorted(e.fid for e in self.itn_net.edges(bounding_poly=poly)))
+        self.assertIsNotNone(self.itn_net._spatial_index)
+        self.itn_net.graph_changed()
+        self.assertIsNone(self.itn_net._spatial_index)
+
+    def test_contraction_hierarchy(self):
+        pts = self.sample_points()
+        expected = [[(self.itn_net.path_undirected(a, b), self.itn_net.path_directed(a, b)) for b in pts] for a in pts]
+        self.itn_net.build_contraction_hierarchy()
+        self.assertEqual(sorted(self.itn_net._ch), [False, True])
+
+        def check(net, pts):
+            for a, row in zip(pts, expected):
+                for b, (p, q) in zip(pts, row):
+                    for path, ref in ((net.path_undirected(a, b), p), (net.path_directed(a, b), q)):
+                        self.assertEqual(path is None, ref is None)
+                        if ref is None:
+                            continue
+                        self.assertAlmostEqual(path.length, ref.length)
+                        self.assertEqual(path.edges, ref.edges)
+                        self.assertEqual(path.nodes, ref.nodes)
+                        self.assertTrue(np.allclose(path.distances, ref.distances))
+
+        check(self.itn_net, pts)
+        # the hierarchies are saved with the network
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.itn_net.save(os.path.join(tmp_dir, 'snap'), fmt='snapshot')
+            net = ITNStreetNet.from_snapshot(os.path.join(tmp_dir, 'snap'), backend='csr')
+            self.assertEqual(sorted(net._ch), [False, True])
+            check(net, [NetPoint(net, Edge(net, **p.edge.attrs), p.node_dist) for p in pts])
+        finally:
+            shutil.rmtree(tmp_dir)
+        # and discarded when the graph is replaced
+        self.itn_net.g = self.itn_net.g.copy()
+        self.assertTrue(self.itn_net.contraction_hierarchy(False) is None)
+        with self.assertRaises(ValueError):
+            self.itn_net.path_undirected(pts[0], pts[1], method='ch')
+
+    def test_graph_changed_csr(self):
+        # edits made in place to the graphs of a CSR-backed network are picked up when graph_changed is called
+        ref = ITNStreetNet.from_multigraph(self.itn_net.g.copy())
+        net = ITNStreetNet.from_multigraph(self.itn_net.g.copy())
+        net.set_backend('csr')
+        a, b = self.sample_points(net, same_edge=False)[1:4:2]
+        before = a.distance(b)
+        u, v = ref.path_undirected(*self.sample_points(ref, same_edge=False)[1:4:2]).nodes[:2]
+        for t in (ref, net):
+            for g in (t.g, t.g_routing):
+                for x, y in ((u, v), (v, u)):
+                    if g.has_edge(x, y):
+                        for key in g[x][y].keys():
+                            g.remove_edge(x, y, key=key)
+        # not seen until graph_changed is called
+        self.assertAlmostEqual(a.distance(b), before)
+        ref.graph_changed()
+        net.graph_changed()
+        self.assertEqual(net.backend, 'csr')
+        expected = ref.path_undirected(*self.sample_points(ref, same_edge=False)[1:4:2]).length
+        self.assertGreater(expected, before)
+        a, b = self.sample_points(net, same_edge=False)[1:4:2]
+        self.assertAlmostEqual(a.distance(b), expected)
+        self.assertAlmostEqual(net.path_undirected(a, b).length, expected)
+
+    def test_landmarks(self):
+        pts = self.sample_points()
+        self.itn_net.build_landmarks(n_landmarks=4)
+        sources = [a for a in pts for b in pts]
+        targets = [b for a in pts for b in pts]
+        for directed in (False, True):
+            f = self.itn_net.path_directed if directed else self.itn_net.path_undirected
+            expected = np.array([f(a, b).length for a, b in zip(sources, targets)])
+            lower, upper = self.itn_net.distance_bounds(sources, targets, directed=directed)
+            self.assertTrue(np.all(lower <= expected + 1e-9))
+            self.assertTrue(np.all(upper >= expected - 1e-9))
+            if not directed:
+                # pairs on the same edge are known exactly in the undirected case
+                self.assertAlmostEqual(lower[len(pts) - 1], expected[len(pts) - 1])
+                self.assertAlmostEqual(upper[len(pts) - 1], expected[len(pts) - 1])
+            # A* guided by the landmarks finds the shortest path
+            for a, b, d in zip(sources, targets, expected):
+                self.assertAlmostEqual(f(a, b, method='alt', length_only=True), d)
+        self.itn_net.g = self.itn_net.g.copy()
+        self.assertTrue(self.itn_net.landmarks() is None)
+        with self.assertRaises(ValueError):
+            self.itn_net.distance_bounds(sources, targets)
+
+    def test_distance_table(self):
+        pts = self.sample_points()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for directed in (False, True):
+                f = self.itn_net.path_directed if directed else self.itn_net.path_undirected
+                expected = [[f(a, b).length for b in pts] for a in pts]
+                self.itn_net.build_distance_table(os.path.join(tmp_dir, 'table.npy'), directed=directed, n_jobs=2)
+                d = self.itn_net.table_distances([a for a in pts for b in pts], [b for a in pts for b in pts],
+                                                 directed=directed)
+                self.assertTrue(np.allclose(d, np.array(expected).flatten(), atol=1e-3))
+                # NetPoint.distance now uses the table
+                self.itn_net.directed = directed
+                for a, row in zip(pts, expected):
+                    for b, x in zip(pts, row):
+                        self.assertAlmostEqual(a.distance(b), x, places=3)
+                with self.assertRaises(ValueError):
+                    f(pts[0], pts[1], method='table')
+            # a file given by name is kept when the table is discarded
+            self.itn_net.graph_changed()
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, 'table.npy')))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # but a temporary file is deleted, whether the table is rebuilt or the graphs change
+        self.itn_net.build_distance_table(directed=False)
+        filename = self.itn_net.distance_table(False).filename
+        self.itn_net.build_distance_table(directed=False)
+        self.assertFalse(os.path.isfile(filename))
+        table = self.itn_net.distance_table(False)
+        # copies sent to other processes do not own the file
+        copy = cPickle.loads(cPickle.dumps(table, -1))
+        self.assertEqual(copy.node_distance(*table.node_ids[:2]), table.node_distance(*table.node_ids[:2]))
+        del copy
+        self.assertTrue(os.path.isfile(table.filename))
+        self.itn_net.graph_changed()
+        self.assertFalse(os.path.isfile(table.filename))
+
+    def test_path_cutoff(self):
+        pts = self.sample_points()
+        self.itn_net.build_contraction_hierarchy()
+        self.itn_net.build_landmarks(n_landmarks=4)
+        for directed in (False, True):
+            f = self.itn_net.path_directed if directed else self.itn_net.path_undirected
+            for method in ('single_source', 'bidirectional', 'astar', 'alt', 'ch'):
+                for a in pts:
+                    for b in pts:
+                        x = f(a, b, length_only=True)
+                        self.assertAlmostEqual(f(a, b, length_only=True, method=method, cutoff=x + 1.), x)
+                        self.assertAlmostEqual(f(a, b, length_only=True, method=method, cutoff=x + 1e-6), x)
+                        if x > 0:
+                            self.assertEqual(f(a, b, length_only=True, method=method, cutoff=x - 1.), np.inf)
+            with self.assertRaises(ValueError):
+                f(pts[0], pts[1], cutoff=100.)
+        self.itn_net.directed = False
+        self.assertEqual(pts[0].distance(pts[3], cutoff=1.), np.inf)
+
+    def test_distance_cache(self):
+        pts = self.sample_points()
+        for directed in (False, True):
+            f = self.itn_net.path_directed if directed else self.itn_net.path_undirected
+            expected = [[f(a, b).length for b in pts] for a in pts]
+            self.itn_net.enable_distance_cache()
+            cache = self.itn_net.distance_cache()
+            for method in ('single_source', 'ch'):
+                if method == 'ch':
+                    self.itn_net.build_contraction_hierarchy(directed=directed)
+                for _ in range(2):
+                    for a, row in zip(pts, expected):
+                        for b, x in zip(pts, row):
+                            self.assertAlmostEqual(f(a, b, length_only=True, method=method), x)
+                self.assertGreater(cache.hits, 0)
+                self.assertGreater(cache.misses, 0)
+                # replacing the graphs empties the cache
+                self.itn_net.graph_changed()
+                self.assertEqual(len(cache), 0)
+            # a small cache evicts the least recently used distances
+            self.itn_net.enable_distance_cache(max_bytes=1000)
+            cache = self.itn_net.distance_cache()
+            for a, row in zip(pts, expected):
+                for b, x in zip(pts, row):
+                    self.assertAlmostEqual(f(a, b, length_only=True), x)
+            self.assertGreater(cache.evictions, 0)
+            self.assertLessEqual(cache.n_bytes, 1000)
+            self.itn_net.disable_distance_cache()
+
+    def test_distance_matrix(self):
+        pts = self.sample_points()
+        for directed in (False, True):
+            self.itn_net.directed = directed
+            expected = np.array([self.itn_net.distances_from(a, pts[1:]) for a in pts])
+            for n_jobs in (1, 2):
+                d = self.itn_net.distance_matrix(pts, pts[1:], n_jobs=n_jobs)
+                self.assertTrue(np.allclose(d, expected))
+                d = self.itn_net.distance_matrix(pts, pts[1:], max_distance=200, n_jobs=n_jobs, sparse_result=True)
+                self.assertEqual(d.shape, expected.shape)
+                self.assertEqual(d.nnz, np.sum(expected <= 200))
+                d = d.toarray()
+                self.assertTrue(np.allclose(d[expected <= 200], expected[expected <= 200]))
+
+    def test_concurrent_paths(self):
+        import threading
+        pts = self.sample_points(same_edge=False)
+        edges = sorted(self.itn_net.g.edges(keys=True))
+        routing_edges = sorted(self.itn_net.g_routing.edges(keys=True))
+        for directed in (False, True):
+            self.itn_net.directed = directed
+            expected = [[a - b for b in pts] for a in pts]
+            errors = []
+
+            def work():
+                for _ in range(5):
+                    for i, a in enumerate(pts):
+                        for j, b in enumerate(pts):
+                            p = a - b
+                            if p.length != expected[i][j].length or p.nodes != expected[i][j].nodes:
+                                errors.append((i, j))
+
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+        # routing leaves the graphs untouched
+        self.assertEqual(sorted(self.itn_net.g.edges(keys=True)), edges)
+        self.assertEqual(sorted(self.itn_net.g_routing.edges(keys=True)), routing_edges)
+
+    def test_intern_ids(self):
+        net = ITNStreetNet.from_data_structure(self.test_data, intern_ids=True)
+        self.assertItemsEqual(net.nodes(), range(len(net.node_table)))
+        self.assertItemsEqual([net.node_table.to_fid(t) for t in net.nodes()], self.itn_net.nodes())
+        self.assertItemsEqual(
+            [(net.node_table.to_fid(u), net.node_table.to_fid(v), net.edge_table.to_fid(fid))
+             for u, v, fid in net.g_routing.edges(keys=True)],
+            self.itn_net.g_routing.edges(keys=True)
+        )
+        for e in net.edges():
+            self.assertIsInstance(e.fid, int)
+            attr = net.original_edge_attrs(e.attrs)
+            other = self.itn_net.g[attr['orientation_neg']][attr['orientation_pos']][attr['fid']]
+            self.assertEqual(net.edge_table.to_int(other['fid']), e.fid)
+            self.assertEqual(attr.get('one_way'), other.get('one_way'))
+            self.assertEqual(attr['length'], other['length'])
+
+        # routing is unaffected
+        xy = [(531190, 175214), (531149, 175185), (531198, 174962), (531090, 175180)]
+        for (x1, y1), (x2, y2) in zip(xy[:-1], xy[1:]):
+            self.assertAlmostEqual(
+                NetPoint.from_cartesian(net, x1, y1).distance(NetPoint.from_cartesian(net, x2, y2)),
+                NetPoint.from_cartesian(self.itn_net, x1, y1).distance(NetPoint.from_cartesian(self.itn_net, x2, y2))
+            )
+
+        # clipped nodes are added to the lookup table
+        poly = [(531000, 174800), (531500, 174800), (531500, 175300), (531000, 175300)]
+        clipped = net.within_boundary(poly)
+        self.assertItemsEqual([clipped.node_table.to_fid(t) for t in clipped.nodes()],
+                              self.itn_net.within_boundary(poly).nodes())
+        self.assertEqual(len(net.node_table), len(self.itn_net.nodes()))
+
+        # snapshots store the original IDs and are interned again on loading
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'itn_snapshot')
+            net.save(path, fmt='snapshot')
+            for backend in ('networkx', 'csr'):
+                loaded = ITNStreetNet.from_snapshot(path, backend=backend)
+                self.assertEqual(loaded.node_table.fids, net.node_table.fids)
+                self.assertItemsEqual(loaded.g.edges(keys=True), net.g.edges(keys=True))
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_net_point(self):
         #Four test points - 1 and 3 on same segment, 2 on neighbouring segment, 4 long way away.
         #5 and 6 are created so that there are 2 paths of almost-equal length between them - they
@@ -252,6 +940,112 @@ class TestNetworkData(unittest.TestCase):
         self.assertEqual(this_netpoint.edge, this_edge)
 
 
+class TestOSMData(unittest.TestCase):
+
+    def setUp(self):
+        this_dir = os.path.dirname(os.path.realpath(__file__))
+        self.osm_file = os.path.join(this_dir, 'test_data', 'camden_fragment.osm')
+        self.osm_net = osm.OSMStreetNet.from_data_structure(osm.read_data(self.osm_file), srid=None)
+
+    def test_highway_data(self):
+        data = osm.read_highway_data(self.osm_file)
+        self.assertTrue(all('highway' in w.tags and w.tags['highway'] != 'service' for w in data.ways.values()))
+        # only the nodes referenced by highways are retained
+        refs = set(int(t) for w in data.ways.values() for t in w.nds)
+        self.assertItemsEqual(data.node_ids, refs)
+        net = osm.OSMStreetNet.from_data_structure(data, srid=None)
+        self.assertItemsEqual(net.g.nodes(data=True), self.osm_net.g.nodes(data=True))
+        self.assertItemsEqual(net.g.edges(keys=True), self.osm_net.g.edges(keys=True))
+        self.assertItemsEqual(net.g_routing.edges(keys=True), self.osm_net.g_routing.edges(keys=True))
+
+    def test_read_data_filtered(self):
+        data = osm.read_data(self.osm_file)
+        lonlat = np.array([t.lonlat for t in data.nodes.values()])
+        lo, hi = lonlat.min(axis=0), lonlat.max(axis=0)
+        bbox = tuple(lo + 0.45 * (hi - lo)) + tuple(lo + 0.55 * (hi - lo))
+        poly = box(*bbox)
+
+        def meets(way):
+            coords = [data.nodes[t].lonlat for t in way.nds if t in data.nodes]
+            return len(coords) > 0 and (LineString(coords) if len(coords) > 1 else Point(coords[0])).intersects(poly)
+
+        filtered = osm.read_data(self.osm_file, bbox=bbox)
+        # exactly those ways that meet the box are kept, not others that only share a node with them
+        expected = [k for k, w in data.ways.items() if meets(w)]
+        self.assertTrue(0 < len(expected) < len(data.ways))
+        self.assertItemsEqual(filtered.ways.keys(), expected)
+        # ways crossing the boundary keep all of their nodes
+        expected = set(t for w in filtered.ways.values() for t in w.nds if t in data.nodes)
+        expected.update(k for k, v in data.nodes.items() if poly.intersects(Point(*v.lonlat)))
+        self.assertItemsEqual(filtered.nodes.keys(), expected)
+
+    def test_projection(self):
+        data = osm.read_data(self.osm_file)
+        net = osm.OSMStreetNet.from_data_structure(data, srid=27700)
+        # the locations computed for the edges are reused for the nodes and then dropped
+        self.assertIsNone(net._node_locs)
+        self.assertItemsEqual(net.g.nodes(), self.osm_net.g.nodes())
+        wgs84 = pyproj.Proj(init='epsg:4326')
+        bng = pyproj.Proj(init='epsg:27700')
+        for v, attr in net.g.nodes(data=True):
+            x, y = pyproj.transform(wgs84, bng, *data.nodes[v].lonlat)
+            self.assertAlmostEqual(attr['loc'][0], x, places=6)
+            self.assertAlmostEqual(attr['loc'][1], y, places=6)
+        # and the edges run between their projected nodes
+        for n1, n2, fid, attr in net.g.edges(keys=True, data=True):
+            ls = attr['linestring']
+            self.assertTrue(np.allclose(ls.coords[0], net.g.node[attr['orientation_neg']]['loc']))
+            self.assertTrue(np.allclose(ls.coords[-1], net.g.node[attr['orientation_pos']]['loc']))
+
+    def test_pbf(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pbf_file = os.path.join(tmp_dir, 'camden_fragment.osm.pbf')
+            pbf.write_pbf(pbf_file, osm.read_data(self.osm_file))
+            for n_jobs in (1, 2):
+                net = osm.OSMStreetNet.from_pbf(pbf_file, n_jobs=n_jobs, srid=None)
+                self.assertItemsEqual(net.g.edges(keys=True), self.osm_net.g.edges(keys=True))
+                self.assertItemsEqual(net.g_routing.edges(keys=True), self.osm_net.g_routing.edges(keys=True))
+                for v in self.osm_net.g:
+                    for a, b in zip(net.g.node[v]['loc'], self.osm_net.g.node[v]['loc']):
+                        self.assertAlmostEqual(a, b, places=6)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_pbf_wire_format(self):
+        # a PrimitiveBlock encoded by hand, independently of pbf.write_pbf:
+        # string table ['', 'highway', 'residential']
+        strings = '\x0a\x18' + '\x0a\x00' + '\x0a\x07highway' + '\x0a\x0bresidential'
+        # DenseNodes 10 and 12 at lat (5, -3) and lon (100, 300) granularity units: delta and zigzag coded
+        dense = '\x0a\x02\x14\x04' + '\x42\x02\x0a\x0f' + '\x4a\x04\xc8\x01\x90\x03'
+        # Way 7 through nodes 10 and 12, tagged highway=residential
+        way = '\x08\x07' + '\x12\x01\x01' + '\x1a\x01\x02' + '\x42\x02\x14\x04'
+        group = '\x12\x0e' + dense + '\x1a\x0c' + way
+        block = strings + '\x12\x1e' + group
+        self.assertEqual(len(block), 58)
+
+        raw_blob = '\x0a\x3a' + block
+        compressed = zlib.compress(block)
+        zlib_blob = '\x10\x3a' + '\x1a' + chr(len(compressed)) + compressed
+        for blob in (raw_blob, zlib_blob):
+            ids, lonlat, ways = pbf.decode_data_blob((blob, None))
+            self.assertEqual(ids.tolist(), [10, 12])
+            self.assertTrue(np.allclose(lonlat, [[1e-5, 5e-7], [3e-5, -3e-7]]))
+            self.assertEqual(ways, [('7', ['10', '12'], {'highway': 'residential'})])
+            self.assertEqual(pbf.decode_data_blob((blob, ('residential',)))[2], [])
+
+        # BlobHeader: type 'OSMData' and the size of the blob, preceded by its own length
+        header = '\x0a\x07OSMData' + '\x18' + chr(len(zlib_blob))
+        f = StringIO.StringIO('\x00\x00\x00' + chr(len(header)) + header + zlib_blob)
+        self.assertEqual(list(pbf.iter_blobs(f)), [('OSMData', zlib_blob)])
+
+        # other compression methods are a data error
+        with self.assertRaises(ValueError):
+            pbf.decode_blob('\x10\x3a' + '\x22\x03abc')
+        with self.assertRaises(ValueError):
+            pbf.decode_blob('\x10\x3a' + '\x4a\x03abc')
+
 class TestUtils(unittest.TestCase):
     def setUp(self):
         self.test_data = read_gml(TEST_DATA_FILE)
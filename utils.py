@@ -230,7 +230,8 @@ def network_linkages(data_source_net,
                      data_target_txy=None,
                      chunksize=2**18,
                      remove_coincident_pairs=False,
-                     time_gte_zero=True):
+                     time_gte_zero=True,
+                     max_distance=None):
     """
     Compute the indices of datapoints that are within the following tolerances:
     interpoint distance less than max_d
@@ -248,6 +249,9 @@ def network_linkages(data_source_net,
     data_source and data_target, otherwise the two are set equal
     :param data_target_txy: as above but a EuclideanSpaceTimeData array
     :param chunksize: The size of an iteration chunk.
+    :param max_distance: Optional upper limit on the network distance of a link, used to bound the network searches.
+    Pairs further apart than this are given an infinite distance before linkage_fun is applied. If landmarks have
+    been built on the network (StreetNet.build_landmarks), pairs whose lower bound exceeds this are not searched.
     :return: tuple (idx_array_source, idx_array_target),
     """
     ndata_source = data_source_net.ndata
@@ -296,6 +300,34 @@ def network_linkages(data_source_net,
     if not idx_i.size:
         return np.array([]), np.array([]), np.array([]), np.array([])
 
+    # network distances, computed with one search from each target point to all of its linked sources rather than
+    # one search per pair. The distance is measured from target to source, as NetPoint.distance would.
+    idx_i = np.asarray(idx_i).ravel()
+    idx_j = np.asarray(idx_j).ravel()
+    source_points = data_source_net.space.toarray(0)
+    target_points = data_target_net.space.toarray(0)
+    net_dd = np.empty(idx_i.size)
+    net_dd.fill(np.inf)
+
+    # if the network has landmark distances, their lower bounds discard pairs that cannot be within max_distance
+    # without searching
+    to_search = np.ones(idx_i.size, dtype=bool)
+    graph = target_points[0].graph
+    if max_distance is not None and graph.landmarks(graph.directed) is not None:
+        lower, _ = graph.distance_bounds(target_points[idx_j], source_points[idx_i])
+        to_search = lower <= max_distance
+        print "Eliminated %d / %d remaining links using landmark bounds (%.1f %%)" % (
+            idx_i.size - to_search.sum(),
+            idx_i.size,
+            100. * (1 - to_search.mean())
+        )
+
+    order = np.argsort(idx_j, kind='mergesort')
+    order = order[to_search[order]]
+    for grp in np.split(order, np.flatnonzero(np.diff(idx_j[order])) + 1) if order.size else []:
+        target = target_points[idx_j[grp[0]]]
+        net_dd[grp] = target.graph.distances_from(target, source_points[idx_i[grp]], max_distance=max_distance)
+
     link_i = []
     link_j = []
     dt = []
@@ -305,12 +337,12 @@ def network_linkages(data_source_net,
 
     for k in range(0, idx_i.size, chunksize):
         # get chunk indices
-        i = idx_i.flat[k:(k + chunksize)]
-        j = idx_j.flat[k:(k + chunksize)]
+        i = idx_i[k:(k + chunksize)]
+        j = idx_j[k:(k + chunksize)]
 
         # recompute dt and dd, this time using NETWORK DISTANCE
         this_dt = (data_target_net.time.getrows(j) - data_source_net.time.getrows(i)).toarray(0)
-        this_dd = (data_target_net.space.getrows(j).distance(data_source_net.space.getrows(i))).toarray(0)  # RATE-LIMIT
+        this_dd = net_dd[k:(k + chunksize)]
 
         # reapply the linkage threshold function
         mask_net = linkage_fun(this_dt, this_dd) & (this_dt > 0)
@@ -762,7 +794,7 @@ def network_walker_fixed_distance(net_obj,
         next_node = get_next_node(edge, path.nodes[-1])
 
         if path.distance_total + el <= distance:
-            if net_obj.g.degree(next_node) == 1:
+            if net_obj.degree(next_node) == 1:
                 # terminal node: stop here
                 node_dist = {
                     path.nodes[-1]: el,